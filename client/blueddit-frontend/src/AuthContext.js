@@ -1,5 +1,5 @@
 import React, { createContext, useState, useContext, useEffect } from 'react';
-import config from './config';
+import { apiFetch } from './api';
 
 const AuthContext = createContext();
 
@@ -37,7 +37,7 @@ export const AuthProvider = ({ children }) => {
 
   const logout = async () => {
     try {
-      const response = await fetch(`${config.API_BASE_URL}/logout`, {
+      const response = await apiFetch('/logout', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
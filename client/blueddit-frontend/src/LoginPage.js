@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { Link, useNavigate } from "react-router-dom";
 import Navbar from "./Navbar";
-import config from './config';
+import { apiFetch } from './api';
 
 function LoginPage() {
     const [username, setUsername] = useState('');
@@ -22,7 +22,7 @@ function LoginPage() {
         }
 
         try {
-            const response = await fetch(`${config.API_BASE_URL}/login`, {
+            const response = await apiFetch('/login', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -66,7 +66,7 @@ function LoginPage() {
         }
 
         try {
-            const response = await fetch(`${config.API_BASE_URL}/register`, {
+            const response = await apiFetch('/register', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 
-import config from './config';
+import { apiFetch } from './api';
 
 import Navbar from "./Navbar";
 import LoadingPage from "./LoadingPage";
@@ -17,6 +17,7 @@ function MainPage() {
   const [createPostText, setCreatePostText] = useState("");
   const [errorMessage, setErrorMessage] = useState("");
   const [scores, setScores] = useState({});
+  const [nextCursor, setNextCursor] = useState(null);
   const { username } = useAuth();
 
   useEffect(() => {
@@ -30,7 +31,7 @@ function MainPage() {
 
   const handleVote = async (id, type) => {
     try {
-      const response = await fetch(`${config.API_BASE_URL}/post_vote`, {
+      const response = await apiFetch('/post_vote', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -92,7 +93,7 @@ function MainPage() {
     const userId = localStorage.getItem('user_id');
 
     try {
-      const response = await fetch(`${config.API_BASE_URL}/create_post`, {
+      const response = await apiFetch('/create_post', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -110,23 +111,25 @@ function MainPage() {
     }
   }
 
-  useEffect(() => {
-    const fetchPosts = async () => {
-      try {
-        const response = await fetch(`${config.API_BASE_URL}/posts`);
-        if (!response.ok) {
-          throw new Error('Network response was not ok');
-        }
-        const data = await response.json();
-        setPosts(data[0][0]);
-      } catch (error) {
-        setError(error.message);
-      } finally {
-        setLoading(false);
+  const fetchPosts = async (cursor) => {
+    try {
+      const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+      const response = await apiFetch(`/posts${query}`);
+      if (!response.ok) {
+        throw new Error('Network response was not ok');
       }
-    };
+      const data = await response.json();
+      setPosts(prevPosts => cursor ? [...prevPosts, ...data.posts] : data.posts);
+      setNextCursor(data.next_cursor);
+    } catch (error) {
+      setError(error.message);
+    } finally {
+      setLoading(false);
+    }
+  };
 
-    fetchPosts();
+  useEffect(() => {
+    fetchPosts(null);
   }, []);
 
   if (loading) {
@@ -175,6 +178,7 @@ function MainPage() {
           </td>
         </tr>
       ))}
+      {nextCursor ? <tr><td /><td><button className="create-post" onClick={() => fetchPosts(nextCursor)}>Load more</button></td></tr> : <></>}
     </table>
   </>;
 }
@@ -1,20 +1,94 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useMemo } from 'react';
 import { Link, useParams } from "react-router-dom";
 import Navbar from "./Navbar";
 import config from './config';
+import { apiFetch } from './api';
 import LoadingPage from './LoadingPage';
 import NotFound from './NotFound';
 import Helmet from 'react-helmet';
 import { getCookie } from './AuthContext';
 import { useAuth } from './AuthContext';
 
-const Comment = ({ comment, post }) => {
+// Fetches the next page of a thread from a `next_cursor` / `more_replies` token
+const fetchThreadPage = async (postId, cursor) => {
+  const response = await apiFetch(`/post/${postId}?cursor=${encodeURIComponent(cursor)}`);
+  if (!response.ok) {
+    throw new Error('Network response was not ok');
+  }
+  const data = await response.json();
+  return data[postId];
+};
+
+// Live updates arrive both as the response to our own writes and as an event
+// on the thread's stream; whichever comes first is applied, the other skipped
+const claimedEvents = new Set();
+const claimEvent = (eventId) => {
+  if (!eventId) {
+    return true;
+  }
+  if (claimedEvents.has(eventId)) {
+    return false;
+  }
+  claimedEvents.add(eventId);
+  return true;
+};
+
+// Listens to the thread's event stream and re-dispatches each event on an
+// EventTarget, so every comment can pick out the events about itself
+const useThreadEvents = (postId, onResync) => {
+  const events = useMemo(() => new EventTarget(), [postId]);
+
+  useEffect(() => {
+    const source = new EventSource(`${config.API_BASE_URL}/post/${postId}/events`);
+    const forward = (message) => {
+      const data = JSON.parse(message.data);
+      if (claimEvent(data.event_id)) {
+        events.dispatchEvent(new CustomEvent(message.type, { detail: data }));
+      }
+    };
+    source.addEventListener('comment_created', forward);
+    source.addEventListener('score_changed', forward);
+    source.addEventListener('resync', onResync);
+    return () => source.close();
+  }, [postId]);
+
+  return events;
+};
+
+// Calls handler(detail) for events of `type` while the component is mounted
+const useThreadEvent = (events, type, handler) => {
+  useEffect(() => {
+    if (!events) {
+      return undefined;
+    }
+    const listener = (event) => handler(event.detail);
+    events.addEventListener(type, listener);
+    return () => events.removeEventListener(type, listener);
+  }, [events, type, handler]);
+};
+
+const Comment = ({ comment, post, events }) => {
   const [score, setScore] = useState(comment.score);
+  const [replies, setReplies] = useState(comment.replies || []);
+  const [moreReplies, setMoreReplies] = useState(comment.more_replies);
   const [showReplyBox, setShowReplyBox] = useState(false);
   const [replyText, setReplyText] = useState("");
   const [errorMessage, setErrorMessage] = useState("");
   const { username } = useAuth();
 
+  useThreadEvent(events, 'score_changed', (data) => {
+    if (data.kind === 'comment' && data.id === comment.id) {
+      setScore((prevScore) => prevScore + data.delta);
+    }
+  });
+
+  useThreadEvent(events, 'comment_created', (data) => {
+    // Replies beyond "Load more replies" show up when that page is loaded
+    if (data.comment.parent_id === comment.id && !moreReplies) {
+      setReplies((prevReplies) => [...prevReplies, data.comment]);
+    }
+  });
+
   const handleReplyClick = () => {
     setShowReplyBox(!showReplyBox);
   };
@@ -43,7 +117,7 @@ const Comment = ({ comment, post }) => {
     const userId = localStorage.getItem('user_id');
 
     try {
-      const response = await fetch(`${config.API_BASE_URL}/comments`, {
+      const response = await apiFetch('/comments', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -64,7 +138,7 @@ const Comment = ({ comment, post }) => {
 
   const handleVote = async (voteType) => {
     try {
-      const response = await fetch(`${config.API_BASE_URL}/comment_vote`, {
+      const response = await apiFetch('/comment_vote', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -80,7 +154,9 @@ const Comment = ({ comment, post }) => {
       if (response.ok) {
         const data = await response.json(); // Await the JSON data from response
         const newScore = data.new_score !== undefined ? data.new_score : 0;
-        setScore((prevScore) => prevScore + newScore);
+        if (claimEvent(data.event_id)) {
+          setScore((prevScore) => prevScore + newScore);
+        }
       } else {
         alert('Failed to submit vote');
         console.error('Failed to submit vote');
@@ -91,6 +167,16 @@ const Comment = ({ comment, post }) => {
     }
   };
 
+  const handleLoadMoreReplies = async () => {
+    try {
+      const page = await fetchThreadPage(post.post.id, moreReplies);
+      setReplies(prevReplies => [...prevReplies, ...page.comments]);
+      setMoreReplies(page.next_cursor);
+    } catch (error) {
+      alert(error);
+    }
+  };
+
   return (
     <>
       <div className="comment-container">
@@ -101,7 +187,7 @@ const Comment = ({ comment, post }) => {
         </div>
         <div className="comment-content">
           <p className="comment-username">{"u/" + comment.username}</p>
-          <p className="comment-text">{comment.content}</p>
+          <p className="comment-text">{comment.truncated ? "[Reload to see this comment]" : comment.content}</p>
           {username ? <button className="comment-reply" onClick={handleReplyClick}>Reply</button> : <></>}
         </div>
       </div>
@@ -122,13 +208,14 @@ const Comment = ({ comment, post }) => {
         </div>
       )}
       <div className="comment-replies">
-        {comment.replies && comment.replies.length > 0 && (
+        {replies.length > 0 && (
           <div className="comment-replies">
-            {comment.replies.map((reply) => (
-              <Comment key={reply.id} comment={reply} post={post} />
+            {replies.map((reply) => (
+              <Comment key={reply.id} comment={reply} post={post} events={events} />
             ))}
           </div>
         )}
+        {moreReplies ? <button className="comment-reply" onClick={handleLoadMoreReplies}>Load more replies</button> : <></>}
       </div>
     </>
   );
@@ -159,6 +246,8 @@ function PostPage() {
   const { username } = useAuth();
 
   const [postScore, setPostScore] = useState(0);
+  const [comments, setComments] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
 
   useEffect(() => {
     setPostScore(post.post ? post.post.score : 0);
@@ -166,7 +255,7 @@ function PostPage() {
 
   const handlePostVote = async (type) => {
     try {
-      const response = await fetch(`${config.API_BASE_URL}/post_vote`, {
+      const response = await apiFetch('/post_vote', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -182,7 +271,9 @@ function PostPage() {
       if (response.ok) {
         const data = await response.json();
         const newScore = data.new_score !== undefined ? data.new_score : 0;
-        setPostScore(postScore + newScore);
+        if (claimEvent(data.event_id)) {
+          setPostScore((prevScore) => prevScore + newScore);
+        }
       } else {
         alert('Failed to submit vote');
         console.error('Failed to submit vote');
@@ -219,7 +310,7 @@ function PostPage() {
     const userId = localStorage.getItem('user_id');
 
     try {
-      const response = await fetch(`${config.API_BASE_URL}/comments`, {
+      const response = await apiFetch('/comments', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -237,27 +328,61 @@ function PostPage() {
     }
   };
 
-  useEffect(() => {
-    const fetchPosts = async () => {
-      try {
-        const response = await fetch(`${config.API_BASE_URL}/post/${postId}`);
-        if (!response.ok) {
-          throw new Error('Network response was not ok');
-        }
-        const data = await response.json();
-        setPost(data[postId]);
-      } catch (error) {
-        setError(error.message);
-      } finally {
-        setLoading(false);
+  // Bumped on every refetch so comments remount with the fresh scores
+  const [threadVersion, setThreadVersion] = useState(0);
+
+  const fetchPosts = async () => {
+    try {
+      const response = await apiFetch(`/post/${postId}`);
+      if (!response.ok) {
+        throw new Error('Network response was not ok');
       }
-    };
+      const data = await response.json();
+      setPost(data[postId]);
+      setComments(data[postId].comments);
+      setNextCursor(data[postId].next_cursor);
+      setThreadVersion((prevVersion) => prevVersion + 1);
+    } catch (error) {
+      setError(error.message);
+    } finally {
+      setLoading(false);
+    }
+  };
 
+  useEffect(() => {
     fetchPosts();
   }, []);
 
+  // Events may have been missed; start over from a fresh copy of the thread
+  const events = useThreadEvents(postId, fetchPosts);
+
+  useThreadEvent(events, 'score_changed', (data) => {
+    if (data.kind === 'post') {
+      setPostScore((prevScore) => prevScore + data.delta);
+    }
+  });
+
+  useThreadEvent(events, 'comment_created', (data) => {
+    // Comments beyond "Load more comments" show up when that page is loaded
+    if (data.comment.parent_id === null && !nextCursor) {
+      setComments((prevComments) => [...prevComments, data.comment]);
+    }
+  });
+
+  const handleLoadMoreComments = async () => {
+    try {
+      const page = await fetchThreadPage(postId, nextCursor);
+      setComments(prevComments => [...prevComments, ...page.comments]);
+      setNextCursor(page.next_cursor);
+    } catch (error) {
+      alert(error);
+    }
+  };
+
   const renderComments = (comments) => {
-    return comments ? comments.map((comment) => <Comment key={comment.id} comment={comment} post={post} />) : <></>;
+    return comments ? comments.map((comment) => (
+      <Comment key={`${threadVersion}-${comment.id}`} comment={comment} post={post} events={events} />
+    )) : <></>;
   };
 
   if (loading) {
@@ -310,7 +435,10 @@ function PostPage() {
           </div>
         </div>
         <hr />
-        <div className="comments-block">{renderComments(post.comments)}</div>
+        <div className="comments-block">
+          {renderComments(comments)}
+          {nextCursor ? <button className="comment-reply" onClick={handleLoadMoreComments}>Load more comments</button> : <></>}
+        </div>
       </div>
     </>
   );
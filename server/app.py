@@ -1,135 +1,708 @@
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, Response, g, request
 from flask_cors import CORS
-from werkzeug.security import generate_password_hash, check_password_hash
 import uuid
 import psycopg2
-from psycopg2 import pool, sql
+import psycopg2.errors
+from psycopg2.extras import execute_values
+from psycopg2 import sql
+from psycopg2.pool import PoolError
 import os
+import sys
+import json
+import signal
+import atexit
+import time
+import base64
+import html
+import math
 from datetime import datetime
 
-app = Flask(__name__)
-
-CORS(app, resources={r"/api/*": {"origins": "http://localhost:3000"}})  # Allow cross-origin requests from React
+from cache import CacheBackendError, SharedCache, SingleFlight, RenderCache, VersionCounter
+from cache_backends import MemoryBackend, RedisBackend
+from compression import PrecompressedBody, choose_encoding, compress, encoded_etag, should_compress, ENCODINGS
+from db_pool import ConnectionPool
+from events import PostEvents, Subscription, event_payload, new_event_id, notify, notify_many
+from hashing import PasswordHasher, HasherBusy
+from metrics import RequestMetrics, TimedCursor, error_log, record_pool_wait
+from queries import (
+    db_config,
+    statements,
+    SESSION_TTL,
+    validate_token_params,
+    FEED_SORTS,
+    DEFAULT_FEED_SORT,
+    DEFAULT_FEED_LIMIT,
+    MAX_FEED_LIMIT,
+    FEED_SNAPSHOT_QUERIES,
+    DEFAULT_THREAD_LIMIT,
+    MAX_THREAD_LIMIT,
+    DEFAULT_THREAD_DEPTH,
+    MAX_THREAD_DEPTH,
+    thread_first_level_params,
+    thread_replies_params,
+    SEARCH_TYPES,
+    DEFAULT_SEARCH_LIMIT,
+    MAX_SEARCH_LIMIT,
+    MAX_SEARCH_QUERY,
+    SEARCH_TIMEOUT_QUERY,
+    SNIPPET_START,
+    SNIPPET_STOP,
+)
+from ranked_feed import RankedFeed, Snapshot, post_row
+from replicas import ReplicaRouter, parse_lsn, write_position
+from score_buffer import ScoreBuffer
+from serialization import dumps, json_response
+from sessions import SignedTokens, SessionJanitor, REVOKE_TOKEN_QUERY
 
-# Database connection parameters
-db_config = {
-    'dbname': 'postgres',
-    'user': 'postgres',
-    'password': os.environ.get("DB_PASSWORD"),
-    'host': 'localhost'
-}
+app = Flask(__name__)
 
-connection_pool = pool.SimpleConnectionPool(1, 10, **db_config)
+CORS(app, resources={r"/api/*": {"origins": "http://localhost:3000"}},
+     expose_headers=["X-Read-After"])  # Allow cross-origin requests from React
+
+# Password hashing and checks run in HASH_WORKERS worker processes, with up to
+# HASH_QUEUE more waiting; past that register/login answer 503 at once. The
+# workers are forked here, before the connection pool, the cache backends or
+# any thread exist, so that they inherit no sockets or held locks.
+password_hasher = PasswordHasher(
+    workers=int(os.environ.get("HASH_WORKERS", os.cpu_count() or 2)),
+    max_queue=int(os.environ.get("HASH_QUEUE", 32)),
+    timeout=float(os.environ.get("HASH_TIMEOUT", 30)),
+)
+password_hasher.start()
+atexit.register(password_hasher.stop)
+
+# Blocks for up to POOL_TIMEOUT seconds when all POOL_MAX connections are in
+# use, so bursts queue instead of failing; see db_pool.py
+connection_pool = ConnectionPool(
+    int(os.environ.get("POOL_MIN", 1)),
+    int(os.environ.get("POOL_MAX", 10)),
+    timeout=float(os.environ.get("POOL_TIMEOUT", 10)),
+    healthcheck_after=float(os.environ.get("POOL_HEALTHCHECK_AFTER", 30)),
+    cursor_factory=TimedCursor,
+    **db_config
+)
+
+# The caches below live in this process by default, each bounded by its own
+# size setting. With CACHE_URL (redis://host:port/db) they live in a Redis
+# server shared by every worker and node instead, so a cache filled by one is
+# warm for all and an invalidation by one is seen by all; see cache.py and
+# cache_backends.py.
+CACHE_URL = os.environ.get("CACHE_URL")
+shared_cache_backend = RedisBackend(CACHE_URL) if CACHE_URL else None
+
+def cache_backend(maxsize, weigh=None):
+    return shared_cache_backend or MemoryBackend(maxsize, weigh)
+
+# Maps session token -> user_id for recently validated tokens, so authenticated
+# writes usually skip the sessions lookup. Entries are dropped on logout; with
+# per-process caches other workers still honour a revoked token for at most
+# SESSION_CACHE_TTL seconds.
+session_cache = SharedCache(
+    cache_backend(int(os.environ.get("SESSION_CACHE_SIZE", 10000))),
+    "session",
+    ttl=float(os.environ.get("SESSION_CACHE_TTL", 300)),
+    encode=lambda user_id: str(user_id).encode(),
+    decode=int,
+)
+
+# Responses smaller than this many bytes are sent uncompressed
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+
+# Serialized /api/post/<id> responses keyed by post id, stored with their
+# compressed variants (PrecompressedBody) and bounded by the total size of
+# those in bytes. Writes that change a thread invalidate its entry after they
+# commit.
+thread_cache = RenderCache(
+    cache_backend(int(os.environ.get("THREAD_CACHE_BYTES", 64 * 1024 * 1024)), weigh=len),
+    "thread",
+    ttl=float(os.environ.get("THREAD_CACHE_TTL", 60)),
+    encode=PrecompressedBody.pack,
+    decode=PrecompressedBody.unpack,
+)
+
+# First pages of /api/posts that ranked_feed cannot answer, keyed by feed
+# version, sort and limit, so a new version simply misses
+feed_cache = SharedCache(
+    cache_backend(int(os.environ.get("FEED_CACHE_BYTES", 16 * 1024 * 1024)), weigh=len),
+    "feed",
+    ttl=float(os.environ.get("FEED_CACHE_TTL", 60)),
+    encode=PrecompressedBody.pack,
+    decode=PrecompressedBody.unpack,
+)
+
+# Bumped by writes that can change /api/posts: new posts and post votes.
+# Threads are versioned by thread_cache's per-post generations instead.
+feed_version = VersionCounter(feed_cache.backend, "feed:version")
+
+# Identical reads in flight at the same time share one query and one rendered
+# body instead of each holding a pooled connection, e.g. when a thread goes
+# viral. Cached first pages are coalesced by their caches' get_or_compute();
+# these flights cover the pages that are never cached. Keys include the
+# version the caller's ETag was taken at and its read-your-writes position,
+# so nobody is handed a read older than what it must see.
+read_flights = {"thread_page": SingleFlight(), "feed_page": SingleFlight(), "search": SingleFlight()}
+
+def coalesced_reads():
+    # Requests served by another request's read, by kind, since start
+    return {"thread": thread_cache.flight.shared, "feed": feed_cache.flight.shared,
+            **{name: flight.shared for name, flight in read_flights.items()}}
+
+# Latency, query, pool-wait and serialization metrics per route, served at
+# /metrics. Requests slower than SLOW_REQUEST_MS are logged with a per-query
+# breakdown, a SLOW_REQUEST_SAMPLE fraction of them; unset disables the log.
+request_metrics = RequestMetrics(
+    slow_threshold=float(os.environ["SLOW_REQUEST_MS"]) / 1000 if os.environ.get("SLOW_REQUEST_MS") else None,
+    sample_rate=float(os.environ.get("SLOW_REQUEST_SAMPLE", 1.0)),
+)
 
 def get_db_connection():
+    started = time.perf_counter()
     try:
         conn = connection_pool.getconn()
         return conn
-    except psycopg2.OperationalError as e:
+    except (psycopg2.OperationalError, PoolError) as e:
         print(f"Error: Could not get connection from the pool. Details: {e}")
         return None
+    finally:
+        record_pool_wait(time.perf_counter() - started)
     
 def release_db_connection(conn):
     connection_pool.putconn(conn)
 
+# Receives the shared cache's invalidations; a thread, so started after the
+# hasher's fork
+if shared_cache_backend is not None:
+    shared_cache_backend.start()
+    atexit.register(shared_cache_backend.stop)
+
+# Streaming replicas for read-only queries, as comma-separated host[:port]
+# entries in DB_REPLICAS (same database and credentials as db_config). A
+# replica gets no reads while it is more than REPLICA_MAX_LAG seconds behind,
+# see replicas.py. Writes and token checks always use the primary.
+replica_configs = []
+for replica_address in filter(None, os.environ.get("DB_REPLICAS", "").split(",")):
+    replica_host, _, replica_port = replica_address.strip().partition(":")
+    replica_configs.append({**db_config, 'host': replica_host, 'port': int(replica_port or 5432)})
+
+replica_router = None
+replica_pools = []
+if replica_configs:
+    replica_pools = [
+        ConnectionPool(
+            int(os.environ.get("POOL_MIN", 1)),
+            int(os.environ.get("POOL_MAX", 10)),
+            timeout=float(os.environ.get("POOL_TIMEOUT", 10)),
+            healthcheck_after=float(os.environ.get("POOL_HEALTHCHECK_AFTER", 30)),
+            cursor_factory=TimedCursor,
+            **config
+        )
+        for config in replica_configs
+    ]
+    replica_router = ReplicaRouter(
+        db_config,
+        replica_configs,
+        max_lag=float(os.environ.get("REPLICA_MAX_LAG", 1)),
+        check_interval=float(os.environ.get("REPLICA_CHECK_INTERVAL", 0.5)),
+    )
+    replica_router.start()
+    atexit.register(replica_router.stop)
+
+# Replies to writes carry the primary's WAL position after the write, in an
+# X-Read-After header and a cookie of the same name. Reads that send it back
+# only go to replicas that have replayed it, so writers see their own writes.
+READ_AFTER_COOKIE_AGE = 60
+
+def note_write(conn):
+    # Call after committing a write on conn
+    if replica_router is not None:
+        g.read_after = write_position(conn)
+
+def request_read_after():
+    return parse_lsn(request.headers.get("X-Read-After") or request.cookies.get("read_after"))
+
+def get_read_connection():
+    # Returns (conn, replica): a replica's connection when one may serve this
+    # request, else the primary's with replica None. Release both with
+    # release_read_connection.
+    if replica_router is not None:
+        replica = replica_router.choose(request_read_after())
+        if replica is not None:
+            started = time.perf_counter()
+            try:
+                return replica_pools[replica].getconn(), replica
+            except (psycopg2.OperationalError, PoolError) as e:
+                print(f"Error: Could not get a replica connection, reading from the primary. Details: {e}")
+                replica_router.mark_failed(replica)
+            finally:
+                record_pool_wait(time.perf_counter() - started)
+    return get_db_connection(), None
+
+def release_read_connection(conn, replica):
+    if replica is None:
+        release_db_connection(conn)
+    else:
+        replica_pools[replica].putconn(conn)
+
+# Optional write-behind mode for vote scores: vote rows are still written per
+# request, but score changes are summed in memory and applied in one batched
+# UPDATE every VOTE_FLUSH_INTERVAL seconds, and once more at shutdown. Scores
+# served by the read endpoints may lag by up to one interval.
+score_buffer = None
+if os.environ.get("VOTE_BUFFER") == "1":
+    score_buffer = ScoreBuffer(
+        get_db_connection,
+        release_db_connection,
+        interval=float(os.environ.get("VOTE_FLUSH_INTERVAL", 1.0)),
+    )
+    score_buffer.start()
+    atexit.register(score_buffer.stop)
+
+# Sessions expire SESSION_TTL seconds after login. With SESSION_TOKENS=signed
+# tokens are HMAC-signed with SESSION_SECRET and checked in-process instead of
+# against the sessions table; logging out adds the token to a revocation list
+# that other processes pick up within SESSION_PURGE_INTERVAL seconds.
+signed_tokens = None
+if os.environ.get("SESSION_TOKENS", "db") == "signed":
+    if not os.environ.get("SESSION_SECRET"):
+        raise RuntimeError("SESSION_SECRET must be set when SESSION_TOKENS=signed")
+    signed_tokens = SignedTokens(os.environ["SESSION_SECRET"], SESSION_TTL)
+
+# Deletes expired sessions and revocations every SESSION_PURGE_INTERVAL
+# seconds, and refreshes the revocation list in signed mode
+session_janitor = SessionJanitor(
+    get_db_connection,
+    release_db_connection,
+    interval=float(os.environ.get("SESSION_PURGE_INTERVAL", 60)),
+    session_ttl=SESSION_TTL,
+    signed_tokens=signed_tokens,
+)
+if signed_tokens is not None:
+    session_janitor.run_once()
+session_janitor.start()
+atexit.register(session_janitor.stop)
+
+# One LISTEN connection per process feeds every /api/post/<id>/events stream.
+# Each viewer buffers at most EVENTS_QUEUE events before it is told to resync.
+post_events = PostEvents(lambda: psycopg2.connect(**db_config))
+post_events.start()
+atexit.register(post_events.stop)
+EVENTS_QUEUE = int(os.environ.get("EVENTS_QUEUE", 64))
+EVENTS_HEARTBEAT = float(os.environ.get("EVENTS_HEARTBEAT", 15))
+
+def pool_gauge():
+    stats = connection_pool.stats()
+    return {state: stats[state] for state in ("in_use", "idle", "waiting")}
+
+request_metrics.add_gauge("blueddit_db_pool_connections", "Pooled connections by state.", pool_gauge,
+                          labelname="state")
+request_metrics.add_gauge("blueddit_password_hasher", "Password hasher activity.",
+                          lambda: {key: value for key, value in password_hasher.stats().items()
+                                   if key in ("in_flight", "completed", "rejected")},
+                          labelname="stat")
+request_metrics.add_gauge("blueddit_post_events", "Live thread event streams.",
+                          lambda: {key: value for key, value in post_events.stats().items()
+                                   if key in ("posts", "subscribers")},
+                          labelname="stat")
+request_metrics.add_gauge("blueddit_cache_entries", "Entries held per cache.",
+                          lambda: {name: cache.stats()["size"] or 0 for name, cache in
+                                   (("sessions", session_cache), ("threads", thread_cache), ("feeds", feed_cache))},
+                          labelname="cache")
+request_metrics.add_gauge("blueddit_coalesced_reads", "Reads served by a concurrent identical read, since start.",
+                          coalesced_reads, labelname="read")
+if replica_router is not None:
+    # Replicas whose lag is unknown (unreachable, or just started) are left out
+    request_metrics.add_gauge("blueddit_replica_lag_seconds", "Replication lag per read replica.",
+                              lambda: {replica["host"]: replica["lag"] for replica in replica_router.stats()["replicas"]
+                                       if replica["lag"] is not None},
+                              labelname="replica")
+
+@app.before_request
+def begin_request_metrics():
+    # Label by route pattern rather than path to keep the series count bounded
+    request_metrics.begin(request.method, request.url_rule.rule if request.url_rule else "unmatched")
+
+@app.after_request
+def finish_request_metrics(response):
+    request_metrics.finish(response.status_code)
+    return response
+
+# Registered after the metrics hook so it runs before it, and compression
+# time counts towards the request
+@app.after_request
+def compress_response(response):
+    if response.is_streamed or response.direct_passthrough:
+        return response
+    size = response.content_length or 0
+    if not should_compress(response.status_code, response.mimetype, response.content_encoding, size,
+                           COMPRESS_MIN_SIZE):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+    if encoding is None:
+        return response
+    response.set_data(compress(response.get_data(), encoding))
+    response.content_encoding = encoding
+    if "ETag" in response.headers:
+        response.headers["ETag"] = encoded_etag(response.headers["ETag"], encoding)
+    return response
+
+@app.after_request
+def send_read_after(response):
+    read_after = g.get("read_after")
+    if read_after is not None:
+        response.headers["X-Read-After"] = read_after
+        response.set_cookie("read_after", read_after, max_age=READ_AFTER_COOKIE_AGE, samesite="Lax")
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/hello', methods=['GET'])
 def hello_world():
-    return jsonify(message="Hello from Flask!")
+    return json_response({"message": "Hello from Flask!"})
+
+def hot_rank(score, created_at):
+    # Mirrors hot_rank() in migrations/0002_votes_and_sessions.sql
+    sign = (score > 0) - (score < 0)
+    return sign * math.log10(max(abs(score), 1)) + (created_at - datetime(1970, 1, 1)).total_seconds() / 45000
+
+# The FEED_SORTS keys computed in Python from a ranked_feed row
+FEED_SORT_KEYS = {
+    'top': lambda row: row[7],
+    'new': lambda row: row[5],
+    'hot': lambda row: hot_rank(row[7], row[5]),
+}
+
+def encode_cursor(*values):
+    payload = json.dumps(values, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
 
-def get_posts_int(conn):
+# Range of the INTEGER columns (ids, scores) cursor values are compared with
+MIN_INTEGER, MAX_INTEGER = -2 ** 31, 2 ** 31 - 1
+
+def is_integer(value):
+    # bool is an int subclass, but never one we issued
+    return isinstance(value, int) and not isinstance(value, bool) and MIN_INTEGER <= value <= MAX_INTEGER
+
+def decode_cursor(cursor, length):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError("Malformed cursor")
+
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Malformed cursor")
+    return values
+
+def encode_feed_cursor(sort, key, post_id):
+    if isinstance(key, datetime):
+        key = key.isoformat()
+    return encode_cursor(sort, key, post_id)
+
+def decode_feed_cursor(cursor, sort):
+    # Returns (key, post_id) or raises ValueError for anything we did not issue
+    cursor_sort, key, post_id = decode_cursor(cursor, 3)
+
+    if cursor_sort != sort:
+        raise ValueError("Cursor does not match the requested sort")
+    if not is_integer(post_id):
+        raise ValueError("Malformed cursor")
+
+    if sort == 'new':
+        if not isinstance(key, str):
+            raise ValueError("Malformed cursor")
+        try:
+            key = datetime.fromisoformat(key)
+        except ValueError:
+            raise ValueError("Malformed cursor")
+    elif sort == 'top' and not is_integer(key):
+        raise ValueError("Malformed cursor")
+    elif sort == 'hot':
+        if isinstance(key, bool) or not isinstance(key, (int, float)):
+            raise ValueError("Malformed cursor")
+        try:
+            key = float(key)
+        except OverflowError:
+            raise ValueError("Malformed cursor")
+        if not math.isfinite(key):
+            raise ValueError("Malformed cursor")
+
+    return key, post_id
+
+def parse_feed_args(args):
+    # Returns (sort, limit, cursor) from the query string or raises ValueError
+    # with a message for the client
+    sort = args.get('sort', DEFAULT_FEED_SORT)
+    if sort not in FEED_SORTS:
+        raise ValueError(f"Unknown sort, expected one of: {', '.join(FEED_SORTS)}")
+
+    try:
+        limit = int(args.get('limit', DEFAULT_FEED_LIMIT))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    limit = max(1, min(limit, MAX_FEED_LIMIT))
+
+    cursor = args.get('cursor')
+    cursor = decode_feed_cursor(cursor, sort) if cursor else None
+    return sort, limit, cursor
+
+# The first FEED_MATERIALIZE posts of every ordering, held in memory so that
+# most feed pages need no query; 0 turns it off. Kept current from the post
+# events of every process and reloaded every FEED_REFRESH_INTERVAL seconds.
+FEED_MATERIALIZE = int(os.environ.get("FEED_MATERIALIZE", 1000))
+ranked_feed = None
+if FEED_MATERIALIZE > 0:
+    ranked_feed = RankedFeed(FEED_SORT_KEYS, FEED_MATERIALIZE,
+                             refresh_interval=float(os.environ.get("FEED_REFRESH_INTERVAL", 300)))
+
+def on_post_event(event):
+    # Runs on the post_events listener thread for writes made by any process.
+    # Per-process thread caches learn of other processes' writes here; a
+    # shared one was invalidated by the writer.
+    if event["type"] in ("comment_created", "score_changed") and not thread_cache.backend.shared:
+        thread_cache.invalidate(event["post_id"])
+
+    if event["type"] == "post_created":
+        if ranked_feed is not None:
+            if event["post"].get("truncated"):
+                ranked_feed.refetch(event["post_id"])
+            else:
+                ranked_feed.add_post(post_row(event["post"]))
+    elif event["type"] == "score_changed" and event["kind"] == "post":
+        if ranked_feed is not None:
+            ranked_feed.apply_vote(event["id"], event["delta"], event.get("txid"))
+    elif event["type"] == "resync":
+        if ranked_feed is not None:
+            ranked_feed.reload()
+    else:
+        return
+    # Also when the version is shared and the writer bumped it already: this
+    # process may have served the old feed under the new version until now
+    feed_version.bump()
+
+post_events.watch(on_post_event)
+
+def sync_ranked_feed():
+    # Reloads ranked_feed when it is due and fetches the posts it asks for,
+    # so that it can answer page(). Reads the primary, never a replica: rows
+    # older than the events already applied would undo them.
+    reload = ranked_feed.begin_reload()
+    pending = ranked_feed.take_pending()
+    if not reload and not pending:
+        return
+
+    conn = get_db_connection()
+    if conn is None:
+        if reload:
+            ranked_feed.abort_reload()
+        return
     cur = conn.cursor()
-    query = sql.SQL(
-        """
-SELECT json_agg(json_build_object(
-    'id', p.id,
-    'user_id', p.user_id,
-    'author', u.username,
-    'title', p.title,
-    'content', p.content,
-    'created_at', p.created_at,
-    'updated_at', p.updated_at,
-    'score', p.score
-) ORDER BY p.score DESC ) 
-FROM posts p
-JOIN users u ON p.user_id = u.id;
-"""
-    )
-    
     try:
-        cur.execute(query)
-        result = cur.fetchall()
+        try:
+            if reload and score_buffer is not None:
+                # The snapshot will see the votes buffered here, so their
+                # deltas must be in the rows too. Those of votes committed
+                # between the two, or buffered by other processes, are not
+                # until the next reload.
+                score_buffer.flush()
+            for query in FEED_SNAPSHOT_QUERIES:
+                cur.execute(query)
+            snapshot = Snapshot(cur.fetchone()[0])
+            if reload:
+                rows = {}
+                for sort in FEED_SORTS:
+                    statements.execute(cur, f"feed_{sort}", (ranked_feed.size,))
+                    rows[sort] = cur.fetchall()
+        except Exception:
+            if reload:
+                ranked_feed.abort_reload()
+            raise
+        if reload:
+            ranked_feed.finish_reload(rows, snapshot)
+
+        if pending:
+            statements.execute(cur, "feed_posts", (list(pending),))
+            for row in cur.fetchall():
+                ranked_feed.add_post(tuple(row), snapshot)
+        conn.rollback()
+    finally:
+        cur.close()
+        release_db_connection(conn)
 
-        if result:
-            return result
-        else:
-            return None
-    except:
+def feed_post(row):
+    # A post as it appears in a feed page, from a feed_query or ranked_feed row
+    post_id, user_id, username, title, content, created_at, updated_at, score = row[:8]
+    return {
+        "id": post_id,
+        "user_id": user_id,
+        "author": username,
+        "title": title,
+        "content": content,
+        "created_at": created_at,
+        "updated_at": updated_at,
+        "score": score,
+    }
+
+def feed_page(rows, sort, limit):
+    # `rows` holds up to limit + 1 results of feed_query; the extra row tells
+    # us whether there is a next page without a COUNT(*)
+    posts = [feed_post(row) for row in rows[:limit]]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_feed_cursor(sort, last[8], last[0])
+
+    return {"posts": posts, "sort": sort, "next_cursor": next_cursor}
+
+def get_posts_int(conn, sort=DEFAULT_FEED_SORT, limit=DEFAULT_FEED_LIMIT, cursor=None):
+    params = (cursor if cursor is not None else ()) + (limit + 1,)
+
+    cur = conn.cursor()
+    try:
+        statements.execute(cur, f"feed_{sort}_after" if cursor is not None else f"feed_{sort}", params)
+        return feed_page(cur.fetchall(), sort, limit)
+    except Exception as e:
+        print(f"Error fetching posts: {e}")
+        conn.rollback()
         return None
     finally:
         cur.close()
 
-import json
+def encode_thread_cursor(parent_id, after_id):
+    return encode_cursor(parent_id, after_id)
 
-def get_comments_json(conn, post_id):
+def decode_thread_cursor(cursor):
+    # Returns (parent_id, after_id); parent_id is None for top-level comments
+    parent_id, after_id = decode_cursor(cursor, 2)
+    if (parent_id is not None and not is_integer(parent_id)) or not is_integer(after_id):
+        raise ValueError("Malformed cursor")
+    return parent_id, after_id
+
+def parse_thread_args(args):
+    # Returns (limit, max_depth, thread_cursor) from the query string or raises
+    # ValueError with a message for the client
     try:
-        cursor = conn.cursor()
-        # Fetch post details
-        cursor.execute("SELECT p.id, p.user_id, p.title, p.content, p.created_at, p.updated_at, p.score, u.username FROM posts p INNER JOIN users u ON p.user_id = u.id WHERE p.id = %s", (post_id,))
-        post = cursor.fetchone()
-        
-        # Fetch comments
-        cursor.execute("""
-            SELECT p.id, p.parent_comment_id, p.content, p.created_at, p.score, u.username 
-            FROM comments p 
-            JOIN users u ON p.user_id = u.id 
-            WHERE p.post_id = %s
-        """, (post_id,))
-
-        response = cursor.fetchall()
-        # Organize comments into a structured format
-        comments_dict = {}
-        for comment in response:
-            comment_id, parent_comment_id, content, created_at, score, username = comment
-            comments_dict[comment_id] = {
+        limit = int(args.get('limit', DEFAULT_THREAD_LIMIT))
+        max_depth = int(args.get('max_depth', DEFAULT_THREAD_DEPTH))
+    except ValueError:
+        raise ValueError("limit and max_depth must be integers")
+    limit = max(1, min(limit, MAX_THREAD_LIMIT))
+    max_depth = max(1, min(max_depth, MAX_THREAD_DEPTH))
+
+    thread_cursor = args.get('cursor')
+    thread_cursor = decode_thread_cursor(thread_cursor) if thread_cursor else None
+    return limit, max_depth, thread_cursor
+
+class ThreadBuilder:
+    """Assembles a comment thread one level at a time.
+
+    Feed it the first level and then whatever THREAD_REPLIES_QUERY returns for
+    the parents add_level() asks for, until it asks for none; result() gives
+    the response payload.
+    """
+
+    def __init__(self, post_id, limit, max_depth, parent_id, after_id):
+        self.post_id = post_id
+        self.limit = limit
+        self.max_depth = max_depth
+        self.parent_id = parent_id
+        self.after_id = after_id
+        self.budget = limit
+        self.depth = 0
+        self.next_cursor = None
+        self.comments = {}
+        self.top_level = []
+
+    def add_level(self, level):
+        # Returns the ids whose replies should be fetched next
+        self.depth += 1
+        if self.depth == 1 and len(level) > self.limit:
+            level = level[:self.limit]
+            self.next_cursor = encode_thread_cursor(self.parent_id, level[-1][0])
+
+        self.budget -= len(level)
+        for comment in level:
+            comment_id, parent_comment_id, content, created_at, score, username, reply_count = comment
+            self.comments[comment_id] = {
                 "id": comment_id,
                 "parent_id": parent_comment_id,
                 "content": content,
                 "username": username,
-                "created_at": created_at.isoformat(),  # Assuming created_at is a datetime object
+                "created_at": created_at,
                 "score": score,
-                "replies": []
+                "replies": [],
+                "reply_count": reply_count,
             }
+            # Build the hierarchical structure for replies
+            if self.depth == 1:
+                self.top_level.append(self.comments[comment_id])
+            else:
+                self.comments[parent_comment_id]["replies"].append(self.comments[comment_id])
+
+        if self.depth >= self.max_depth or self.budget <= 0:
+            return []
+        return [comment[0] for comment in level if comment[6] > 0]
+
+    def result(self, post):
+        # Anything with fewer replies attached than it has gets a continuation
+        for comment in self.comments.values():
+            replies = comment["replies"]
+            if comment.pop("reply_count") > len(replies):
+                comment["more_replies"] = encode_thread_cursor(comment["id"], replies[-1]["id"] if replies else 0)
 
-        # Build the hierarchical structure for replies
-        for comment in response:
-            comment_id, parent_id, _, _, _, _ = comment
-            if parent_id is not None:
-                # Check if the parent_id exists in the comments_dict before accessing it
-                if parent_id in comments_dict:
-                    comments_dict[parent_id]["replies"].append(comments_dict[comment_id])
-                else:
-                    print(f"Warning: Parent ID {parent_id} not found in comments_dict.")
-
-        result = {
-            post_id: {
+        return {
+            self.post_id: {
                 "post": {
                     "id": post[0],
                     "title": post[2],
                     "body": post[3],
                     "author": post[7],
-                    "created_at": post[4].isoformat(),  # Assuming created_at is a datetime object
-                    "updated_at": post[5].isoformat(),  # Assuming created_at is a datetime object
+                    "created_at": post[4],
+                    "updated_at": post[5],
                     "score": post[6],
                 },
-                "comments": [comment for comment in comments_dict.values() if comment["parent_id"] is None]
+                "comments": self.top_level,
+                "next_cursor": self.next_cursor,
             }
         }
 
-        return json.dumps(result, indent=4, sort_keys=True, default=str)  # Convert to JSON string
+def get_comments_json(conn, post_id, limit=DEFAULT_THREAD_LIMIT, max_depth=DEFAULT_THREAD_DEPTH, thread_cursor=None):
+    # Returns at most `limit` comments, `max_depth` levels deep, starting from
+    # the top-level comments of the post or, when thread_cursor is given, from
+    # the replies to the comment it points at. Comments whose replies were cut
+    # off carry a `more_replies` cursor; `next_cursor` continues the first level.
+    # None only if the post does not exist: database errors are raised, so
+    # that they are answered with a 500 and never cached as a missing post.
+    parent_id, after_id = thread_cursor if thread_cursor is not None else (None, 0)
+    builder = ThreadBuilder(post_id, limit, max_depth, parent_id, after_id)
+
+    cursor = conn.cursor()
+    try:
+        # Fetch post details
+        statements.execute(cursor, "thread_post", (post_id,))
+        post = cursor.fetchone()
+        if post is None:
+            return None
 
-    except Exception as e:
-        print(f"Error: {e}")
-        return json.dumps({})  # Return an empty JSON object in case of error
+        statements.execute(cursor, "thread_top_level" if parent_id is None else "thread_replies_to",
+                           thread_first_level_params(post_id, parent_id, after_id, limit))
+        parents = builder.add_level(cursor.fetchall())
+        while parents:
+            statements.execute(cursor, "thread_replies", thread_replies_params(post_id, parents, builder.budget))
+            parents = builder.add_level(cursor.fetchall())
+
+        # Compact bytes, ready to be cached and sent as-is
+        return dumps(builder.result(post))
+
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
 
 def create_post(conn, user_id, title, content):
     cur = conn.cursor()
@@ -137,7 +710,7 @@ def create_post(conn, user_id, title, content):
         """
 INSERT INTO posts (user_id, title, content, created_at, updated_at, score)
 VALUES (%s, %s, %s, %s, %s, 0)
-RETURNING id;
+RETURNING id, user_id, (SELECT username FROM users WHERE id = posts.user_id);
 """
     )
     
@@ -147,10 +720,18 @@ RETURNING id;
         cur.execute(query, (user_id, title, content, now, now))
         
         # Fetch the ID of the newly created post
-        post_id = cur.fetchone()[0]
+        post_id, user_id, username = cur.fetchone()
+        row = (post_id, user_id, username, title, content, now, now, 0)
+        notify(cur, post_id, "post_created", new_event_id(), post=feed_post(row))
         
         # Commit the transaction
         conn.commit()
+        note_write(conn)
+        feed_version.bump()
+        # Also applied when the event comes back, but readers of this process
+        # should see the post straight away
+        if ranked_feed is not None:
+            ranked_feed.add_post(row)
         
         return post_id
     except Exception as e:
@@ -161,10 +742,15 @@ RETURNING id;
     finally:
         cur.close()
 
+def comment_event(comment_id, parent_id, content, username, created_at):
+    # A new comment as it appears in a thread page, see ThreadBuilder
+    return {"id": comment_id, "parent_id": parent_id, "content": content, "username": username,
+            "created_at": created_at, "score": 0, "replies": []}
+
 def create_comment(conn, user_id, token, post_id, content, parent_comment_id=None):
     # Validate user token
     if not validate_user_token(conn, user_id, token):
-        return json.dumps({"error": "Invalid token or user ID."}), 403
+        return {"error": "Invalid token or user ID."}, 403
     
     try:
         cursor = conn.cursor()
@@ -173,61 +759,172 @@ def create_comment(conn, user_id, token, post_id, content, parent_comment_id=Non
         cursor.execute("""
             INSERT INTO comments (post_id, user_id, content, parent_comment_id, created_at, score) 
             VALUES (%s, %s, %s, %s, NOW(), 0)
-            RETURNING id;
+            RETURNING id, created_at, (SELECT username FROM users WHERE id = comments.user_id);
         """, (post_id, user_id, content, parent_comment_id))
         
         # Retrieve the ID of the newly created comment
-        comment_id = cursor.fetchone()[0]
+        comment_id, created_at, username = cursor.fetchone()
+
+        event_id = new_event_id()
+        notify(cursor, post_id, "comment_created", event_id,
+               comment=comment_event(comment_id, parent_comment_id, content, username, created_at))
         
         # Commit the transaction
         conn.commit()
+        note_write(conn)
+        thread_cache.invalidate(int(post_id))
         
-        return json.dumps({
+        return {
             "message": "Comment created successfully.",
             "comment_id": comment_id,
             "post_id": post_id,
             "user_id": user_id,
             "content": content,
-            "parent_comment_id": parent_comment_id
-        }), 201
+            "parent_comment_id": parent_comment_id,
+            "event_id": event_id
+        }, 201
     
     except Exception as e:
         conn.rollback()
         print(f"Error: {e}")
-        return json.dumps({"error": "Failed to create comment due to server error."}), 500
+        return {"error": "Failed to create comment due to server error."}, 500
 
 
 
-@app.route('/api/posts', methods=['GET'])
-def get_posts():
+# Read routes answer If-None-Match from the version counters alone, without
+# touching the database. ETags also carry a per-process epoch, so a process
+# never confirms an ETag another one issued, the score buffer's flush count,
+# and the ETAG_WINDOW-second window they were issued in, which bounds how long
+# a write handled by another process can go unnoticed. Versions kept in a
+# shared cache mean the same in every process, so there the epoch is the
+# cache's, unless the (per-process) score buffer is on.
+ETAG_EPOCH = uuid.uuid4().hex[:8]
+ETAG_WINDOW = float(os.environ.get("ETAG_WINDOW", 60))
+# Browsers may keep the body but must revalidate before every reuse
+READ_CACHE_CONTROL = "no-cache"
+
+def etag_epoch():
+    if shared_cache_backend is None or score_buffer is not None:
+        return ETAG_EPOCH
+    try:
+        return shared_cache_backend.epoch()
+    except CacheBackendError:
+        # Versions are unique to this process meanwhile
+        return ETAG_EPOCH
+
+def make_etag(*versions):
+    flushes = score_buffer.flushes if score_buffer is not None else 0
+    window = int(time.time() // ETAG_WINDOW)
+    return '"' + "-".join(str(part) for part in (etag_epoch(), *versions, flushes, window)) + '"'
+
+def feed_etag():
+    return make_etag("f", feed_version.value)
+
+def thread_etag(post_id):
+    return make_etag("t", post_id, thread_cache.version(post_id))
+
+def matching_etag(if_none_match, etag):
+    """The tag in If-None-Match that matches etag or one of its compressed
+    variants (the one the client holds, to send back with the 304), or None.
+    If-None-Match uses weak comparison, so a W/ prefix is ignored."""
+    if not if_none_match:
+        return None
+    if if_none_match.strip() == "*":
+        return etag
+    variants = {etag} | {encoded_etag(etag, encoding) for encoding in ENCODINGS}
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.removeprefix("W/") in variants:
+            return tag
+    return None
+
+def cacheable_response(body, etag):
+    # A PrecompressedBody is sent in the client's preferred encoding as it is;
+    # anything else is compressed, if at all, by compress_response
+    if isinstance(body, PrecompressedBody):
+        data, encoding = body.encoded(choose_encoding(request.headers.get("Accept-Encoding")))
+        response = app.response_class(data, status=200, mimetype='application/json')
+        if body.variants:
+            response.vary.add("Accept-Encoding")
+        if encoding is not None:
+            response.content_encoding = encoding
+            etag = encoded_etag(etag, encoding)
+    else:
+        response = json_response(body, 200)
+    if etag is not None:
+        response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = READ_CACHE_CONTROL
+    return response
+
+def not_modified_response(etag):
+    response = app.response_class(status=304)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = READ_CACHE_CONTROL
+    response.vary.add("Accept-Encoding")
+    return response
+
+def render_feed_page(sort, limit):
+    # A first feed page for feed_cache, read from the primary so a lagging
+    # replica never leaves a stale page behind for everybody
     conn = get_db_connection()
     if conn is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
-
+        raise psycopg2.OperationalError("Failed to connect to the database")
     try:
-        posts = get_posts_int(conn)
-        return posts
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        posts = get_posts_int(conn, sort, limit)
     finally:
         release_db_connection(conn)
+    return PrecompressedBody(dumps(posts), COMPRESS_MIN_SIZE) if posts is not None else None
 
-def get_user_id(conn, username):
-    cur = conn.cursor()
-    query = sql.SQL("SELECT id FROM users WHERE username = %s")
-    
+def read_feed_page(sort, limit, cursor):
+    # (body, replica) for a feed page past the first
+    conn, replica = get_read_connection()
+    if conn is None:
+        raise psycopg2.OperationalError("Failed to connect to the database")
     try:
-        cur.execute(query, (username,))
-        result = cur.fetchone()
-
-        if result:
-            return result[0]  # Return the user ID
-        else:
-            return None
-    except:
-        return None
+        posts = get_posts_int(conn, sort, limit, cursor)
     finally:
-        cur.close()
+        release_read_connection(conn, replica)
+    return (dumps(posts) if posts is not None else None), replica
+
+@app.route('/api/posts', methods=['GET'])
+def get_posts():
+    try:
+        sort, limit, cursor = parse_feed_args(request.args)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    # Taken before the query: a write that lands during it moves the version
+    # on, so this ETag can only be too old, never too new
+    etag = feed_etag()
+    matched = matching_etag(request.headers.get("If-None-Match"), etag)
+    if matched:
+        return not_modified_response(matched)
+
+    if ranked_feed is not None:
+        sync_ranked_feed()
+        rows = ranked_feed.page(sort, limit, cursor)
+        if rows is not None:
+            return cacheable_response(feed_page(rows, sort, limit), etag)
+
+    if cursor is None:
+        try:
+            body = feed_cache.get_or_compute(f"{feed_version.value}:{sort}:{limit}",
+                                             lambda: render_feed_page(sort, limit))
+        except Exception as e:
+            return json_response({"error": str(e)}, 500)
+        if body is None:
+            return json_response({"error": "Failed to fetch posts"}, 500)
+        return cacheable_response(body, etag)
+
+    key = (sort, limit, cursor, feed_version.value, request_read_after())
+    try:
+        body, replica = read_flights["feed_page"].do(key, lambda: read_feed_page(sort, limit, cursor))
+    except Exception as e:
+        return json_response({"error": str(e)}, 500)
+    if body is None:
+        return json_response({"error": "Failed to fetch posts"}, 500)
+    # A replica may not have caught up with the version in the ETag yet
+    return cacheable_response(body, etag if replica is None else None)
 
 def get_username(conn, user_id):
     cur = conn.cursor()
@@ -247,50 +944,70 @@ def get_username(conn, user_id):
         cur.close()
 
 
-def create_user(conn, username, password):
-    cur = conn.cursor()
-    # Use RETURNING clause to get the id of the newly inserted user
-    query = sql.SQL("INSERT INTO users (username, password) VALUES (%s, %s) RETURNING id")
+# Creates the user and their first session in one statement. ON CONFLICT
+# makes a taken username yield no row instead of racing a separate existence
+# check; the session insert then has nothing to insert either.
+CREATE_USER_QUERY = """
+    WITH new_user AS (
+        INSERT INTO users (username, password) VALUES (%s, %s)
+        ON CONFLICT (username) DO NOTHING
+        RETURNING id
+    )
+    INSERT INTO sessions (user_id, token)
+    SELECT id, %s FROM new_user
+    RETURNING user_id;
+"""
+
+# Signed tokens need no sessions row, so only the user is inserted
+INSERT_USER_QUERY = """
+    INSERT INTO users (username, password) VALUES (%s, %s)
+    ON CONFLICT (username) DO NOTHING
+    RETURNING id;
+"""
 
+def create_user(conn, username, password_hash):
+    # Returns (user_id, token) for the new user's first session, or None if
+    # the username is taken
+    cur = conn.cursor()
     try:
-        # Execute the insert query and fetch the returned id
-        cur.execute(query, (username, password))
-        user_id = cur.fetchone()[0]  # Fetch the first row and get the id
-        conn.commit()
-        return user_id  # Return the user id
-    except Exception as e:
-        print(f"Error occurred: {e}")
-        return None
+        if signed_tokens is None:
+            token = uuid.uuid4().hex
+            cur.execute(CREATE_USER_QUERY, (username, password_hash, token))
+        else:
+            cur.execute(INSERT_USER_QUERY, (username, password_hash))
+        result = cur.fetchone()
+        if result is None:
+            return None
+        user_id = result[0]
+        return user_id, token if signed_tokens is None else signed_tokens.issue(user_id)
     finally:
         cur.close()
 
-
 def save_user_token(conn, user_id, token):
     cur = conn.cursor()
-    query = sql.SQL("INSERT INTO sessions (user_id, token) VALUES (%s, %s)")
-    
     try:
-        cur.execute(query, (user_id, token,))
-        result = cur.fetchone()
-
-        if result:
-            return result[0]  # Return the user ID
-        else:
-            return None
-    except:
-        return None
+        cur.execute("INSERT INTO sessions (user_id, token) VALUES (%s, %s)", (user_id, token))
     finally:
         cur.close()
 
 def validate_user_token(conn, user_id, token):
+    # user_id arrives from request JSON and may be a string, so compare as text
+    if signed_tokens is not None:
+        token_user_id = signed_tokens.verify(token)
+        return token_user_id is not None and str(token_user_id) == str(user_id)
+
+    cached_user_id = session_cache.get(token)
+    if cached_user_id is not None:
+        return str(cached_user_id) == str(user_id)
+
     cur = conn.cursor()
-    query = sql.SQL("SELECT token FROM sessions WHERE user_id = %s AND token = %s")
 
     try:
-        cur.execute(query, (user_id, token,))
+        statements.execute(cur, "validate_token", validate_token_params(user_id, token))
         result = cur.fetchone()
 
         if result is not None:
+            session_cache.set(token, result[0], ttl=result[1])
             return True  # Token is valid
         else:
             return False  # Token is invalid
@@ -304,7 +1021,17 @@ def delete_user_token(conn, token):
     query = sql.SQL("DELETE FROM sessions WHERE token = %s")
 
     try:
+        if signed_tokens is not None:
+            claims = signed_tokens.parse(token)
+            if claims is None:
+                return False
+            _, expires, token_id = claims
+            cur.execute(REVOKE_TOKEN_QUERY, (token_id, expires))
+            signed_tokens.revoke(token_id, expires)
+            return True
+
         cur.execute(query, (token,))
+        session_cache.delete(token)
         # Optionally return the number of deleted rows to confirm deletion
         deleted_count = cur.rowcount
         return deleted_count > 0  # Returns True if a row was deleted
@@ -314,163 +1041,358 @@ def delete_user_token(conn, token):
     finally:
         cur.close()
 
-def verify_password(conn, username, password):
+def get_user_credentials(conn, username):
+    # Returns (user_id, password_hash), or None for an unknown username
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT password FROM users WHERE username = %s", (username,))
-        result = cursor.fetchone()
-        
-        if result is None:
-            return False
-
-        stored_password_hash = result[0]
-        print(stored_password_hash)
-        return check_password_hash(stored_password_hash, password)
-    except Exception as e:
-        print(f"Error verifying password: {e}")
-        return False
+        cursor.execute("SELECT id, password FROM users WHERE username = %s", (username,))
+        return cursor.fetchone()
     finally:
         cursor.close()
 
+def hasher_busy_response():
+    response = json_response({"error": "Too many logins in progress, try again shortly"}, 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
 def vote_comment(conn, user_id, token, comment_id, vote_type):
     if not validate_user_token(conn, user_id, token):
-        return json.dumps({"error": "Invalid token or user ID."}), 403
+        return {"error": "Invalid token or user ID."}, 403
 
     if vote_type not in ["upvote", "downvote"]:
-        return json.dumps({"error": "Invalid vote type."}), 400
+        return {"error": "Invalid vote type."}, 400
     
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
-
-        # Retrieve existing vote, if any
-        cursor.execute("""
-            SELECT vote_type FROM comment_votes
-            WHERE user_id = %s AND comment_id = %s;
-        """, (user_id, comment_id))
-        existing_vote = cursor.fetchone()
-
-        # Determine score adjustment based on current and new vote
-        score_change = 0
-        if existing_vote:
-            # Delete the existing vote
-            cursor.execute("""
-                DELETE FROM comment_votes
-                WHERE user_id = %s AND comment_id = %s;
-            """, (user_id, comment_id))
-            
-            # Adjust score change based on existing vote
-            if existing_vote[0] == "upvote":
-                score_change = -1  # Removing an upvote
-            else:
-                score_change = 1   # Removing a downvote
-
-            conn.commit()
-
-            if existing_vote[0] == vote_type:
-                cursor.execute("""
-                    UPDATE comments SET score = score + %s
-                    WHERE id = %s;
-                """, (score_change, comment_id))
+        # Record the vote and adjust the score in one statement, see
+        # cast_comment_vote in migrations/0002_votes_and_sessions.sql
+        statements.execute(cursor, "cast_comment_vote",
+                           (user_id, comment_id, vote_type, score_buffer is None, comment_id))
+        score_change, post_id = cursor.fetchone()
 
-                return json.dumps({
-                    "message": f"Comment {vote_type}d successfully.",
-                    "comment_id": comment_id,
-                    "new_score": score_change
-                }), 200
+        event_id = new_event_id()
+        notify(cursor, post_id, "score_changed", event_id, kind="comment", id=int(comment_id), delta=score_change)
 
-        # Insert new vote
-        score_change += 1 if vote_type == "upvote" else -1
-        cursor.execute("""
-            INSERT INTO comment_votes (user_id, comment_id, vote_type)
-            VALUES (%s, %s, %s);
-        """, (user_id, comment_id, vote_type))
-
-        # Update comment score
-        cursor.execute("""
-            UPDATE comments SET score = score + %s
-            WHERE id = %s;
-        """, (score_change, comment_id))
-
-        # Commit the transaction
         conn.commit()
+        note_write(conn)
+        thread_cache.invalidate(post_id)
 
-        return json.dumps({
+        if score_buffer is not None:
+            score_buffer.add("comments", comment_id, score_change)
+
+        return {
             "message": f"Comment {vote_type}d successfully.",
             "comment_id": comment_id,
-            "new_score": score_change
-        }), 200
-    
+            "new_score": score_change,
+            "event_id": event_id
+        }, 200
+
+    except psycopg2.errors.ForeignKeyViolation:
+        conn.rollback()
+        return {"error": "Comment not found."}, 404
     except Exception as e:
         conn.rollback()
         print(f"Error: {e}")
-        return json.dumps({"error": "Failed to process vote due to server error."}), 500
+        return {"error": "Failed to process vote due to server error."}, 500
+    finally:
+        cursor.close()
+
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    stats = {"sessions": session_cache.stats(), "threads": thread_cache.stats(), "feeds": feed_cache.stats(),
+             "coalesced_reads": coalesced_reads(), "session_janitor": session_janitor.stats(),
+             "post_events": post_events.stats()}
+    if ranked_feed is not None:
+        stats["ranked_feed"] = ranked_feed.stats()
+    if score_buffer is not None:
+        stats["vote_buffer"] = score_buffer.stats()
+    if signed_tokens is not None:
+        stats["signed_tokens"] = signed_tokens.stats()
+    return json_response(stats, 200)
+
+@app.route('/api/pool_stats', methods=['GET'])
+def pool_stats():
+    stats = connection_pool.stats()
+    if replica_router is not None:
+        stats["replicas"] = replica_router.stats()
+        for replica, pool in zip(stats["replicas"]["replicas"], replica_pools):
+            replica["pool"] = pool.stats()
+    return json_response(stats, 200)
 
 @app.route('/api/username/<int:user_id>', methods=['GET'])
 def get_username_route(user_id):
-    conn = get_db_connection()
+    conn, replica = get_read_connection()
     if conn is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
+        return json_response({"error": "Failed to connect to the database"}, 500)
 
     try:
         username = get_username(conn, user_id)
         if username:
-            return jsonify({"username": username}), 200
+            # Usernames never change
+            response = json_response({"username": username}, 200)
+            response.headers["Cache-Control"] = "public, max-age=86400"
+            return response
         else:
-            return jsonify({"error": "User ID not found"}), 404
+            return json_response({"error": "User ID not found"}, 404)
     except Exception as e:
-        return jsonify({"error": e}), 404
+        return json_response({"error": str(e)}, 404)
     finally:
-        release_db_connection(conn)
+        release_read_connection(conn, replica)
 
-@app.route('/api/post/<int:post_id>', methods=['GET'])
-def get_post(post_id):
-    conn = get_db_connection()
+# GET /api/usernames?ids=1,2,3 resolves up to USERNAME_BATCH_MAX users at once
+USERNAME_BATCH_MAX = int(os.environ.get("USERNAME_BATCH_MAX", 100))
+
+def parse_user_ids(ids):
+    # "1,2,3" -> [1, 2, 3]; raises ValueError
+    try:
+        user_ids = [int(user_id) for user_id in ids.split(",") if user_id.strip()]
+    except ValueError:
+        raise ValueError("ids must be comma-separated user IDs") from None
+    if not user_ids:
+        raise ValueError("ids must list at least one user ID")
+    if len(user_ids) > USERNAME_BATCH_MAX:
+        raise ValueError(f"At most {USERNAME_BATCH_MAX} user IDs per request")
+    return user_ids
+
+def username_results(user_ids, usernames):
+    # One result per requested ID, in request order
+    return [{"user_id": user_id, "username": usernames[user_id]} if user_id in usernames
+            else {"user_id": user_id, "error": "User ID not found"}
+            for user_id in user_ids]
+
+def get_usernames(conn, user_ids):
+    cur = conn.cursor()
+    try:
+        statements.execute(cur, "usernames", (sorted(set(user_ids)),))
+        return dict(cur.fetchall())
+    finally:
+        cur.close()
+
+@app.route('/api/usernames', methods=['GET'])
+def get_usernames_route():
+    try:
+        user_ids = parse_user_ids(request.args.get("ids", ""))
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    conn, replica = get_read_connection()
     if conn is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
+        return json_response({"error": "Failed to connect to the database"}, 500)
 
     try:
-        json = get_comments_json(conn, post_id)
-        if json:
-            return json, 200
-        else:
-            return jsonify({"error": "Something went wrong"}), 404
+        usernames = get_usernames(conn, user_ids)
+    except Exception as e:
+        return json_response({"error": str(e)}, 500)
+    finally:
+        release_read_connection(conn, replica)
+
+    response = json_response({"results": username_results(user_ids, usernames)}, 200)
+    if len(usernames) == len(set(user_ids)):
+        # Usernames never change, but a missing user may be registered later
+        response.headers["Cache-Control"] = "public, max-age=86400"
+    return response
+
+# GET /api/search?q=...&type=posts|comments: full-text search over the
+# search_vector columns kept by migrations/0005_search.sql, best match first.
+# q is read like a web search box (websearch_to_tsquery): words, "quoted
+# phrases", OR and -excluded words; the statements are in queries.py.
+#
+# Every match is ranked before a page is cut, so words found in much of the
+# corpus cost seconds; such searches are cancelled after SEARCH_TIMEOUT_MS
+# and answered with a 503, instead of holding a pooled connection that long
+SEARCH_TIMEOUT_MS = int(os.environ.get("SEARCH_TIMEOUT_MS", 1000))
+SEARCH_TIMEOUT_ERROR = "Search took too long, try more specific words"
+
+def parse_search_args(args):
+    # Returns (text, search_type, limit, cursor) from the query string or
+    # raises ValueError with a message for the client
+    text = args.get('q', '').strip()
+    if not text:
+        raise ValueError("q must not be empty")
+    if len(text) > MAX_SEARCH_QUERY:
+        raise ValueError(f"q must be at most {MAX_SEARCH_QUERY} characters")
+
+    search_type = args.get('type', SEARCH_TYPES[0])
+    if search_type not in SEARCH_TYPES:
+        raise ValueError(f"Unknown type, expected one of: {', '.join(SEARCH_TYPES)}")
+
+    try:
+        limit = int(args.get('limit', DEFAULT_SEARCH_LIMIT))
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    limit = max(1, min(limit, MAX_SEARCH_LIMIT))
+
+    cursor = args.get('cursor')
+    if cursor:
+        cursor_type, rank, result_id = decode_cursor(cursor, 3)
+        if cursor_type != search_type:
+            raise ValueError("Cursor does not match the requested type")
+        if not isinstance(rank, (int, float)) or not isinstance(result_id, int):
+            raise ValueError("Malformed cursor")
+        cursor = (rank, result_id)
+    return text, search_type, limit, cursor or None
+
+def search_snippet(headline):
+    return html.escape(headline).replace(SNIPPET_START, "<mark>").replace(SNIPPET_STOP, "</mark>")
+
+def search_result(search_type, row):
+    if search_type == "posts":
+        post_id, user_id, username, title, created_at, score, title_headline, snippet = row[:8]
+        return {"id": post_id, "user_id": user_id, "author": username, "title": title,
+                "highlighted_title": search_snippet(title_headline), "snippet": search_snippet(snippet),
+                "created_at": created_at, "score": score}
+    comment_id, post_id, post_title, user_id, username, created_at, score, snippet = row[:8]
+    return {"id": comment_id, "post_id": post_id, "post_title": post_title, "user_id": user_id,
+            "author": username, "snippet": search_snippet(snippet), "created_at": created_at, "score": score}
+
+def search_page(rows, text, search_type, limit):
+    # Up to limit + 1 rows of search_query, as in feed_page
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(search_type, last[-1], last[0])
+    return {"results": [search_result(search_type, row) for row in rows[:limit]], "query": text,
+            "type": search_type, "next_cursor": next_cursor}
+
+def read_search_page(text, search_type, limit, cursor):
+    # (body, replica) for read_flights["search"]
+    conn, replica = get_read_connection()
+    if conn is None:
+        raise psycopg2.OperationalError("Failed to connect to the database")
+    cur = conn.cursor()
+    try:
+        cur.execute(SEARCH_TIMEOUT_QUERY, (str(SEARCH_TIMEOUT_MS),))
+        statements.execute(cur, f"search_{search_type}_after" if cursor else f"search_{search_type}",
+                           (text,) + (cursor or ()) + (limit + 1,))
+        return dumps(search_page(cur.fetchall(), text, search_type, limit)), replica
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        release_read_connection(conn, replica)
+
+@app.route('/api/search', methods=['GET'])
+def search():
+    try:
+        text, search_type, limit, cursor = parse_search_args(request.args)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    try:
+        body, _ = read_flights["search"].do((text, search_type, limit, cursor, request_read_after()),
+                                            lambda: read_search_page(text, search_type, limit, cursor))
+    except psycopg2.errors.QueryCanceled:
+        return json_response({"error": SEARCH_TIMEOUT_ERROR}, 503)
     except Exception as e:
-        return jsonify({"error": e}), 404
+        return json_response({"error": str(e)}, 500)
+    return json_response(body, 200)
+
+def render_thread(post_id):
+    # The first page of a thread for thread_cache, read from the primary for
+    # the same reason as render_feed_page; None if the post does not exist
+    conn = get_db_connection()
+    if conn is None:
+        raise psycopg2.OperationalError("Failed to connect to the database")
+    try:
+        body = get_comments_json(conn, post_id)
     finally:
         release_db_connection(conn)
+    return PrecompressedBody(body, COMPRESS_MIN_SIZE) if body is not None else None
+
+def read_thread_page(post_id, limit, max_depth, thread_cursor):
+    # (body, replica) for any other thread page; body is None if the post
+    # does not exist
+    conn, replica = get_read_connection()
+    if conn is None:
+        raise psycopg2.OperationalError("Failed to connect to the database")
+    try:
+        return get_comments_json(conn, post_id, limit, max_depth, thread_cursor), replica
+    finally:
+        release_read_connection(conn, replica)
+
+@app.route('/api/post/<int:post_id>', methods=['GET'])
+def get_post(post_id):
+    if not is_integer(post_id):
+        return json_response({"error": "Post not found"}, 404)
+    etag = thread_etag(post_id)
+    matched = matching_etag(request.headers.get("If-None-Match"), etag)
+    if matched:
+        return not_modified_response(matched)
+
+    # Only the default first page of a thread is cached; explicit limits,
+    # depths and continuation cursors always go to the database.
+    if not request.args:
+        try:
+            body = thread_cache.get_or_compute(post_id, lambda: render_thread(post_id))
+        except Exception as e:
+            error_log.exception("Failed to read thread %s", post_id)
+            return json_response({"error": str(e)}, 500)
+        if body is None:
+            return json_response({"error": "Post not found"}, 404)
+        return cacheable_response(body, etag)
+
+    try:
+        limit, max_depth, thread_cursor = parse_thread_args(request.args)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    key = (post_id, limit, max_depth, thread_cursor, thread_cache.version(post_id), request_read_after())
+    try:
+        body, replica = read_flights["thread_page"].do(
+            key, lambda: read_thread_page(post_id, limit, max_depth, thread_cursor))
+    except Exception as e:
+        error_log.exception("Failed to read thread %s", post_id)
+        return json_response({"error": str(e)}, 500)
+    if body is None:
+        return json_response({"error": "Post not found"}, 404)
+    return cacheable_response(body, etag if replica is None else None)
+
+@app.route('/api/post/<int:post_id>/events', methods=['GET'])
+def post_events_stream(post_id):
+    # Server-Sent Events: comment_created and score_changed for this post, see
+    # events.py. Each open stream holds a server thread here; the ASGI server
+    # serves the same stream without one.
+    subscription = Subscription(post_events, post_id, EVENTS_QUEUE, EVENTS_HEARTBEAT)
+    response = app.response_class(subscription.frames(), mimetype='text/event-stream')
+    response.headers["Cache-Control"] = "no-cache"
+    # Tell nginx-style proxies not to buffer the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
 @app.route('/api/register', methods=['POST'])
 def register():
     data = request.get_json()
     username = data.get('username')
     password = data.get('password')
-    user_id = 0
     if not username or not password:
-        return jsonify({"error": "Username and password are required"}), 400
+        return json_response({"error": "Username and password are required"}, 400)
+
+    # Hash before taking a connection, so none is held while the KDF runs
+    try:
+        password_hash = password_hasher.hash(password)
+    except HasherBusy:
+        return hasher_busy_response()
 
-    # Check if the user already exists
     conn = get_db_connection()
     if conn is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
+        return json_response({"error": "Failed to connect to the database"}, 500)
 
     try:
-        id = get_user_id(conn, username)
-        if id is not None:
-            return jsonify({"error": "Username already exists"}), 400
-        
-        user_id = create_user(conn, username, generate_password_hash(password))
-        token = uuid.uuid4().hex
-        save_user_token(conn, user_id, token)
-
+        created = create_user(conn, username, password_hash)
         conn.commit()
+        if created is None:
+            return json_response({"error": "Username already exists"}, 400)
+        user_id, token = created
+        note_write(conn)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        conn.rollback()
+        return json_response({"error": str(e)}, 500)
     finally:
         release_db_connection(conn)
 
     # Return the session token in the response
-
-    response = make_response(jsonify({"username": username, "user_id": user_id, "token": token}), 200)
+    response = json_response({"username": username, "user_id": user_id, "token": token})
     response.set_cookie("token", token, domain="127.0.0.1")
     return response
 
@@ -482,33 +1404,50 @@ def login():
     password = data.get('password')
 
     if not username or not password:
-        return jsonify({"error": "Username and password are required"}), 400
+        return json_response({"error": "Username and password are required"}, 400)
 
-    # Check if the user exists and verify the password
+    # Look the user up, then give the connection back before checking the
+    # password so it is not held while the KDF runs
     conn = get_db_connection()
     if conn is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
+        return json_response({"error": "Failed to connect to the database"}, 500)
 
     try:
-        user_id = get_user_id(conn, username)
-        if user_id is None:
-            return jsonify({"error": "Invalid username"}), 401
-        
-        # Assuming you have a function to verify the password
-        if not verify_password(conn, username, password):
-            return jsonify({"error": "Invalid password"}), 401
-        
-        token = uuid.uuid4().hex
-        save_user_token(conn, user_id, token)
-
-        conn.commit()
+        credentials = get_user_credentials(conn, username)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
     finally:
         release_db_connection(conn)
 
+    if credentials is None:
+        return json_response({"error": "Invalid username"}, 401)
+    user_id, stored_password_hash = credentials
+
+    try:
+        if not password_hasher.verify(stored_password_hash, password):
+            return json_response({"error": "Invalid password"}, 401)
+    except HasherBusy:
+        return hasher_busy_response()
+
+    if signed_tokens is not None:
+        token = signed_tokens.issue(user_id)
+    else:
+        conn = get_db_connection()
+        if conn is None:
+            return json_response({"error": "Failed to connect to the database"}, 500)
+
+        try:
+            token = uuid.uuid4().hex
+            save_user_token(conn, user_id, token)
+
+            conn.commit()
+        except Exception as e:
+            return json_response({"error": str(e)}, 500)
+        finally:
+            release_db_connection(conn)
+
     # Return the session token in the response
-    response = make_response(jsonify({"username": username, "user_id": user_id, "token": token}), 200)
+    response = json_response({"username": username, "user_id": user_id, "token": token})
     response.set_cookie("token", token, domain="127.0.0.1")
     return response
 
@@ -517,22 +1456,22 @@ def logout():
     token = request.cookies.get('token')
 
     if not token:
-        return jsonify({"error": "No token provided"}), 400
+        return json_response({"error": "No token provided"}, 400)
 
     conn = get_db_connection()
     if conn is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
+        return json_response({"error": "Failed to connect to the database"}, 500)
 
     try:
         delete_user_token(conn, token)
         conn.commit()
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
     finally:
         release_db_connection(conn)
 
     # Clear the token cookie from the client
-    response = make_response(jsonify({"message": "Logged out successfully"}), 200)
+    response = json_response({"message": "Logged out successfully"})
     response.set_cookie("token", "", expires=0)  # Set cookie to expire
     return response
 
@@ -544,14 +1483,13 @@ def create_comment_route():
     user_id = request.json.get('user_id')
     content = request.json.get('content')
     parent_comment_id = request.json.get('parent_comment_id', None)  # Optional field
-    print("Token:" + str(token) + ", post_id: " + str(post_id) +", user_id: " + str(user_id) + ", content: " + str(content) + ", parent_comment_id: " + str(parent_comment_id))
     # Ensure all required data is present
     if not token or not post_id or not user_id or not content:
-        return jsonify({"error": "Missing required fields"}), 400
+        return json_response({"error": "Missing required fields"}, 400)
 
     conn = get_db_connection()
     if conn is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
+        return json_response({"error": "Failed to connect to the database"}, 500)
 
     try:
         result, status_code = create_comment(conn, user_id, token, post_id, content, parent_comment_id)
@@ -559,12 +1497,12 @@ def create_comment_route():
         conn.commit()
         
         # Return the result as a JSON response
-        return jsonify(json.loads(result)), status_code
+        return json_response(result, status_code)
     
     except Exception as e:
         print(str(e))
         conn.rollback()  # Rollback in case of error
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
     finally:
         release_db_connection(conn)
 
@@ -576,29 +1514,26 @@ def vote_comment_route():
     user_id = request.json.get('user_id')
     vote_type = request.json.get('vote_type')
     
-    print("Token:" + str(token) + ", comment_id: " + str(comment_id) +", user_id: " + str(user_id) + ", vote_type: " + str(vote_type))
-    
     if not token or not comment_id or not user_id or not vote_type:
-        return jsonify({"error": "Missing required fields"}), 400
+        return json_response({"error": "Missing required fields"}, 400)
 
     conn = get_db_connection()
     if conn is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
+        return json_response({"error": "Failed to connect to the database"}, 500)
 
     try:
-        print(1)
         # Call the `create_comment` function to insert the comment
         result, status_code = vote_comment(conn, user_id, token, comment_id, vote_type)
         # Commit the transaction
         conn.commit()
         
         # Return the result as a JSON response
-        return jsonify(json.loads(result)), status_code
+        return json_response(result, status_code)
     
     except Exception as e:
         print(str(e))
         conn.rollback()  # Rollback in case of error
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
     finally:
         release_db_connection(conn)
 
@@ -613,107 +1548,71 @@ def create_post_endpoint():
     title = data.get("title")
     content = data.get("content")
     
-    print("Token:" + str(token) + ", user_id: " + str(user_id) +", content: " + str(content) + ", title: " + str(title))
-    
     if not token or not title or not user_id:
-        return jsonify({"error": "Missing required fields"}), 400
+        return json_response({"error": "Missing required fields"}, 400)
 
     conn = get_db_connection()
     if conn is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
+        return json_response({"error": "Failed to connect to the database"}, 500)
 
     try:
-        print(1)
         if not validate_user_token(conn, user_id, token):
-            return json.dumps({"error": "Invalid token or user ID."}), 403
+            return json_response({"error": "Invalid token or user ID."}, 403)
     
-        # Call the `create_comment` function to insert the comment
-        result, status_code = create_post(conn, user_id, title, content)
-        # Commit the transaction
-        conn.commit()
-        
-        # Return the result as a JSON response
-        return jsonify(json.loads(result)), status_code
+        post_id = create_post(conn, user_id, title, content)
+        if post_id is None:
+            return json_response({"error": "Failed to create post due to server error."}, 500)
+
+        return json_response({"message": "Post created successfully.", "post_id": post_id}, 201)
     
     except Exception as e:
         print(str(e))
         conn.rollback()  # Rollback in case of error
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
     finally:
         release_db_connection(conn)
 
 def vote_post(conn, user_id, token, post_id, vote_type):
     if not validate_user_token(conn, user_id, token):
-        return json.dumps({"error": "Invalid token or user ID."}), 403
+        return {"error": "Invalid token or user ID."}, 403
 
     if vote_type not in ["upvote", "downvote"]:
-        return json.dumps({"error": "Invalid vote type."}), 400
+        return {"error": "Invalid vote type."}, 400
     
+    cursor = conn.cursor()
     try:
-        cursor = conn.cursor()
+        # Record the vote and adjust the score in one statement, see
+        # cast_post_vote in migrations/0002_votes_and_sessions.sql
+        statements.execute(cursor, "cast_post_vote", (user_id, post_id, vote_type, score_buffer is None))
+        score_change = cursor.fetchone()[0]
 
-        # Retrieve existing vote, if any
-        cursor.execute("""
-            SELECT vote_type FROM post_votes
-            WHERE user_id = %s AND post_id = %s;
-        """, (user_id, post_id))
-        existing_vote = cursor.fetchone()
-
-        # Determine score adjustment based on current and new vote
-        score_change = 0
-        if existing_vote:
-            # Delete the existing vote
-            cursor.execute("""
-                DELETE FROM post_votes
-                WHERE user_id = %s AND post_id = %s;
-            """, (user_id, post_id))
-            
-            # Adjust score change based on existing vote
-            if existing_vote[0] == "upvote":
-                score_change = -1  # Removing an upvote
-            else:
-                score_change = 1   # Removing a downvote
-
-            conn.commit()
-
-            if existing_vote[0] == vote_type:
-                cursor.execute("""
-                    UPDATE posts SET score = score + %s
-                    WHERE id = %s;
-                """, (score_change, post_id))
+        event_id = new_event_id()
+        notify(cursor, post_id, "score_changed", event_id, kind="post", id=int(post_id), delta=score_change)
 
-                return json.dumps({
-                    "message": f"Post {vote_type}d successfully.",
-                    "post_id": post_id,
-                    "new_score": score_change
-                }), 200
-
-        # Insert new vote
-        score_change += 1 if vote_type == "upvote" else -1
-        cursor.execute("""
-            INSERT INTO post_votes (user_id, post_id, vote_type)
-            VALUES (%s, %s, %s);
-        """, (user_id, post_id, vote_type))
-
-        # Update post score
-        cursor.execute("""
-            UPDATE posts SET score = score + %s
-            WHERE id = %s;
-        """, (score_change, post_id))
-
-        # Commit the transaction
         conn.commit()
+        note_write(conn)
+        thread_cache.invalidate(int(post_id))
+        feed_version.bump()
 
-        return json.dumps({
+        if score_buffer is not None:
+            score_buffer.add("posts", post_id, score_change)
+
+        return {
             "message": f"Post {vote_type}d successfully.",
             "post_id": post_id,
-            "new_score": score_change
-        }), 200
-    
+            "new_score": score_change,
+            "event_id": event_id
+        }, 200
+
+    except psycopg2.errors.ForeignKeyViolation:
+        conn.rollback()
+        return {"error": "Post not found."}, 404
     except Exception as e:
         conn.rollback()
         print(f"Error: {e}")
-        return json.dumps({"error": "Failed to process vote due to server error."}), 500
+        return {"error": "Failed to process vote due to server error."}, 500
+    finally:
+        cursor.close()
 
 @app.route('/api/post_vote', methods=['POST'])
 def vote_post_route():
@@ -722,30 +1621,180 @@ def vote_post_route():
     user_id = request.json.get('user_id')
     vote_type = request.json.get('vote_type')
     
-    print("Token:" + str(token) + ", post_id: " + str(post_id) +", user_id: " + str(user_id) + ", vote_type: " + str(vote_type))
-    
     if not token or not post_id or not user_id or not vote_type:
-        return jsonify({"error": "Missing required fields"}), 400
+        return json_response({"error": "Missing required fields"}, 400)
 
     conn = get_db_connection()
     if conn is None:
-        return jsonify({"error": "Failed to connect to the database"}), 500
+        return json_response({"error": "Failed to connect to the database"}, 500)
 
     try:
-        print(1)
         result, status_code = vote_post(conn, user_id, token, post_id, vote_type)
         conn.commit()
 
-        return jsonify(json.loads(result)), status_code
+        return json_response(result, status_code)
     
     except Exception as e:
         print(str(e))
         conn.rollback()
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
+    finally:
+        release_db_connection(conn)
+
+
+# POST /api/votes applies up to VOTE_BATCH_MAX post and comment votes, such
+# as ones a client queued while offline, in one transaction with one
+# statement per kind instead of a request and a transaction per vote
+VOTE_BATCH_MAX = int(os.environ.get("VOTE_BATCH_MAX", 100))
+
+# Missing posts and comments drop out of the join and are reported per vote.
+# Rows are voted on in id order so concurrent batches lock them in the same
+# order, as in score_buffer.py.
+BATCH_VOTE_QUERIES = {
+    "post": """
+        SELECT v.id, cast_post_vote(v.user_id, v.id, v.vote_type, v.apply_score), v.id
+        FROM (VALUES %s) AS v(id, user_id, vote_type, apply_score)
+        JOIN posts ON posts.id = v.id
+        ORDER BY v.id
+    """,
+    "comment": """
+        SELECT v.id, cast_comment_vote(v.user_id, v.id, v.vote_type, v.apply_score), comments.post_id
+        FROM (VALUES %s) AS v(id, user_id, vote_type, apply_score)
+        JOIN comments ON comments.id = v.id
+        ORDER BY v.id
+    """,
+}
+BATCH_VOTE_TEMPLATE = "(%s::INTEGER, %s::INTEGER, %s::VARCHAR, %s::BOOLEAN)"
+
+def parse_vote_batch(votes):
+    """Checks the votes of a /api/votes request, each
+    {"kind": "post" | "comment", "id": ..., "vote_type": "upvote" | "downvote"}.
+
+    Returns (results, pending): results has an error result at the index of
+    every rejected vote and None elsewhere, pending maps each kind to
+    {item id: (index, vote_type)} for the votes to apply. Raises ValueError
+    when the batch as a whole is unusable.
+    """
+    if not isinstance(votes, list) or not votes:
+        raise ValueError("votes must be a non-empty list")
+    if len(votes) > VOTE_BATCH_MAX:
+        raise ValueError(f"At most {VOTE_BATCH_MAX} votes per batch")
+
+    results = [None] * len(votes)
+    pending = {kind: {} for kind in BATCH_VOTE_QUERIES}
+    for index, vote in enumerate(votes):
+        vote = vote if isinstance(vote, dict) else {}
+        kind, vote_type = vote.get("kind"), vote.get("vote_type")
+        try:
+            item_id = int(vote.get("id"))
+        except (TypeError, ValueError):
+            item_id = None
+
+        error = None
+        if kind not in BATCH_VOTE_QUERIES:
+            error = "Invalid vote kind."
+        elif item_id is None:
+            error = "Invalid id."
+        elif vote_type not in ["upvote", "downvote"]:
+            error = "Invalid vote type."
+        elif item_id in pending[kind]:
+            # Two votes on one item toggle each other; send them separately
+            error = "Duplicate vote in batch."
+        if error is not None:
+            results[index] = {"kind": kind, "id": vote.get("id"), "status": 400, "error": error}
+        else:
+            pending[kind][item_id] = (index, vote_type)
+    return results, pending
+
+def vote_batch_result(kind, item_id, score_change=None, event_id=None):
+    # A vote that was applied, or not found when score_change is None
+    if score_change is None:
+        return {"kind": kind, "id": item_id, "status": 404, "error": f"{kind.capitalize()} not found."}
+    return {"kind": kind, "id": item_id, "status": 200, "new_score": score_change, "event_id": event_id}
+
+def cast_votes(conn, user_id, token, votes):
+    try:
+        results, pending = parse_vote_batch(votes)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+
+    if not validate_user_token(conn, user_id, token):
+        return {"error": "Invalid token or user ID."}, 403
+
+    cursor = conn.cursor()
+    try:
+        applied = []  # (kind, item id, score change, post id)
+        payloads = []
+        for kind, items in pending.items():
+            if not items:
+                continue
+            rows = execute_values(
+                cursor,
+                BATCH_VOTE_QUERIES[kind],
+                [(item_id, user_id, vote_type, score_buffer is None) for item_id, (_, vote_type) in items.items()],
+                template=BATCH_VOTE_TEMPLATE,
+                page_size=len(items),
+                fetch=True,
+            )
+            found = set()
+            for item_id, score_change, post_id in rows:
+                event_id = new_event_id()
+                payloads.append(event_payload(post_id, "score_changed", event_id, kind=kind, id=item_id,
+                                              delta=score_change))
+                results[items[item_id][0]] = vote_batch_result(kind, item_id, score_change, event_id)
+                applied.append((kind, item_id, score_change, post_id))
+                found.add(item_id)
+            for item_id, (index, _) in items.items():
+                if item_id not in found:
+                    results[index] = vote_batch_result(kind, item_id)
+
+        if payloads:
+            notify_many(cursor, payloads)
+        conn.commit()
+        if applied:
+            note_write(conn)
+    except Exception as e:
+        conn.rollback()
+        print(f"Error: {e}")
+        return {"error": "Failed to process votes due to server error."}, 500
+    finally:
+        cursor.close()
+
+    for kind, item_id, score_change, post_id in applied:
+        thread_cache.invalidate(post_id)
+        if score_buffer is not None:
+            score_buffer.add(f"{kind}s", item_id, score_change)
+    if any(kind == "post" for kind, _, _, _ in applied):
+        feed_version.bump()
+
+    return {"results": results}, 200
+
+@app.route('/api/votes', methods=['POST'])
+def cast_votes_route():
+    token = request.json.get('token')
+    user_id = request.json.get('user_id')
+    votes = request.json.get('votes')
+
+    if not token or not user_id or votes is None:
+        return json_response({"error": "Missing required fields"}, 400)
+
+    conn = get_db_connection()
+    if conn is None:
+        return json_response({"error": "Failed to connect to the database"}, 500)
+
+    try:
+        result, status_code = cast_votes(conn, user_id, token, votes)
+        return json_response(result, status_code)
+    except Exception as e:
+        print(str(e))
+        conn.rollback()
+        return json_response({"error": str(e)}, 500)
     finally:
         release_db_connection(conn)
 
 
 if __name__ == '__main__':
+    # Exit normally on SIGTERM so atexit handlers (the score buffer flush) run
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(debug=True)
 
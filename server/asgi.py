@@ -0,0 +1,888 @@
+"""Asyncio serving mode.
+
+Serves the same /api/* routes as app.py from an ASGI application backed by an
+async Postgres pool, so one process can keep thousands of slow clients open
+while only ASYNC_POOL_MAX of them hold a database connection at a time.
+Queries, pagination, caches and response encoding are shared with app.py.
+
+    uvicorn asgi:app --port 5000
+
+Requires starlette, psycopg (3) and psycopg_pool in addition to the Flask
+server's dependencies.
+"""
+import os
+import uuid
+from contextlib import asynccontextmanager
+
+import psycopg
+import psycopg.errors
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+from app import (
+    CREATE_USER_QUERY,
+    INSERT_USER_QUERY,
+    signed_tokens,
+    password_hasher,
+    request_metrics,
+    session_cache,
+    thread_cache,
+    feed_cache,
+    score_buffer,
+    feed_version,
+    read_flights,
+    coalesced_reads,
+    feed_etag,
+    thread_etag,
+    matching_etag,
+    READ_CACHE_CONTROL,
+    COMPRESS_MIN_SIZE,
+    post_events,
+    EVENTS_QUEUE,
+    EVENTS_HEARTBEAT,
+    comment_event,
+    ranked_feed,
+    feed_post,
+    replica_router,
+    replica_configs,
+    READ_AFTER_COOKIE_AGE,
+    parse_user_ids,
+    username_results,
+    parse_vote_batch,
+    vote_batch_result,
+    parse_feed_args,
+    parse_search_args,
+    search_page,
+    SEARCH_TIMEOUT_MS,
+    SEARCH_TIMEOUT_ERROR,
+    feed_page,
+    is_integer,
+    parse_thread_args,
+    ThreadBuilder,
+)
+from cache import AsyncSingleFlight
+from compression import PrecompressedBody, choose_encoding, compress, encoded_etag, should_compress
+from events import AsyncSubscription, NOTIFY_QUERY, NOTIFY_MANY_QUERY, event_payload, new_event_id
+from hashing import HasherBusy
+from metrics import error_log
+from queries import (
+    db_config,
+    validate_token_params,
+    statements,
+    FEED_SORTS,
+    FEED_SNAPSHOT_QUERIES,
+    SEARCH_TIMEOUT_QUERY,
+    feed_query,
+    THREAD_POST_QUERY,
+    thread_first_level_query,
+    thread_first_level_params,
+    THREAD_REPLIES_QUERY,
+    thread_replies_params,
+)
+from ranked_feed import Snapshot
+from replicas import WRITE_POSITION_QUERY, parse_lsn
+from serialization import dumps
+from sessions import REVOKE_TOKEN_QUERY
+
+db_pool = AsyncConnectionPool(
+    kwargs={key: value for key, value in db_config.items() if value is not None},
+    min_size=int(os.environ.get("ASYNC_POOL_MIN", 1)),
+    max_size=int(os.environ.get("ASYNC_POOL_MAX", 20)),
+    open=False,
+)
+
+# One pool per DB_REPLICAS entry; app.py's replica_router picks among them
+replica_pools = [
+    AsyncConnectionPool(
+        kwargs={key: value for key, value in config.items() if value is not None},
+        min_size=int(os.environ.get("ASYNC_POOL_MIN", 1)),
+        max_size=int(os.environ.get("ASYNC_POOL_MAX", 20)),
+        timeout=float(os.environ.get("POOL_TIMEOUT", 10)),
+        open=False,
+    )
+    for config in replica_configs
+]
+
+# Concurrent identical reads share one, as in app.py, under the same names so
+# that app.py's coalesced_reads() reports these. Thread pages include the
+# cached first page here: its renders are coroutines, which the cache's own
+# single-flight cannot run.
+read_flights.update(thread_page=AsyncSingleFlight(), feed_page=AsyncSingleFlight(), search=AsyncSingleFlight())
+
+@asynccontextmanager
+async def primary_connection():
+    async with db_pool.connection() as conn:
+        yield conn, None
+
+def request_read_after(request):
+    return parse_lsn(request.headers.get("x-read-after") or request.cookies.get("read_after"))
+
+@asynccontextmanager
+async def read_connection(request):
+    # Yields (conn, replica) like app.py's get_read_connection, with replica
+    # None for the primary
+    if replica_router is not None:
+        replica = replica_router.choose(request_read_after(request))
+        if replica is not None:
+            connected = False
+            try:
+                async with replica_pools[replica].connection() as conn:
+                    connected = True
+                    yield conn, replica
+                return
+            except PoolTimeout as e:
+                if connected:
+                    raise
+                print(f"Error: Could not get a replica connection, reading from the primary. Details: {e}")
+                replica_router.mark_failed(replica)
+    async with primary_connection() as (conn, replica):
+        yield conn, replica
+
+async def write_position(conn):
+    # The primary's WAL position after a commit on conn, see app.py's note_write
+    if replica_router is None:
+        return None
+    cur = await conn.execute(WRITE_POSITION_QUERY)
+    return (await cur.fetchone())[0]
+
+def send_read_after(response, read_after):
+    if read_after is not None:
+        response.headers["X-Read-After"] = read_after
+        response.set_cookie("read_after", read_after, max_age=READ_AFTER_COOKIE_AGE, samesite="lax")
+    return response
+
+async def cache_call(fn, *args):
+    # With CACHE_URL a cache call is a round trip to Redis, or a socket
+    # timeout while it is down; either way, not something to run on the loop
+    if not thread_cache.backend.shared:
+        return fn(*args)
+    return await run_in_threadpool(fn, *args)
+
+def json_response(payload, status=200, headers=None):
+    body = payload if isinstance(payload, bytes) else dumps(payload)
+    return Response(body, status_code=status, headers=headers, media_type='application/json')
+
+def cache_headers(etag):
+    # etag is None for responses read from a replica
+    if etag is None:
+        return {"Cache-Control": READ_CACHE_CONTROL}
+    return {"ETag": etag, "Cache-Control": READ_CACHE_CONTROL}
+
+def not_modified_response(etag):
+    return Response(status_code=304, headers={**cache_headers(etag), "Vary": "Accept-Encoding"})
+
+def cacheable_response(request, body, etag):
+    # As in app.py: a PrecompressedBody goes out in the preferred encoding,
+    # anything else is left to CompressionMiddleware
+    if not isinstance(body, PrecompressedBody):
+        return json_response(body, headers=cache_headers(etag))
+    data, encoding = body.encoded(choose_encoding(request.headers.get("accept-encoding")))
+    headers = cache_headers(encoded_etag(etag, encoding))
+    if body.variants:
+        headers["Vary"] = "Accept-Encoding"
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return json_response(data, headers=headers)
+
+async def read_json(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def parse_id(value):
+    # Ids arrive from request JSON as numbers or numeric strings; raises
+    # ValueError for anything that cannot be a row id, so the caller answers
+    # 400 instead of the query failing
+    try:
+        value = int(value) if isinstance(value, str) else value
+    except ValueError:
+        raise ValueError("Malformed id") from None
+    if not is_integer(value):
+        raise ValueError("Malformed id")
+    return value
+
+async def validate_user_token(conn, user_id, token):
+    # user_id arrives from request JSON and may be a string, so compare as text
+    if signed_tokens is not None:
+        token_user_id = signed_tokens.verify(token)
+        return token_user_id is not None and str(token_user_id) == str(user_id)
+
+    cached_user_id = await cache_call(session_cache.get, token)
+    if cached_user_id is not None:
+        return str(cached_user_id) == str(user_id)
+
+    cur = await conn.execute(statements.query("validate_token"), validate_token_params(user_id, token))
+    result = await cur.fetchone()
+    if result is None:
+        return False
+    await cache_call(session_cache.set, token, result[0], result[1])
+    return True
+
+class MetricsMiddleware:
+    """Feeds request latency and serialization time into app.py's
+    request_metrics. Queries through the async pool are not timed."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        request_metrics.begin(scope["method"], "unmatched")
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            request_metrics.finish(status, getattr(route, "path", "unmatched"))
+
+class CompressionMiddleware:
+    """Compresses single-message responses the way app.py's compress_response
+    does. Responses that already carry a Content-Encoding, such as cached
+    threads, and streamed responses pass through untouched."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding"))
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # Held back until the body shows whether to compress
+                start = message
+                return
+            if start is not None and message["type"] == "http.response.body":
+                headers = MutableHeaders(scope=start)
+                body = message.get("body", b"")
+                if not message.get("more_body") and should_compress(
+                        start["status"], headers.get("content-type"), headers.get("content-encoding"),
+                        len(body), COMPRESS_MIN_SIZE):
+                    if "accept-encoding" not in headers.get("vary", "").lower():
+                        headers.add_vary_header("Accept-Encoding")
+                    if encoding is not None:
+                        body = compress(body, encoding)
+                        headers["Content-Encoding"] = encoding
+                        headers["Content-Length"] = str(len(body))
+                        if "etag" in headers:
+                            headers["ETag"] = encoded_etag(headers["etag"], encoding)
+                        message = {**message, "body": body}
+                await send(start)
+                start = None
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+async def metrics_endpoint(request):
+    return Response(request_metrics.render(), media_type='text/plain; version=0.0.4')
+
+async def hello_world(request):
+    return json_response({"message": "Hello from Flask!"})
+
+async def sync_ranked_feed():
+    # As app.py's sync_ranked_feed, over the async pool
+    reload = ranked_feed.begin_reload()
+    pending = ranked_feed.take_pending()
+    if not reload and not pending:
+        return
+
+    async with db_pool.connection() as conn:
+        try:
+            if reload and score_buffer is not None:
+                await run_in_threadpool(score_buffer.flush)
+            for query in FEED_SNAPSHOT_QUERIES:
+                cur = await conn.execute(query)
+            snapshot = Snapshot((await cur.fetchone())[0])
+            if reload:
+                rows = {}
+                for sort in FEED_SORTS:
+                    cur = await conn.execute(feed_query(sort, False), (ranked_feed.size,))
+                    rows[sort] = await cur.fetchall()
+        except BaseException:
+            if reload:
+                ranked_feed.abort_reload()
+            raise
+        if reload:
+            ranked_feed.finish_reload(rows, snapshot)
+
+        if pending:
+            cur = await conn.execute(statements.query("feed_posts"), (list(pending),))
+            for row in await cur.fetchall():
+                ranked_feed.add_post(tuple(row), snapshot)
+
+async def get_posts(request):
+    try:
+        sort, limit, cursor = parse_feed_args(request.query_params)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    # Taken before the query, as in app.py
+    etag = await cache_call(feed_etag)
+    matched = matching_etag(request.headers.get("if-none-match"), etag)
+    if matched:
+        return not_modified_response(matched)
+
+    if ranked_feed is not None:
+        await sync_ranked_feed()
+        rows = ranked_feed.page(sort, limit, cursor)
+        if rows is not None:
+            return json_response(feed_page(rows, sort, limit), headers=cache_headers(etag))
+
+    if cursor is None:
+        # First pages are shared through feed_cache and filled from the
+        # primary, as in app.py
+        key = f"{await cache_call(lambda: feed_version.value)}:{sort}:{limit}"
+        body = await cache_call(feed_cache.get, key)
+        if body is None:
+            try:
+                body = await read_flights["feed_page"].do(key, lambda: fill_feed_page(key, sort, limit))
+            except psycopg.Error as e:
+                print(f"Error fetching posts: {e}")
+                return json_response({"error": "Failed to fetch posts"}, 500)
+        return cacheable_response(request, body, etag)
+
+    key = (sort, limit, cursor, await cache_call(lambda: feed_version.value), request_read_after(request))
+    try:
+        body, replica = await read_flights["feed_page"].do(
+            key, lambda: read_feed_page(request, sort, limit, cursor))
+    except psycopg.Error as e:
+        print(f"Error fetching posts: {e}")
+        return json_response({"error": "Failed to fetch posts"}, 500)
+    return json_response(body, headers=cache_headers(etag if replica is None else None))
+
+async def fill_feed_page(key, sort, limit):
+    async with primary_connection() as (conn, _):
+        cur = await conn.execute(feed_query(sort, False), (limit + 1,))
+        rows = await cur.fetchall()
+    body = PrecompressedBody(dumps(feed_page(rows, sort, limit)), COMPRESS_MIN_SIZE)
+    await cache_call(feed_cache.set, key, body)
+    return body
+
+async def read_feed_page(request, sort, limit, cursor):
+    # (body, replica) for a feed page past the first
+    async with read_connection(request) as (conn, replica):
+        cur = await conn.execute(feed_query(sort, True), cursor + (limit + 1,))
+        rows = await cur.fetchall()
+    return dumps(feed_page(rows, sort, limit)), replica
+
+async def get_post(request):
+    post_id = request.path_params['post_id']
+    if not is_integer(post_id):
+        return json_response({"error": "Post not found"}, 404)
+    etag = await cache_call(thread_etag, post_id)
+    matched = matching_etag(request.headers.get("if-none-match"), etag)
+    if matched:
+        return not_modified_response(matched)
+
+    # Only the default first page of a thread is cached, as in app.py
+    cacheable = not request.query_params
+    if cacheable:
+        body = await cache_call(thread_cache.get, post_id)
+        if body is not None:
+            return cacheable_response(request, body, etag)
+
+    try:
+        limit, max_depth, thread_cursor = parse_thread_args(request.query_params)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    ticket = await cache_call(thread_cache.begin, post_id)
+    key = (post_id, limit, max_depth, thread_cursor, ticket, cacheable,
+           None if cacheable else request_read_after(request))
+    try:
+        body, replica = await read_flights["thread_page"].do(
+            key, lambda: read_thread_page(request, post_id, cacheable, ticket, limit, max_depth, thread_cursor))
+    except psycopg.Error as e:
+        error_log.exception("Failed to read thread %s", post_id)
+        return json_response({"error": str(e)}, 500)
+    if body is None:
+        return json_response({"error": "Post not found"}, 404)
+    return cacheable_response(request, body, etag if replica is None else None)
+
+async def read_thread_page(request, post_id, cacheable, ticket, limit, max_depth, thread_cursor):
+    # (body, replica) for get_post; body is None if the post does not exist
+    parent_id, after_id = thread_cursor if thread_cursor is not None else (None, 0)
+    builder = ThreadBuilder(post_id, limit, max_depth, parent_id, after_id)
+
+    # Cache fills read the primary, as in app.py
+    async with (primary_connection() if cacheable else read_connection(request)) as (conn, replica):
+        cur = await conn.execute(THREAD_POST_QUERY, (post_id,))
+        post = await cur.fetchone()
+        if post is None:
+            return None, replica
+
+        cur = await conn.execute(thread_first_level_query(parent_id),
+                                 thread_first_level_params(post_id, parent_id, after_id, limit))
+        parents = builder.add_level(await cur.fetchall())
+        while parents:
+            cur = await conn.execute(THREAD_REPLIES_QUERY, thread_replies_params(post_id, parents, builder.budget))
+            parents = builder.add_level(await cur.fetchall())
+
+    body = dumps(builder.result(post))
+    if cacheable:
+        body = PrecompressedBody(body, COMPRESS_MIN_SIZE)
+        await cache_call(thread_cache.set, post_id, body, ticket)
+    return body, replica
+
+async def post_events_stream(request):
+    # See app.py's post_events_stream; here an open stream costs a coroutine
+    subscription = AsyncSubscription(post_events, request.path_params['post_id'], EVENTS_QUEUE, EVENTS_HEARTBEAT)
+    return StreamingResponse(subscription.frames(), media_type='text/event-stream',
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def get_username(request):
+    user_id = request.path_params['user_id']
+    if not is_integer(user_id):
+        return json_response({"error": "User ID not found"}, 404)
+    try:
+        async with read_connection(request) as (conn, _):
+            cur = await conn.execute("SELECT username FROM users WHERE id = %s", (user_id,))
+            result = await cur.fetchone()
+    except psycopg.Error as e:
+        return json_response({"error": str(e)}, 500)
+    if result is None:
+        return json_response({"error": "User ID not found"}, 404)
+    # Usernames never change
+    return json_response({"username": result[0]}, headers={"Cache-Control": "public, max-age=86400"})
+
+async def get_usernames(request):
+    try:
+        user_ids = parse_user_ids(request.query_params.get("ids", ""))
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    async with read_connection(request) as (conn, _):
+        cur = await conn.execute(statements.query("usernames"), (sorted(set(user_ids)),))
+        usernames = dict(await cur.fetchall())
+    headers = None
+    if len(usernames) == len(set(user_ids)):
+        headers = {"Cache-Control": "public, max-age=86400"}
+    return json_response({"results": username_results(user_ids, usernames)}, headers=headers)
+
+async def search(request):
+    try:
+        text, search_type, limit, cursor = parse_search_args(request.query_params)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    key = (text, search_type, limit, cursor, request_read_after(request))
+    try:
+        body = await read_flights["search"].do(
+            key, lambda: read_search_page(request, text, search_type, limit, cursor))
+    except psycopg.errors.QueryCanceled:
+        return json_response({"error": SEARCH_TIMEOUT_ERROR}, 503)
+    return json_response(body)
+
+async def read_search_page(request, text, search_type, limit, cursor):
+    query = statements.query(f"search_{search_type}_after" if cursor else f"search_{search_type}")
+    async with read_connection(request) as (conn, _):
+        await conn.execute(SEARCH_TIMEOUT_QUERY, (str(SEARCH_TIMEOUT_MS),))
+        cur = await conn.execute(query, (text,) + (cursor or ()) + (limit + 1,))
+        rows = await cur.fetchall()
+    return dumps(search_page(rows, text, search_type, limit))
+
+async def cache_stats(request):
+    stats = await cache_call(lambda: {"sessions": session_cache.stats(), "threads": thread_cache.stats(),
+                                      "feeds": feed_cache.stats()})
+    stats["coalesced_reads"] = coalesced_reads()
+    if ranked_feed is not None:
+        stats["ranked_feed"] = ranked_feed.stats()
+    if score_buffer is not None:
+        stats["vote_buffer"] = score_buffer.stats()
+    return json_response(stats)
+
+async def pool_stats(request):
+    # Shaped like app.py's pool_stats, with psycopg_pool's own counters for
+    # each pool (get_stats()) in place of db_pool.py's
+    stats = db_pool.get_stats()
+    if replica_router is not None:
+        stats["replicas"] = replica_router.stats()
+        for replica, pool in zip(stats["replicas"]["replicas"], replica_pools):
+            replica["pool"] = pool.get_stats()
+    return json_response(stats)
+
+def session_response(username, user_id, token):
+    response = json_response({"username": username, "user_id": user_id, "token": token})
+    response.set_cookie("token", token, domain="127.0.0.1")
+    return response
+
+def hasher_busy_response():
+    return json_response({"error": "Too many logins in progress, try again shortly"}, 503,
+                         headers={"Retry-After": "1"})
+
+async def register(request):
+    data = await read_json(request)
+    username = data.get('username')
+    password = data.get('password')
+    if not username or not password:
+        return json_response({"error": "Username and password are required"}, 400)
+
+    # Hashing is deliberately slow; it runs in app.py's hasher processes
+    try:
+        password_hash = await password_hasher.hash_async(password)
+    except HasherBusy:
+        return hasher_busy_response()
+    token = uuid.uuid4().hex
+
+    async with db_pool.connection() as conn:
+        if signed_tokens is None:
+            cur = await conn.execute(CREATE_USER_QUERY, (username, password_hash, token))
+        else:
+            cur = await conn.execute(INSERT_USER_QUERY, (username, password_hash))
+        result = await cur.fetchone()
+        await conn.commit()
+        read_after = await write_position(conn)
+    if result is None:
+        return json_response({"error": "Username already exists"}, 400)
+    user_id = result[0]
+    if signed_tokens is not None:
+        token = signed_tokens.issue(user_id)
+
+    return send_read_after(session_response(username, user_id, token), read_after)
+
+async def login(request):
+    data = await read_json(request)
+    username = data.get('username')
+    password = data.get('password')
+    if not username or not password:
+        return json_response({"error": "Username and password are required"}, 400)
+
+    async with db_pool.connection() as conn:
+        cur = await conn.execute("SELECT id, password FROM users WHERE username = %s", (username,))
+        result = await cur.fetchone()
+    if result is None:
+        return json_response({"error": "Invalid username"}, 401)
+
+    user_id, stored_password_hash = result
+    try:
+        if not await password_hasher.verify_async(stored_password_hash, password):
+            return json_response({"error": "Invalid password"}, 401)
+    except HasherBusy:
+        return hasher_busy_response()
+
+    if signed_tokens is not None:
+        return session_response(username, user_id, signed_tokens.issue(user_id))
+
+    token = uuid.uuid4().hex
+    async with db_pool.connection() as conn:
+        await conn.execute("INSERT INTO sessions (user_id, token) VALUES (%s, %s)", (user_id, token))
+        await conn.commit()
+
+    return session_response(username, user_id, token)
+
+async def logout(request):
+    token = request.cookies.get('token')
+    if not token:
+        return json_response({"error": "No token provided"}, 400)
+
+    if signed_tokens is not None:
+        claims = signed_tokens.parse(token)
+        if claims is not None:
+            _, expires, token_id = claims
+            async with db_pool.connection() as conn:
+                await conn.execute(REVOKE_TOKEN_QUERY, (token_id, expires))
+                await conn.commit()
+            signed_tokens.revoke(token_id, expires)
+    else:
+        async with db_pool.connection() as conn:
+            await conn.execute("DELETE FROM sessions WHERE token = %s", (token,))
+            await conn.commit()
+        await cache_call(session_cache.delete, token)
+
+    response = json_response({"message": "Logged out successfully"})
+    response.delete_cookie("token")
+    return response
+
+async def create_comment(request):
+    data = await read_json(request)
+    token = data.get('token')
+    post_id = data.get('post_id')
+    user_id = data.get('user_id')
+    content = data.get('content')
+    parent_comment_id = data.get('parent_comment_id')
+    if not token or not post_id or not user_id or not content:
+        return json_response({"error": "Missing required fields"}, 400)
+    try:
+        post_id, user_id = parse_id(post_id), parse_id(user_id)
+        if parent_comment_id is not None:
+            parent_comment_id = parse_id(parent_comment_id)
+    except ValueError:
+        return json_response({"error": "Invalid post, user or parent comment ID."}, 400)
+
+    async with db_pool.connection() as conn:
+        try:
+            if not await validate_user_token(conn, user_id, token):
+                return json_response({"error": "Invalid token or user ID."}, 403)
+
+            cur = await conn.execute("""
+                INSERT INTO comments (post_id, user_id, content, parent_comment_id, created_at, score)
+                VALUES (%s, %s, %s, %s, NOW(), 0)
+                RETURNING id, created_at, (SELECT username FROM users WHERE id = comments.user_id);
+            """, (post_id, user_id, content, parent_comment_id))
+            comment_id, created_at, username = await cur.fetchone()
+            event_id = new_event_id()
+            await conn.execute(NOTIFY_QUERY, (event_payload(
+                post_id, "comment_created", event_id,
+                comment=comment_event(comment_id, parent_comment_id, content, username, created_at)),))
+            await conn.commit()
+            read_after = await write_position(conn)
+        except psycopg.Error as e:
+            await conn.rollback()
+            print(f"Error: {e}")
+            return json_response({"error": "Failed to create comment due to server error."}, 500)
+
+    await cache_call(thread_cache.invalidate, post_id)
+    return send_read_after(json_response({
+        "message": "Comment created successfully.",
+        "comment_id": comment_id,
+        "post_id": post_id,
+        "user_id": user_id,
+        "content": content,
+        "parent_comment_id": parent_comment_id,
+        "event_id": event_id
+    }, 201), read_after)
+
+async def create_post(request):
+    data = await read_json(request)
+    user_id = data.get("user_id")
+    token = data.get("token")
+    title = data.get("title")
+    content = data.get("content")
+    if not token or not title or not user_id:
+        return json_response({"error": "Missing required fields"}, 400)
+    try:
+        user_id = parse_id(user_id)
+    except ValueError:
+        return json_response({"error": "Invalid user ID."}, 400)
+
+    async with db_pool.connection() as conn:
+        try:
+            if not await validate_user_token(conn, user_id, token):
+                return json_response({"error": "Invalid token or user ID."}, 403)
+
+            cur = await conn.execute("""
+                INSERT INTO posts (user_id, title, content, created_at, updated_at, score)
+                VALUES (%s, %s, %s, NOW(), NOW(), 0)
+                RETURNING id, user_id, (SELECT username FROM users WHERE id = posts.user_id), title, content,
+                          created_at, updated_at, score;
+            """, (user_id, title, content))
+            row = await cur.fetchone()
+            post_id = row[0]
+            await conn.execute(NOTIFY_QUERY, (event_payload(post_id, "post_created", new_event_id(),
+                                                            post=feed_post(row)),))
+            await conn.commit()
+            read_after = await write_position(conn)
+        except psycopg.Error as e:
+            await conn.rollback()
+            print(f"Error: {e}")
+            return json_response({"error": "Failed to create post due to server error."}, 500)
+    await cache_call(feed_version.bump)
+    if ranked_feed is not None:
+        ranked_feed.add_post(tuple(row))
+
+    return send_read_after(json_response({"message": "Post created successfully.", "post_id": post_id}, 201),
+                           read_after)
+
+async def cast_vote(request, kind):
+    # kind is "post" or "comment"; mirrors vote_post / vote_comment in app.py
+    data = await read_json(request)
+    token = data.get('token')
+    item_id = data.get(f'{kind}_id')
+    user_id = data.get('user_id')
+    vote_type = data.get('vote_type')
+    if not token or not item_id or not user_id or not vote_type:
+        return json_response({"error": "Missing required fields"}, 400)
+    try:
+        item_id, user_id = parse_id(item_id), parse_id(user_id)
+    except ValueError:
+        return json_response({"error": f"Invalid {kind} or user ID."}, 400)
+
+    async with db_pool.connection() as conn:
+        try:
+            if not await validate_user_token(conn, user_id, token):
+                return json_response({"error": "Invalid token or user ID."}, 403)
+
+            if vote_type not in ["upvote", "downvote"]:
+                return json_response({"error": "Invalid vote type."}, 400)
+
+            if kind == "post":
+                cur = await conn.execute("SELECT cast_post_vote(%s, %s, %s, %s), %s::INTEGER;",
+                                         (user_id, item_id, vote_type, score_buffer is None, item_id))
+            else:
+                cur = await conn.execute("""
+                    SELECT cast_comment_vote(%s, %s, %s, %s), (SELECT post_id FROM comments WHERE id = %s);
+                """, (user_id, item_id, vote_type, score_buffer is None, item_id))
+            score_change, post_id = await cur.fetchone()
+            event_id = new_event_id()
+            await conn.execute(NOTIFY_QUERY, (event_payload(post_id, "score_changed", event_id, kind=kind,
+                                                            id=item_id, delta=score_change),))
+            await conn.commit()
+            read_after = await write_position(conn)
+        except psycopg.errors.ForeignKeyViolation:
+            await conn.rollback()
+            return json_response({"error": f"{kind.capitalize()} not found."}, 404)
+        except psycopg.Error as e:
+            await conn.rollback()
+            print(f"Error: {e}")
+            return json_response({"error": f"Failed to record {kind} vote due to server error."}, 500)
+
+    await cache_call(thread_cache.invalidate, post_id)
+    if kind == "post":
+        await cache_call(feed_version.bump)
+    if score_buffer is not None:
+        score_buffer.add(f"{kind}s", item_id, score_change)
+
+    return send_read_after(json_response({
+        "message": f"{kind.capitalize()} {vote_type}d successfully.",
+        f"{kind}_id": item_id,
+        "new_score": score_change,
+        "event_id": event_id
+    }), read_after)
+
+# app.py's BATCH_VOTE_QUERIES over arrays, as psycopg 3 has no execute_values
+BATCH_VOTE_QUERIES = {
+    "post": """
+        SELECT v.id, cast_post_vote(%s, v.id, v.vote_type, %s), v.id
+        FROM unnest(%s::INTEGER[], %s::VARCHAR[]) AS v(id, vote_type)
+        JOIN posts ON posts.id = v.id
+        ORDER BY v.id
+    """,
+    "comment": """
+        SELECT v.id, cast_comment_vote(%s, v.id, v.vote_type, %s), comments.post_id
+        FROM unnest(%s::INTEGER[], %s::VARCHAR[]) AS v(id, vote_type)
+        JOIN comments ON comments.id = v.id
+        ORDER BY v.id
+    """,
+}
+
+async def cast_votes(request):
+    # Mirrors cast_votes in app.py
+    data = await read_json(request)
+    token = data.get('token')
+    user_id = data.get('user_id')
+    votes = data.get('votes')
+    if not token or not user_id or votes is None:
+        return json_response({"error": "Missing required fields"}, 400)
+
+    try:
+        results, pending = parse_vote_batch(votes)
+    except ValueError as e:
+        return json_response({"error": str(e)}, 400)
+
+    try:
+        user_id = parse_id(user_id)
+    except ValueError:
+        return json_response({"error": "Invalid user ID."}, 400)
+
+    applied = []  # (kind, item id, score change, post id)
+    async with db_pool.connection() as conn:
+        try:
+            if not await validate_user_token(conn, user_id, token):
+                return json_response({"error": "Invalid token or user ID."}, 403)
+
+            payloads = []
+            for kind, items in pending.items():
+                if not items:
+                    continue
+                cur = await conn.execute(BATCH_VOTE_QUERIES[kind], (
+                    user_id, score_buffer is None,
+                    list(items), [vote_type for _, vote_type in items.values()]))
+                found = set()
+                for item_id, score_change, post_id in await cur.fetchall():
+                    event_id = new_event_id()
+                    payloads.append(event_payload(post_id, "score_changed", event_id, kind=kind, id=item_id,
+                                                  delta=score_change))
+                    results[items[item_id][0]] = vote_batch_result(kind, item_id, score_change, event_id)
+                    applied.append((kind, item_id, score_change, post_id))
+                    found.add(item_id)
+                for item_id, (index, _) in items.items():
+                    if item_id not in found:
+                        results[index] = vote_batch_result(kind, item_id)
+
+            if payloads:
+                await conn.execute(NOTIFY_MANY_QUERY, (payloads,))
+            await conn.commit()
+            read_after = await write_position(conn) if applied else None
+        except psycopg.Error as e:
+            await conn.rollback()
+            print(f"Error: {e}")
+            return json_response({"error": "Failed to process votes due to server error."}, 500)
+
+    for kind, item_id, score_change, post_id in applied:
+        await cache_call(thread_cache.invalidate, post_id)
+        if score_buffer is not None:
+            score_buffer.add(f"{kind}s", item_id, score_change)
+    if any(kind == "post" for kind, _, _, _ in applied):
+        await cache_call(feed_version.bump)
+
+    return send_read_after(json_response({"results": results}), read_after)
+
+async def vote_post(request):
+    return await cast_vote(request, "post")
+
+async def vote_comment(request):
+    return await cast_vote(request, "comment")
+
+@asynccontextmanager
+async def lifespan(_):
+    await db_pool.open()
+    for pool in replica_pools:
+        await pool.open()
+    try:
+        yield
+    finally:
+        for pool in replica_pools:
+            await pool.close()
+        await db_pool.close()
+
+app = Starlette(
+    routes=[
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+        Route('/api/hello', hello_world, methods=['GET']),
+        Route('/api/posts', get_posts, methods=['GET']),
+        Route('/api/post/{post_id:int}', get_post, methods=['GET']),
+        Route('/api/post/{post_id:int}/events', post_events_stream, methods=['GET']),
+        Route('/api/username/{user_id:int}', get_username, methods=['GET']),
+        Route('/api/usernames', get_usernames, methods=['GET']),
+        Route('/api/search', search, methods=['GET']),
+        Route('/api/cache_stats', cache_stats, methods=['GET']),
+        Route('/api/pool_stats', pool_stats, methods=['GET']),
+        Route('/api/register', register, methods=['POST']),
+        Route('/api/login', login, methods=['POST']),
+        Route('/api/logout', logout, methods=['POST']),
+        Route('/api/comments', create_comment, methods=['POST']),
+        Route('/api/comment_vote', vote_comment, methods=['POST']),
+        Route('/api/create_post', create_post, methods=['POST']),
+        Route('/api/post_vote', vote_post, methods=['POST']),
+        Route('/api/votes', cast_votes, methods=['POST']),
+    ],
+    middleware=[
+        Middleware(MetricsMiddleware),
+        Middleware(CompressionMiddleware),
+        # Allow cross-origin requests from React
+        Middleware(CORSMiddleware, allow_origins=["http://localhost:3000"], allow_methods=["*"], allow_headers=["*"],
+                   expose_headers=["X-Read-After"]),
+    ],
+    lifespan=lifespan,
+)
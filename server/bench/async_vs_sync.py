@@ -0,0 +1,111 @@
+"""Compare the sync Flask server with the asyncio server under many concurrent,
+optionally slow, clients.
+
+Start both servers against the same database, e.g.
+
+    python app.py                              # sync, port 5000
+    uvicorn asgi:app --port 8000               # async
+
+then run
+
+    python bench/async_vs_sync.py --sync http://127.0.0.1:5000 \\
+        --async http://127.0.0.1:8000 --concurrency 500 --requests 5000 --slow-ms 200
+
+Each client opens a fresh connection per request. With --slow-ms the request
+head is trickled out over that many milliseconds, which keeps a connection
+(and, in the sync server, a worker thread) busy without doing any work.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def fetch(host, port, path, slow_ms):
+    request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode()
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        if slow_ms:
+            chunks = [request[i:i + 8] for i in range(0, len(request), 8)]
+            for chunk in chunks:
+                writer.write(chunk)
+                await writer.drain()
+                await asyncio.sleep(slow_ms / 1000 / len(chunks))
+        else:
+            writer.write(request)
+            await writer.drain()
+
+        response = await reader.read()
+    finally:
+        writer.close()
+
+    status_line = response.split(b"\r\n", 1)[0]
+    return int(status_line.split(b" ")[1])
+
+
+async def run_target(base_url, paths, concurrency, requests, slow_ms, timeout):
+    url = urlsplit(base_url)
+    host, port = url.hostname, url.port or 80
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def client():
+        nonlocal errors
+        for i in counter:
+            path = paths[i % len(paths)]
+            started = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(fetch(host, port, path, slow_ms), timeout)
+            except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+                status = None
+            if status is None or status >= 500:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(name, latencies, errors, elapsed, requests):
+    ok = len(latencies)
+    print(f"{name:>6}: {ok / elapsed:8.1f} req/s  "
+          f"p50 {percentile(latencies, 0.50) * 1000:7.1f} ms  "
+          f"p95 {percentile(latencies, 0.95) * 1000:7.1f} ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:7.1f} ms  "
+          f"mean {statistics.fmean(latencies) * 1000 if latencies else float('nan'):7.1f} ms  "
+          f"errors {errors}/{requests}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sync", dest="sync_url", default="http://127.0.0.1:5000")
+    parser.add_argument("--async", dest="async_url", default="http://127.0.0.1:8000")
+    parser.add_argument("--path", action="append", dest="paths",
+                        help="request path, may be repeated (default: /api/posts)")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--slow-ms", type=float, default=0)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+    paths = args.paths or ["/api/posts"]
+
+    for name, url in (("sync", args.sync_url), ("async", args.async_url)):
+        latencies, errors, elapsed = asyncio.run(
+            run_target(url, paths, args.concurrency, args.requests, args.slow_ms, args.timeout))
+        report(name, latencies, errors, elapsed, args.requests)
+
+
+if __name__ == "__main__":
+    main()
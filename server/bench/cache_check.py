@@ -0,0 +1,197 @@
+"""Consistency check for the shared cache tier.
+
+Plays two server processes ("workers") with their own RedisBackend against
+one cache server, by default an embedded fake (fake_redis.py) so nothing
+needs installing but the redis package, and checks that:
+
+- a session one worker deletes is gone for the other;
+- a thread one worker invalidates is never served stale by the other, even
+  when the invalidation lands while a render is in progress;
+- a hot key's misses from many threads in both workers run one render;
+- after the cache server restarts both workers resubscribe, reload their
+  generations and move to a new epoch, and while it is down nothing stale
+  is served.
+
+Run from the server directory:
+
+    python bench/cache_check.py
+    python bench/cache_check.py --url redis://localhost:6379/15   # keys get a random prefix
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cache import RenderCache, SharedCache
+from cache_backends import MemoryBackend, RedisBackend
+from fake_redis import FakeRedis
+
+
+class Worker:
+    # The caches one server process would hold
+    def __init__(self, url, prefix):
+        self.backend = RedisBackend(url, prefix=prefix, reconnect_delay=0.1)
+        self.sessions = SharedCache(self.backend, "session", 60, encode=lambda v: str(v).encode(), decode=int)
+        self.threads = RenderCache(self.backend, "thread", 60, encode=lambda v: v, decode=lambda v: v)
+        self.backend.start()
+
+    def stop(self):
+        self.backend.stop()
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def check_sessions(a, b):
+    a.sessions.set("token1", 42)
+    if b.sessions.get("token1") != 42:
+        return "session set by one worker not seen by the other"
+    b.sessions.delete("token1")
+    if a.sessions.get("token1") is not None:
+        return "deleted session still served"
+
+
+def check_invalidation(a, b):
+    a.threads.get_or_compute(1, lambda: b"v1")
+    if b.threads.get(1) != b"v1":
+        return "rendered thread not shared"
+    b.threads.invalidate(1)
+    # Invalidations travel over pub/sub, so other workers see them a moment later
+    if not wait_for(lambda: a.threads.version(1) == b.threads.version(1)):
+        return "invalidation never reached the other worker"
+    if a.threads.get(1) is not None:
+        return "invalidated thread still served by the other worker"
+    if a.threads.get_or_compute(1, lambda: b"v2") != b"v2" or b.threads.get(1) != b"v2":
+        return "re-render after invalidation not served"
+
+
+def check_inflight_invalidation(a, b):
+    ticket = a.threads.begin(2)
+    b.threads.invalidate(2)  # a write commits while a renders
+    if not wait_for(lambda: a.threads.begin(2) != ticket):
+        return "invalidation never reached the rendering worker"
+    if a.threads.set(2, b"stale", ticket):
+        return "render begun before an invalidation was stored"
+    if a.threads.get(2) is not None or b.threads.get(2) is not None:
+        return "stale render served"
+
+
+def check_stampede(a, b, threads=32):
+    computes = []
+    lock = threading.Lock()
+
+    def render():
+        with lock:
+            computes.append(1)
+        time.sleep(0.2)  # a slow thread query
+        return b"hot"
+
+    key = f"hot-{uuid.uuid4().hex}"
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(lambda i: (a, b)[i % 2].threads.get_or_compute(key, render), range(threads)))
+    if results != [b"hot"] * threads:
+        return f"callers got {set(results)}"
+    if len(computes) != 1:
+        return f"{len(computes)} renders for one key"
+
+
+def check_restart(servers, a, b):
+    # servers: [the running fake], replaced by the restarted one
+    fake = servers[0]
+    a.threads.get_or_compute(3, lambda: b"before")
+    epoch = a.backend.epoch()
+    if b.backend.epoch() != epoch:
+        return "workers disagree on the epoch"
+    resyncs = a.backend.resyncs
+    fake.stop()
+    if not wait_for(lambda: a.backend.resyncs > resyncs):
+        return "lost subscription not noticed"
+
+    # While the server is down: misses, and versions that match nothing
+    versions = {a.threads.version(3) for _ in range(3)}
+    if a.threads.get(3) is not None or len(versions) != 3 or min(versions) >= 0:
+        return "stale entry or reused version while the cache server was down"
+
+    servers[0] = FakeRedis(fake.host, fake.port).start()
+    if not wait_for(lambda: a.backend.resyncs > resyncs + 1 and a.threads.version(3) >= 0, timeout=5.0):
+        return "subscriber did not reconnect"
+    b.threads.invalidate(3)
+    if not wait_for(lambda: a.threads.get(3) is None):
+        return "invalidation after the restart not seen"
+    if not wait_for(lambda: a.backend.epoch() == b.backend.epoch() != epoch):
+        return "epoch unchanged after the server came back empty"
+
+
+def check_memory():
+    backend = MemoryBackend(1024 * 1024, weigh=len)
+    threads = RenderCache(backend, "thread", 60)
+    computes = []
+
+    def render():
+        computes.append(1)
+        time.sleep(0.2)
+        return b"hot"
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(lambda i: threads.get_or_compute(1, render), range(16)))
+    if results != [b"hot"] * 16 or len(computes) != 1:
+        return f"{len(computes)} renders, results {set(results)}"
+    ticket = threads.begin(1)
+    threads.invalidate(1)
+    if threads.get(1) is not None or threads.set(1, b"stale", ticket):
+        return "invalidation not applied"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="a Redis server to use instead of the embedded fake")
+    args = parser.parse_args()
+
+    servers = [] if args.url else [FakeRedis().start()]
+    url = args.url or servers[0].url
+    prefix = f"cache_check:{uuid.uuid4().hex[:8]}:"
+    a, b = Worker(url, prefix), Worker(url, prefix)
+    # Both subscriptions are live before anything is published
+    wait_for(lambda: a.backend.resyncs and b.backend.resyncs)
+
+    checks = [
+        ("sessions", lambda: check_sessions(a, b)),
+        ("invalidation", lambda: check_invalidation(a, b)),
+        ("in-flight invalidation", lambda: check_inflight_invalidation(a, b)),
+        ("stampede", lambda: check_stampede(a, b)),
+        ("memory backend", check_memory),
+    ]
+    if servers:
+        checks.append(("restart", lambda: check_restart(servers, a, b)))
+
+    failed = False
+    for name, check in checks:
+        result = check()
+        print(f"{'ok  ' if result is None else 'FAIL'} {name}{'' if result is None else ': ' + result}")
+        failed = failed or result is not None
+
+    print(f"worker stats: {a.threads.stats()}")
+    a.stop()
+    b.stop()
+    for server in servers:
+        server.stop()
+    if failed:
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""An in-process server speaking enough of the Redis protocol for the shared
+cache tier (cache_backends.RedisBackend): strings with expiry, counters and
+pub/sub, kept in one dict.
+
+cache_check.py starts one per run. To point servers at it by hand:
+
+    python bench/fake_redis.py --port 6390
+    CACHE_URL=redis://127.0.0.1:6390/0 python app.py
+
+It is a test double, not a cache to deploy: there is no eviction, no
+persistence and no authentication.
+"""
+import argparse
+import socket
+import socketserver
+import threading
+import time
+
+CRLF = b"\r\n"
+
+
+class ReplyError(Exception):
+    pass
+
+
+class Status(bytes):
+    pass
+
+
+OK = Status(b"OK")
+
+
+def encode(value):
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, Status):
+        return b"+" + value + CRLF
+    if isinstance(value, ReplyError):
+        return b"-" + str(value).encode() + CRLF
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+    raise TypeError(f"Cannot encode {value!r}")
+
+
+def read_command(rfile):
+    # Returns the arguments of the next command, or None at end of stream
+    line = rfile.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        return line.split()  # inline command, as typed into telnet
+    args = []
+    for _ in range(int(line[1:])):
+        size = int(rfile.readline()[1:])
+        args.append(rfile.read(size + 2)[:-2])
+    return args
+
+
+class FakeRedis:
+    def __init__(self, host="127.0.0.1", port=0):
+        self._data = {}  # key -> (value, expires_at or None)
+        self._channels = {}  # channel -> set of connections
+        self._connections = set()
+        self._lock = threading.Lock()
+        self.commands = 0
+
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def setup(self):
+                super().setup()
+                self.write_lock = threading.Lock()
+                self.channels = set()
+                with fake._lock:
+                    fake._connections.add(self)
+
+            def send(self, data):
+                with self.write_lock:
+                    self.wfile.write(data)
+                    self.wfile.flush()
+
+            def handle(self):
+                try:
+                    while True:
+                        args = read_command(self.rfile)
+                        if args is None:
+                            return
+                        for reply in fake.execute(self, args):
+                            self.send(encode(reply))
+                        if args and args[0].upper() == b"QUIT":
+                            return
+                except (ConnectionError, OSError, ValueError):
+                    pass
+
+            def finish(self):
+                with fake._lock:
+                    fake._connections.discard(self)
+                    for channel in self.channels:
+                        fake._channels.get(channel, set()).discard(self)
+                try:
+                    super().finish()
+                except OSError:
+                    pass
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"redis://{self.host}:{self.port}/0"
+
+    def _alive(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    def execute(self, connection, args):
+        # Returns the replies to send, usually one
+        self.commands += 1
+        if not args:
+            return [ReplyError("ERR empty command")]
+        name = args[0].upper().decode()
+        handler = getattr(self, "_cmd_" + name.lower(), None)
+        if handler is None:
+            return [ReplyError(f"ERR unknown command '{name}'")]
+        try:
+            with self._lock:
+                return handler(connection, *args[1:])
+        except (TypeError, ValueError):
+            return [ReplyError(f"ERR wrong arguments for '{name}'")]
+
+    def _cmd_ping(self, connection, message=None):
+        return [Status(b"PONG") if message is None else message]
+
+    def _cmd_client(self, connection, *args):
+        return [OK]
+
+    def _cmd_select(self, connection, db):
+        return [OK]
+
+    def _cmd_quit(self, connection):
+        return [OK]
+
+    def _cmd_get(self, connection, key):
+        entry = self._alive(key)
+        return [entry[0] if entry is not None else None]
+
+    def _cmd_set(self, connection, key, value, *options):
+        expires_at = None
+        nx = xx = False
+        options = list(options)
+        while options:
+            option = options.pop(0).upper()
+            if option == b"EX":
+                expires_at = time.monotonic() + int(options.pop(0))
+            elif option == b"PX":
+                expires_at = time.monotonic() + int(options.pop(0)) / 1000
+            elif option == b"NX":
+                nx = True
+            elif option == b"XX":
+                xx = True
+            else:
+                return [ReplyError("ERR syntax error")]
+        exists = self._alive(key) is not None
+        if (nx and exists) or (xx and not exists):
+            return [None]
+        self._data[key] = (value, expires_at)
+        return [OK]
+
+    def _cmd_del(self, connection, *keys):
+        deleted = 0
+        for key in keys:
+            if self._alive(key) is not None:
+                del self._data[key]
+                deleted += 1
+        return [deleted]
+
+    def _cmd_exists(self, connection, *keys):
+        return [sum(self._alive(key) is not None for key in keys)]
+
+    def _cmd_incr(self, connection, key):
+        return self._cmd_incrby(connection, key, b"1")
+
+    def _cmd_incrby(self, connection, key, amount):
+        entry = self._alive(key)
+        try:
+            value = (int(entry[0]) if entry is not None else 0) + int(amount)
+        except ValueError:
+            return [ReplyError("ERR value is not an integer or out of range")]
+        self._data[key] = (str(value).encode(), entry[1] if entry is not None else None)
+        return [value]
+
+    def _cmd_dbsize(self, connection):
+        return [sum(self._alive(key) is not None for key in list(self._data))]
+
+    def _cmd_flushdb(self, connection, *args):
+        self._data.clear()
+        return [OK]
+
+    _cmd_flushall = _cmd_flushdb
+
+    def _cmd_publish(self, connection, channel, message):
+        subscribers = list(self._channels.get(channel, ()))
+        frame = encode([b"message", channel, message])
+        for subscriber in subscribers:
+            try:
+                subscriber.send(frame)
+            except OSError:
+                pass
+        return [len(subscribers)]
+
+    def _cmd_subscribe(self, connection, *channels):
+        replies = []
+        for channel in channels:
+            self._channels.setdefault(channel, set()).add(connection)
+            connection.channels.add(channel)
+            replies.append([b"subscribe", channel, len(connection.channels)])
+        return replies
+
+    def _cmd_unsubscribe(self, connection, *channels):
+        replies = []
+        for channel in channels or sorted(connection.channels):
+            self._channels.get(channel, set()).discard(connection)
+            connection.channels.discard(channel)
+            replies.append([b"unsubscribe", channel, len(connection.channels)])
+        return replies or [[b"unsubscribe", None, 0]]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-redis", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # Closes client connections too, the way a restarting server would
+        self._server.shutdown()
+        self._server.server_close()
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+
+    fake = FakeRedis(args.host, args.port).start()
+    print(f"Listening on {fake.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""Benchmark for /api/search on a large synthetic corpus.
+
+Two steps, both driven by --seed:
+
+    # Load posts and comments whose words follow a Zipf distribution over a
+    # made-up vocabulary, through COPY so the search triggers run per row
+    DB_PASSWORD=... python bench/full_text_search.py seed --posts 500000 --comments 2500000
+
+    # Time the search statements for queries from very common to rare words,
+    # first pages and deep pages, against a sequential ILIKE scan
+    DB_PASSWORD=... python bench/full_text_search.py run --repeat 20
+
+Queries are picked by word frequency rank in the generated vocabulary, so
+"common" matches a large share of all rows and "rare" a handful. A search
+ranks every match before it returns a page, so its cost grows with the number
+of matches rather than the page size; the report shows how far. The server
+cancels searches slower than SEARCH_TIMEOUT_MS (see app.py) and answers 503;
+the statements are timed here without that limit.
+"""
+import argparse
+import io
+import itertools
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+
+import queries
+
+SEED_PREFIX = "search_"
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "ta", "shi", "po", "ve", "da", "zu", "fe", "gor", "lin", "mar",
+             "tek", "bal", "sor", "wen", "qui"]
+COPY_BATCH = 50000
+
+# name -> how to build the query text from the vocabulary (most frequent first)
+QUERY_CLASSES = {
+    "common": lambda words, rng: words[rng.randrange(0, 5)],
+    "medium": lambda words, rng: words[rng.randrange(100, 200)],
+    "rare": lambda words, rng: words[rng.randrange(len(words) // 2, len(words))],
+    "two words": lambda words, rng: f"{words[rng.randrange(50, 200)]} {words[rng.randrange(50, 200)]}",
+    "phrase": lambda words, rng: f'"{words[rng.randrange(0, 20)]} {words[rng.randrange(0, 20)]}"',
+    "or": lambda words, rng: f"{words[rng.randrange(1000, 2000)]} or {words[rng.randrange(1000, 2000)]}",
+    "exclude": lambda words, rng: f"{words[rng.randrange(100, 200)]} -{words[rng.randrange(0, 5)]}",
+}
+
+
+def vocabulary(size, rng):
+    # Distinct pronounceable non-words, so the stemmer and stop word list
+    # leave them alone, in a fixed order: index = frequency rank
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+class Text:
+    """Random text with Zipf-distributed words."""
+
+    def __init__(self, words, rng, exponent=1.1):
+        self.words = words
+        self.rng = rng
+        self.cum_weights = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, len(words) + 1)))
+
+    def __call__(self, low, high):
+        return " ".join(self.rng.choices(self.words, cum_weights=self.cum_weights, k=self.rng.randint(low, high)))
+
+
+def copy_rows(cur, table, columns, rows):
+    # rows: an iterable of tuples of str/int, sent COPY_BATCH at a time
+    rows = iter(rows)
+    copied = 0
+    while True:
+        batch = list(itertools.islice(rows, COPY_BATCH))
+        if not batch:
+            return copied
+        buffer = io.StringIO()
+        for row in batch:
+            buffer.write("\t".join(str(value) for value in row) + "\n")
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+        copied += len(batch)
+        print(f"  {table}: {copied} rows", end="\r", flush=True)
+
+
+def seed(conn, rng, words, users, posts, comments):
+    text = Text(words, rng)
+    cur = conn.cursor()
+    prefix = f"{SEED_PREFIX}{rng.getrandbits(32):08x}_"
+
+    cur.execute("INSERT INTO users (username, password) SELECT %s || g, 'x' FROM generate_series(1, %s) g "
+                "RETURNING id", (prefix, users))
+    user_ids = [row[0] for row in cur.fetchall()]
+
+    timings = {}
+    started = time.perf_counter()
+    cur.execute("SELECT COALESCE(MAX(id), 0) FROM posts")
+    first_post = cur.fetchone()[0] + 1
+    copy_rows(cur, "posts", ("user_id", "title", "content"),
+              ((rng.choice(user_ids), text(3, 10), text(20, 120)) for _ in range(posts)))
+    cur.execute("SELECT id FROM posts WHERE id >= %s", (first_post,))
+    post_ids = [row[0] for row in cur.fetchall()]
+    timings["posts"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    copy_rows(cur, "comments", ("post_id", "user_id", "content"),
+              ((rng.choice(post_ids), rng.choice(user_ids), text(5, 60)) for _ in range(comments)))
+    timings["comments"] = time.perf_counter() - started
+    conn.commit()
+
+    cur.execute("ANALYZE posts; ANALYZE comments;")
+    conn.commit()
+    cur.close()
+    print()
+    for table, count in (("posts", posts), ("comments", comments)):
+        print(f"{table}: {count} rows in {timings[table]:.1f}s ({count / timings[table]:.0f} rows/s, "
+              f"text generation and search triggers included)")
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def timed(cur, query, params):
+    started = time.perf_counter()
+    cur.execute(query, params)
+    rows = cur.fetchall()
+    return time.perf_counter() - started, rows
+
+
+def run(conn, rng, words, repeat, depth, baseline):
+    cur = conn.cursor()
+    if not seeded_users(cur):
+        raise SystemExit("No seeded corpus found, run the seed step first")
+    limit = queries.DEFAULT_SEARCH_LIMIT
+    print(f"{'query':<10} {'type':<9} {'matches':>9} {'page 1 p50':>11} {'p95':>8} "
+          f"{f'page {depth} p50':>11} {'p95':>8} {'ILIKE':>9}")
+    for name, build in QUERY_CLASSES.items():
+        for search_type in queries.SEARCH_TYPES:
+            first, deep, matches = [], [], []
+            for _ in range(repeat):
+                text = build(words, rng)
+                cur.execute(f"SELECT count(*) FROM {search_type} "
+                            f"WHERE search_vector @@ websearch_to_tsquery('{queries.SEARCH_CONFIG}', %s)", (text,))
+                matches.append(cur.fetchone()[0])
+
+                seconds, rows = timed(cur, queries.search_query(search_type, False), (text, limit + 1))
+                first.append(seconds)
+                # Follow next_cursor the way a client paging through would
+                for _ in range(depth - 1):
+                    if len(rows) <= limit:
+                        break
+                    last = rows[limit - 1]
+                    seconds, rows = timed(cur, queries.search_query(search_type, True),
+                                          (text, last[-1], last[0], limit + 1))
+                else:
+                    deep.append(seconds)
+
+            ilike = ""
+            if baseline:
+                # What finding a thread costs without the index: one word
+                # anywhere in the text, unranked
+                column = "content" if search_type == "comments" else "title || ' ' || content"
+                word = build(words, rng).split()[0].strip('-"')
+                seconds, _ = timed(cur, f"SELECT id FROM {search_type} WHERE {column} ILIKE %s LIMIT %s",
+                                   (f"%{word}%", limit + 1))
+                ilike = f"{seconds * 1000:7.0f}ms"
+
+            first.sort()
+            deep.sort()
+            deep_p50 = f"{percentile(deep, 0.5) * 1000:9.1f}ms" if deep else f"{'-':>11}"
+            deep_p95 = f"{percentile(deep, 0.95) * 1000:6.1f}ms" if deep else f"{'-':>8}"
+            print(f"{name:<10} {search_type:<9} {sorted(matches)[len(matches) // 2]:>9} "
+                  f"{percentile(first, 0.5) * 1000:9.1f}ms {percentile(first, 0.95) * 1000:6.1f}ms "
+                  f"{deep_p50} {deep_p95} {ilike:>9}")
+    conn.rollback()
+    cur.close()
+
+
+def seeded_users(cur):
+    cur.execute("SELECT count(*) FROM users WHERE username LIKE %s", (SEED_PREFIX + "%",))
+    return cur.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--vocabulary", type=int, default=50000, help="distinct words; same for seed and run")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = subparsers.add_parser("seed")
+    seed_parser.add_argument("--users", type=int, default=10000)
+    seed_parser.add_argument("--posts", type=int, default=500000)
+    seed_parser.add_argument("--comments", type=int, default=2500000)
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--repeat", type=int, default=20, help="queries per class and type")
+    run_parser.add_argument("--depth", type=int, default=5, help="page to time besides the first")
+    run_parser.add_argument("--no-baseline", dest="baseline", action="store_false",
+                            help="skip the ILIKE sequential scans")
+    args = parser.parse_args()
+
+    # The same seed gives the same vocabulary, in the same frequency order,
+    # so run knows which words are common without reading the corpus back
+    rng = random.Random(args.seed)
+    words = vocabulary(args.vocabulary, rng)
+    conn = psycopg2.connect(**queries.db_config)
+    try:
+        if args.command == "seed":
+            seed(conn, rng, words, args.users, args.posts, args.comments)
+        else:
+            run(conn, rng, words, args.repeat, args.depth, args.baseline)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
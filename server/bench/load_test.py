@@ -0,0 +1,502 @@
+"""Reproducible load test for the /api/* routes.
+
+Two steps, both driven by --seed so reruns generate the same data and the
+same request sequence:
+
+    # Fill the database with synthetic users (with sessions), posts, comment
+    # trees and votes; every seeded account has the password "password"
+    DB_PASSWORD=... python bench/load_test.py seed --users 1000 --posts 5000 \\
+        --comments 50000 --votes 100000
+
+    # Replay a traffic mix against a running server
+    DB_PASSWORD=... python bench/load_test.py run --url http://127.0.0.1:5000 \\
+        --mix mixed --concurrency 32 --duration 30 --output results.json
+
+The run step reads the seeded accounts and hot items back from the database,
+prints p50/p95/p99 latency, throughput and error rate per route and overall,
+and writes the same numbers as JSON. With --baseline it compares against an
+earlier results file and exits non-zero when p95 latency or the error rate
+regresses by more than --tolerance.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+import psycopg2.errors
+from psycopg2.extras import execute_values
+from werkzeug.security import generate_password_hash
+
+import queries
+
+SEED_PREFIX = "load_"
+SEED_PASSWORD = "password"
+
+# Operation weights per traffic mix; see OPERATIONS for what each one sends
+MIXES = {
+    'browse': {'feed': 40, 'feed_scroll': 10, 'thread': 35, 'thread_page': 5, 'username': 10},
+    'votes': {'feed': 20, 'thread': 20, 'vote_post': 30, 'vote_comment': 30},
+    'comments': {'thread': 40, 'comment_burst': 60},
+    'logins': {'login': 70, 'logout': 20, 'register': 10},
+    # One post everybody opens at once, with a comment now and then
+    'viral': {'viral_thread': 60, 'viral_page': 38, 'viral_comment': 2},
+    'mixed': {
+        'feed': 25, 'feed_scroll': 5, 'thread': 25, 'thread_page': 3, 'username': 5,
+        'vote_post': 10, 'vote_comment': 10, 'comment_burst': 5, 'create_post': 2,
+        'login': 5, 'logout': 1, 'register': 1, 'hello': 1, 'stats': 2,
+    },
+}
+
+# Votes and comment bursts target the HOT_ITEMS hottest posts
+HOT_ITEMS = 20
+
+
+def seed(conn, rng, users, posts, comments, votes, depth):
+    cur = conn.cursor()
+    prefix = f"{SEED_PREFIX}{rng.getrandbits(32):08x}_"
+    password_hash = generate_password_hash(SEED_PASSWORD)
+
+    rows = execute_values(cur, "INSERT INTO users (username, password) VALUES %s RETURNING id",
+                          [(f"{prefix}{i}", password_hash) for i in range(users)], fetch=True)
+    user_ids = [row[0] for row in rows]
+    execute_values(cur, "INSERT INTO sessions (user_id, token) VALUES %s",
+                   [(user_id, uuid.UUID(int=rng.getrandbits(128)).hex) for user_id in user_ids])
+
+    # Spread creation times over the last 30 days so the hot ranking matters
+    now = datetime.now()
+    post_rows = []
+    for i in range(posts):
+        created_at = now - timedelta(seconds=rng.randrange(30 * 24 * 3600))
+        post_rows.append((rng.choice(user_ids), f"Post {i}", "Lorem ipsum " * rng.randint(1, 40),
+                          created_at, created_at))
+    rows = execute_values(cur, """
+        INSERT INTO posts (user_id, title, content, created_at, updated_at) VALUES %s RETURNING id
+    """, post_rows, fetch=True)
+    post_ids = [row[0] for row in rows]
+
+    # Comments are skewed towards a few popular posts and inserted level by
+    # level, so replies can reference their parent's id. Each comment either
+    # starts a new top-level thread or replies to an existing comment on the
+    # same post; replying to the newest one builds chains up to `depth` deep.
+    per_post = {}
+    for _ in range(comments):
+        post_id = post_ids[min(int(rng.paretovariate(1.2)) - 1, len(post_ids) - 1)]
+        per_post[post_id] = per_post.get(post_id, 0) + 1
+    levels = [[] for _ in range(depth + 1)]
+    for post_id, count in per_post.items():
+        nodes = []  # (depth, index of the parent within this post)
+        for i in range(count):
+            if i == 0 or rng.random() < 0.3:
+                nodes.append((0, None))
+            else:
+                parent = i - 1 if rng.random() < 0.5 else rng.randrange(i)
+                if nodes[parent][0] < depth:
+                    nodes.append((nodes[parent][0] + 1, parent))
+                else:
+                    nodes.append((0, None))
+        for i, (level, parent) in enumerate(nodes):
+            levels[level].append((post_id, i, parent))
+
+    comment_ids = {}
+    for level in levels:
+        if not level:
+            continue
+        rows = execute_values(cur, """
+            INSERT INTO comments (post_id, user_id, content, parent_comment_id) VALUES %s RETURNING id
+        """, [(post_id, rng.choice(user_ids), "Comment " * rng.randint(1, 20),
+               comment_ids[post_id, parent] if parent is not None else None)
+              for post_id, _, parent in level], fetch=True)
+        for (post_id, i, _), row in zip(level, rows):
+            comment_ids[post_id, i] = row[0]
+    all_comment_ids = sorted(comment_ids.values())
+
+    post_votes, comment_votes = {}, {}
+    for _ in range(votes):
+        vote_type = "upvote" if rng.random() < 0.7 else "downvote"
+        if all_comment_ids and rng.random() < 0.5:
+            comment_votes[rng.choice(user_ids), rng.choice(all_comment_ids)] = vote_type
+        else:
+            post_votes[rng.choice(user_ids), rng.choice(post_ids)] = vote_type
+    execute_values(cur, "INSERT INTO post_votes (user_id, post_id, vote_type) VALUES %s ON CONFLICT DO NOTHING",
+                   [key + (value,) for key, value in post_votes.items()])
+    execute_values(cur, "INSERT INTO comment_votes (user_id, comment_id, vote_type) VALUES %s ON CONFLICT DO NOTHING",
+                   [key + (value,) for key, value in comment_votes.items()])
+    for table, vote_table, column, ids in (("posts", "post_votes", "post_id", post_ids),
+                                           ("comments", "comment_votes", "comment_id", all_comment_ids)):
+        cur.execute(f"""
+            UPDATE {table} t SET score = v.score
+            FROM (
+                SELECT {column} AS id, SUM(CASE vote_type WHEN 'upvote' THEN 1 ELSE -1 END) AS score
+                FROM {vote_table} WHERE {column} = ANY(%s) GROUP BY {column}
+            ) v
+            WHERE t.id = v.id
+        """, (ids,))
+
+    conn.commit()
+    cur.execute("ANALYZE")
+    cur.close()
+    return {"users": len(user_ids), "posts": len(post_ids), "comments": len(all_comment_ids),
+            "post_votes": len(post_votes), "comment_votes": len(comment_votes)}
+
+
+class Fixture:
+    """Seeded accounts and items the traffic generator picks from."""
+
+    def __init__(self, conn, limit=10000):
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT DISTINCT ON (u.id) u.id, u.username, s.token
+            FROM users u JOIN sessions s ON s.user_id = u.id
+            WHERE u.username LIKE %s
+            ORDER BY u.id, s.id
+            LIMIT %s
+        """, (SEED_PREFIX + "%", limit))
+        self.accounts = cur.fetchall()
+        cur.execute("SELECT id FROM posts ORDER BY id DESC LIMIT %s", (limit,))
+        self.post_ids = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT id FROM posts ORDER BY hot_rank(score, created_at) DESC, id DESC LIMIT %s",
+                    (HOT_ITEMS,))
+        self.hot_post_ids = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT id, post_id FROM comments WHERE post_id = ANY(%s) ORDER BY id",
+                    (self.hot_post_ids,))
+        self.hot_comments = cur.fetchall()
+        cur.close()
+        conn.rollback()
+
+        if not self.accounts or not self.post_ids:
+            raise SystemExit("No seeded data found, run the seed step first")
+
+
+class Client:
+    """One simulated user: a keep-alive HTTP connection and a private RNG."""
+
+    def __init__(self, base_url, fixture, rng, record):
+        url = urlsplit(base_url)
+        self.conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+        self.fixture = fixture
+        self.rng = rng
+        self.record = record
+
+    def request(self, route, method, path, body=None, headers=None):
+        # Returns the decoded JSON body, or None on a transport error
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        started = time.perf_counter()
+        try:
+            self.conn.request(method, path, body=body, headers=headers)
+            response = self.conn.getresponse()
+            payload = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.record(route, None, time.perf_counter() - started)
+            return None
+        self.record(route, status, time.perf_counter() - started)
+        try:
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    def account(self):
+        return self.rng.choice(self.fixture.accounts)
+
+    def feed(self):
+        sort = self.rng.choice(list(queries.FEED_SORTS))
+        return self.request("GET /api/posts", "GET", f"/api/posts?sort={sort}")
+
+    def feed_scroll(self):
+        data = self.feed()
+        for _ in range(self.rng.randint(1, 3)):
+            if not data or not data.get("next_cursor"):
+                return
+            data = self.request("GET /api/posts?cursor", "GET",
+                                f"/api/posts?sort={data['sort']}&cursor={data['next_cursor']}")
+
+    def thread(self):
+        # Mostly hot posts, which is what the thread cache is for
+        if self.rng.random() < 0.8:
+            post_id = self.rng.choice(self.fixture.hot_post_ids)
+        else:
+            post_id = self.rng.choice(self.fixture.post_ids)
+        self.request("GET /api/post/<id>", "GET", f"/api/post/{post_id}")
+
+    def thread_page(self):
+        post_id = self.rng.choice(self.fixture.hot_post_ids)
+        data = self.request("GET /api/post/<id>?limit", "GET", f"/api/post/{post_id}?limit=50&max_depth=3")
+        cursor = data and data.get(str(post_id), {}).get("next_cursor")
+        if cursor:
+            self.request("GET /api/post/<id>?cursor", "GET", f"/api/post/{post_id}?limit=50&cursor={cursor}")
+
+    def viral_thread(self):
+        post_id = self.fixture.hot_post_ids[0]
+        self.request("GET /api/post/<id>", "GET", f"/api/post/{post_id}")
+
+    def viral_page(self):
+        # Uncached, so only request coalescing keeps these off the pool
+        post_id = self.fixture.hot_post_ids[0]
+        self.request("GET /api/post/<id>?limit", "GET", f"/api/post/{post_id}?limit=500&max_depth=20")
+
+    def viral_comment(self):
+        user_id, _, token = self.account()
+        self.request("POST /api/comments", "POST", "/api/comments", {
+            "token": token, "user_id": user_id, "post_id": self.fixture.hot_post_ids[0], "content": "Load test reply",
+        })
+
+    def username(self):
+        user_id, _, _ = self.account()
+        self.request("GET /api/username/<id>", "GET", f"/api/username/{user_id}")
+
+    def vote_post(self):
+        user_id, _, token = self.account()
+        self.request("POST /api/post_vote", "POST", "/api/post_vote", {
+            "token": token, "user_id": user_id, "post_id": self.rng.choice(self.fixture.hot_post_ids),
+            "vote_type": self.rng.choice(["upvote", "downvote"]),
+        })
+
+    def vote_comment(self):
+        if not self.fixture.hot_comments:
+            return self.vote_post()
+        user_id, _, token = self.account()
+        comment_id, _ = self.rng.choice(self.fixture.hot_comments)
+        self.request("POST /api/comment_vote", "POST", "/api/comment_vote", {
+            "token": token, "user_id": user_id, "comment_id": comment_id,
+            "vote_type": self.rng.choice(["upvote", "downvote"]),
+        })
+
+    def comment_burst(self):
+        # Several replies in a row on one hot post, each invalidating its thread
+        post_id = self.rng.choice(self.fixture.hot_post_ids)
+        parents = [c for c, p in self.fixture.hot_comments if p == post_id] or [None]
+        for _ in range(self.rng.randint(2, 5)):
+            user_id, _, token = self.account()
+            self.request("POST /api/comments", "POST", "/api/comments", {
+                "token": token, "user_id": user_id, "post_id": post_id, "content": "Load test reply",
+                "parent_comment_id": self.rng.choice(parents) if self.rng.random() < 0.7 else None,
+            })
+
+    def create_post(self):
+        user_id, _, token = self.account()
+        self.request("POST /api/create_post", "POST", "/api/create_post", {
+            "token": token, "user_id": user_id, "title": "Load test post", "content": "Lorem ipsum",
+        })
+
+    def login(self):
+        _, username, _ = self.account()
+        return self.request("POST /api/login", "POST", "/api/login",
+                            {"username": username, "password": SEED_PASSWORD})
+
+    def logout(self):
+        # Log out of a fresh session so the seeded tokens stay valid
+        data = self.login()
+        if data and data.get("token"):
+            self.request("POST /api/logout", "POST", "/api/logout",
+                         headers={"Cookie": f"token={data['token']}"})
+
+    def register(self):
+        username = f"{SEED_PREFIX}r_{self.rng.getrandbits(48):012x}"
+        self.request("POST /api/register", "POST", "/api/register",
+                     {"username": username, "password": SEED_PASSWORD})
+
+    def hello(self):
+        self.request("GET /api/hello", "GET", "/api/hello")
+
+    def stats(self):
+        self.request("GET /api/cache_stats", "GET", "/api/cache_stats")
+        self.request("GET /api/pool_stats", "GET", "/api/pool_stats")
+
+
+OPERATIONS = {name: getattr(Client, name) for name in {op for mix in MIXES.values() for op in mix}}
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}  # route -> [(status, seconds)]
+        self.lock = threading.Lock()
+
+    def __call__(self, route, status, seconds):
+        with self.lock:
+            self.samples.setdefault(route, []).append((status, seconds))
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(seconds for _, seconds in samples)
+    statuses = {}
+    for status, _ in samples:
+        key = str(status) if status is not None else "error"
+        statuses[key] = statuses.get(key, 0) + 1
+    # Transport failures and 5xx are errors; 4xx are answers to bad input
+    errors = sum(1 for status, _ in samples if status is None or status >= 500)
+    return {
+        "requests": len(samples),
+        "throughput": len(samples) / elapsed,
+        "error_rate": errors / len(samples) if samples else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "statuses": statuses,
+    }
+
+
+def run(base_url, fixture, mix, concurrency, duration, requests, seed_value):
+    recorder = Recorder()
+    names = list(MIXES[mix])
+    weights = [MIXES[mix][name] for name in names]
+    remaining = iter(range(requests)) if requests else None
+    deadline = time.monotonic() + duration
+
+    def worker(index):
+        rng = random.Random(f"{seed_value}:{index}")
+        client = Client(base_url, fixture, rng, recorder)
+        try:
+            while time.monotonic() < deadline:
+                if remaining is not None and next(remaining, None) is None:
+                    break
+                OPERATIONS[rng.choices(names, weights)[0]](client)
+        finally:
+            client.conn.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    every_sample = [sample for samples in recorder.samples.values() for sample in samples]
+    return {
+        "elapsed": elapsed,
+        "total": summarize(every_sample, elapsed) if every_sample else None,
+        "routes": {route: summarize(samples, elapsed) for route, samples in sorted(recorder.samples.items())},
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def report(results):
+    print(f"{'route':<28} {'reqs':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    rows = list(results["routes"].items()) + [("total", results["total"])]
+    for route, stats in rows:
+        print(f"{route:<28} {stats['requests']:7d} {stats['throughput']:8.1f} {stats['p50_ms']:8.1f} "
+              f"{stats['p95_ms']:8.1f} {stats['p99_ms']:8.1f} {stats['error_rate']:7.2%}")
+
+
+def compare(results, baseline, tolerance, min_requests):
+    # Returns the number of regressions: a p95 more than `tolerance` slower, or
+    # an error rate more than `tolerance` percentage points higher. Routes with
+    # fewer than `min_requests` samples in either run are too noisy to judge.
+    regressions = 0
+    current = dict(results["routes"], total=results["total"])
+    previous = dict(baseline["routes"], total=baseline["total"])
+    print(f"\ncompared with {baseline['meta'].get('commit')} ({baseline['meta'].get('started_at')}):")
+    for route, stats in current.items():
+        before = previous.get(route)
+        if before is None or min(before["requests"], stats["requests"]) < min_requests:
+            continue
+        p95_change = stats["p95_ms"] / before["p95_ms"] - 1 if before["p95_ms"] else 0.0
+        throughput_change = stats["throughput"] / before["throughput"] - 1 if before["throughput"] else 0.0
+        regressed = p95_change > tolerance or stats["error_rate"] - before["error_rate"] > tolerance / 100
+        regressions += regressed
+        print(f"{'REGRESSED' if regressed else 'ok':<10} {route:<28} p95 {p95_change:+7.1%}  "
+              f"throughput {throughput_change:+7.1%}  errors {before['error_rate']:.2%} -> {stats['error_rate']:.2%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seed", type=int, default=42)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="insert synthetic data")
+    seed_parser.add_argument("--users", type=int, default=1000)
+    seed_parser.add_argument("--posts", type=int, default=5000)
+    seed_parser.add_argument("--comments", type=int, default=50000)
+    seed_parser.add_argument("--votes", type=int, default=100000)
+    seed_parser.add_argument("--depth", type=int, default=20, help="deepest reply chain")
+
+    run_parser = commands.add_parser("run", help="replay a traffic mix against a server")
+    run_parser.add_argument("--url", default="http://127.0.0.1:5000")
+    run_parser.add_argument("--mix", choices=sorted(MIXES), default="mixed")
+    run_parser.add_argument("--concurrency", type=int, default=16)
+    run_parser.add_argument("--duration", type=float, default=30, help="seconds")
+    run_parser.add_argument("--requests", type=int, default=0, help="stop after this many operations")
+    run_parser.add_argument("--output", help="write results as JSON to this file")
+    run_parser.add_argument("--baseline", help="results JSON to compare against")
+    run_parser.add_argument("--tolerance", type=float, default=0.2)
+    run_parser.add_argument("--min-requests", type=int, default=50,
+                            help="ignore routes with fewer samples when comparing")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**queries.db_config)
+    try:
+        if args.command == "seed":
+            started = time.perf_counter()
+            try:
+                counts = seed(conn, random.Random(args.seed), args.users, args.posts, args.comments,
+                              args.votes, args.depth)
+            except psycopg2.errors.UniqueViolation:
+                raise SystemExit(f"This database was already seeded with --seed {args.seed}; "
+                                 "use a fresh database or another seed")
+            print(f"Seeded {counts} in {time.perf_counter() - started:.1f}s")
+            return
+        fixture = Fixture(conn)
+    finally:
+        conn.close()
+
+    started_at = datetime.now().isoformat(timespec="seconds")
+    results = run(args.url, fixture, args.mix, args.concurrency, args.duration, args.requests, args.seed)
+    if results["total"] is None:
+        raise SystemExit("No requests were sent")
+    results["meta"] = {
+        "commit": git_commit(),
+        "started_at": started_at,
+        "url": args.url,
+        "mix": args.mix,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "requests": args.requests,
+        "seed": args.seed,
+        "python": platform.python_version(),
+    }
+    report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance, args.min_requests):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Feed latency with and without a concurrent login storm.
+
+Needs a server and data seeded by load_test.py:
+
+    DB_PASSWORD=... python bench/load_test.py seed
+    python app.py
+    DB_PASSWORD=... python bench/login_storm.py --readers 8 --logins 32 --duration 15
+
+First only --readers clients read /api/posts for --duration seconds. Then
+the same readers run again while --logins clients hammer /api/login. The
+output shows feed p50/p95/p99 for both phases and the login results. With
+hashing offloaded, the feed numbers should barely move, and logins past the
+hasher's queue limit should get 503s rather than slow everything down.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+
+import queries
+from load_test import Client, Fixture, Recorder, summarize
+
+
+def phase(base_url, fixture, readers, logins, duration, seed_value, login_pause=0.0):
+    recorder = Recorder()
+    deadline = time.monotonic() + duration
+
+    def worker(index, operation):
+        client = Client(base_url, fixture, random.Random(f"{seed_value}:{index}"), recorder)
+        try:
+            while time.monotonic() < deadline:
+                operation(client)
+        finally:
+            client.conn.close()
+
+    def login(client):
+        client.login()
+        time.sleep(login_pause)
+
+    threads = [threading.Thread(target=worker, args=(i, Client.feed)) for i in range(readers)]
+    threads += [threading.Thread(target=worker, args=(readers + i, login)) for i in range(logins)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {route: summarize(samples, elapsed) for route, samples in recorder.samples.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--logins", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15, help="seconds per phase")
+    parser.add_argument("--login-pause", type=float, default=0.1, help="seconds between one client's logins")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**queries.db_config)
+    try:
+        fixture = Fixture(conn)
+    finally:
+        conn.close()
+
+    quiet = phase(args.url, fixture, args.readers, 0, args.duration, args.seed)
+    storm = phase(args.url, fixture, args.readers, args.logins, args.duration, args.seed, args.login_pause)
+
+    print(f"{'':<22} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name, results in (("feed, no logins", quiet), ("feed, login storm", storm)):
+        stats = results["GET /api/posts"]
+        print(f"{name:<22} {stats['throughput']:8.1f} {stats['p50_ms']:8.1f} {stats['p95_ms']:8.1f} "
+              f"{stats['p99_ms']:8.1f} {stats['error_rate']:7.2%}")
+    logins = storm.get("POST /api/login")
+    if logins:
+        print(f"\nlogins: {logins['throughput']:.1f}/s, p50 {logins['p50_ms']:.1f} ms, "
+              f"p99 {logins['p99_ms']:.1f} ms, statuses {logins['statuses']}")
+
+
+if __name__ == "__main__":
+    main()
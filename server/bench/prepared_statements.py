@@ -0,0 +1,110 @@
+"""Per-call latency of the hot queries, sent as text vs. as prepared statements.
+
+Seeds a user with a session and a post with a small comment thread, then runs
+each registered hot statement back to back on one connection, first with
+PREPARED_STATEMENTS off and then on, and prints the mean and p95 per call.
+
+Run from the server directory against a scratch database:
+
+    DB_PASSWORD=... python bench/prepared_statements.py --iterations 2000
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+
+import app
+
+
+def setup(conn, comments):
+    cur = conn.cursor()
+    cur.execute("INSERT INTO users (username, password) VALUES (%s, 'x') RETURNING id",
+                (f"prepared_{uuid.uuid4().hex[:8]}",))
+    user_id = cur.fetchone()[0]
+    token = uuid.uuid4().hex
+    cur.execute("INSERT INTO sessions (user_id, token) VALUES (%s, %s)", (user_id, token))
+    cur.execute("INSERT INTO posts (user_id, title, content) VALUES (%s, 'prepared', 'prepared') RETURNING id",
+                (user_id,))
+    post_id = cur.fetchone()[0]
+
+    parent_id = None
+    for i in range(comments):
+        cur.execute("""
+            INSERT INTO comments (post_id, user_id, content, parent_comment_id)
+            VALUES (%s, %s, 'prepared', %s) RETURNING id
+        """, (post_id, user_id, parent_id if i % 3 else None))
+        parent_id = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    return user_id, token, post_id
+
+
+def workload(user_id, token, post_id):
+    # (statement name, params) pairs; the vote is cast twice per round so the
+    # vote table is back where it started
+    cursor = app.encode_feed_cursor("hot", 1e9, 2 ** 31 - 1)
+    return [
+        ("validate_token", app.validate_token_params(user_id, token)),
+        ("feed_hot", (app.DEFAULT_FEED_LIMIT + 1,)),
+        ("feed_hot_after", app.decode_feed_cursor(cursor, "hot") + (app.DEFAULT_FEED_LIMIT + 1,)),
+        ("thread_post", (post_id,)),
+        ("thread_top_level", app.thread_first_level_params(post_id, None, 0, app.DEFAULT_THREAD_LIMIT)),
+        ("cast_post_vote", (user_id, post_id, "upvote", True)),
+        ("cast_post_vote", (user_id, post_id, "upvote", True)),
+    ]
+
+
+def run(conn, statements, iterations):
+    timings = {}
+    cur = conn.cursor()
+    for _ in range(iterations):
+        for name, params in statements:
+            started = time.perf_counter()
+            app.statements.execute(cur, name, params)
+            cur.fetchall()
+            timings.setdefault(name, []).append(time.perf_counter() - started)
+        conn.commit()
+    cur.close()
+    return timings
+
+
+def summarize(timings):
+    result = {}
+    for name, values in timings.items():
+        ordered = sorted(values)
+        result[name] = (sum(ordered) / len(ordered), ordered[int(0.95 * (len(ordered) - 1))])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--comments", type=int, default=50)
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**app.db_config)
+    user_id, token, post_id = setup(conn, args.comments)
+    statements = workload(user_id, token, post_id)
+
+    results = {}
+    for mode, enabled in (("text", False), ("prepared", True)):
+        app.statements.enabled = enabled
+        run(conn, statements, min(100, args.iterations))  # warm up
+        results[mode] = summarize(run(conn, statements, args.iterations))
+    conn.close()
+
+    print(f"{'statement':<18} {'text mean':>10} {'prepared':>10} {'text p95':>10} {'prepared':>10}  speedup")
+    for name in results["text"]:
+        text_mean, text_p95 = results["text"][name]
+        prepared_mean, prepared_p95 = results["prepared"][name]
+        print(f"{name:<18} {text_mean * 1e6:8.1f}us {prepared_mean * 1e6:8.1f}us "
+              f"{text_p95 * 1e6:8.1f}us {prepared_p95 * 1e6:8.1f}us  {text_mean / prepared_mean:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
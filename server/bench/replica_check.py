@@ -0,0 +1,157 @@
+"""Smoke check for the ASGI server's replica reads.
+
+Starts uvicorn with DB_REPLICAS set (by default to the primary itself, which
+serves fine as a replica that is never behind), then checks that:
+
+- every replica-routed GET answers 200, with and without an X-Read-After
+  position to wait for;
+- concurrent identical searches, feed pages and thread pages share reads, so
+  the coalescing keys are stable per request.
+
+Run from the server directory, against a seeded database:
+
+    DB_PASSWORD=... python bench/replica_check.py
+    DB_PASSWORD=... python bench/replica_check.py --replica replica-host:5433
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+def get(url, headers=None):
+    # (status, parsed JSON body or None)
+    request = urllib.request.Request(url, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, None
+
+
+def wait_until_up(url, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            return False
+        try:
+            get(url + "/api/hello")
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def concurrent_gets(url, clients):
+    # All clients send the same request at once; returns their statuses
+    barrier = threading.Barrier(clients)
+    statuses = []
+
+    def client():
+        barrier.wait()
+        statuses.append(get(url)[0])
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses
+
+
+def first_post(base):
+    # A post to read, and a word from its title to search for
+    status, feed = get(base + "/api/posts?limit=1")
+    if status != 200 or not feed["posts"]:
+        raise SystemExit(f"/api/posts answered {status}, is the database seeded?")
+    post = feed["posts"][0]
+    return post, (post["title"].split() or ["post"])[0]
+
+
+def check_routes(base):
+    post, word = first_post(base)
+    failures = []
+    paths = [
+        "/api/posts?sort=new&limit=5",
+        f"/api/post/{post['id']}",
+        f"/api/post/{post['id']}?limit=5",
+        f"/api/username/{post['user_id']}",
+        f"/api/usernames?ids={post['user_id']}",
+        f"/api/search?q={urllib.parse.quote(word)}",
+    ]
+    for path in paths:
+        for headers in ({}, {"X-Read-After": "0/0"}):
+            status, _ = get(base + path, headers)
+            if status != 200:
+                failures.append(f"{path} {headers or ''} answered {status}")
+    return "; ".join(failures) or None
+
+
+def check_coalescing(base, clients):
+    post, word = first_post(base)
+    before = get(base + "/api/cache_stats")[1]["coalesced_reads"]
+    # Fresh keys, so no response comes from a cache
+    stamp = int(time.time() * 1000) % 1000 + 2
+    paths = {
+        "search": f"/api/search?q={urllib.parse.quote(word)}&limit={stamp % 90 + 5}",
+        "feed_page": f"/api/posts?sort=top&limit={stamp % 90 + 5}",
+        "thread_page": f"/api/post/{post['id']}?limit={stamp % 90 + 5}",
+    }
+    failures = []
+    for name, path in paths.items():
+        statuses = concurrent_gets(base + path, clients)
+        if set(statuses) != {200}:
+            failures.append(f"{path} answered {sorted(set(statuses))}")
+    after = get(base + "/api/cache_stats")[1]["coalesced_reads"]
+    shared = {name: after[name] - before[name] for name in paths}
+    print(f"shared reads from {clients} concurrent clients: {shared}")
+    if not any(shared.values()):
+        failures.append("no read was shared")
+    return "; ".join(failures) or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--replica", default="localhost:5432", help="DB_REPLICAS for the server")
+    parser.add_argument("--port", type=int, default=8010)
+    parser.add_argument("--clients", type=int, default=16)
+    args = parser.parse_args()
+
+    server_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, DB_REPLICAS=args.replica)
+    log = tempfile.TemporaryFile()
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(args.port)],
+                               cwd=server_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{args.port}"
+    failed = False
+    try:
+        if not wait_until_up(base, process):
+            log.seek(0)
+            print(f"FAIL server did not start:\n{log.read().decode()}")
+            sys.exit(1)
+        for name, check in (("replica routes", lambda: check_routes(base)),
+                            ("coalescing", lambda: check_coalescing(base, args.clients))):
+            result = check()
+            print(f"{'ok  ' if result is None else 'FAIL'} {name}{'' if result is None else ': ' + result}")
+            failed = failed or result is not None
+        if failed:
+            log.seek(0)
+            print(log.read().decode()[-4000:])
+    finally:
+        process.terminate()
+        process.wait()
+    if failed:
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
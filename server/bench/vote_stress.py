@@ -0,0 +1,120 @@
+"""Concurrency stress check for the voting path.
+
+Creates a batch of users with sessions plus one post and one comment, then
+fires thousands of random votes at them from many threads through
+vote_post / vote_comment. Afterwards the stored scores must equal the sum
+of the rows left in post_votes / comment_votes.
+
+Run from the server directory against a scratch database:
+
+    DB_PASSWORD=... python bench/vote_stress.py --votes 5000 --threads 32
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg2 import pool
+
+import app
+
+
+def setup(conn, users):
+    cur = conn.cursor()
+    prefix = uuid.uuid4().hex[:8]
+    accounts = []
+    for i in range(users):
+        cur.execute("INSERT INTO users (username, password) VALUES (%s, 'x') RETURNING id",
+                    (f"stress_{prefix}_{i}",))
+        user_id = cur.fetchone()[0]
+        token = uuid.uuid4().hex
+        cur.execute("INSERT INTO sessions (user_id, token) VALUES (%s, %s)", (user_id, token))
+        accounts.append((user_id, token))
+
+    cur.execute("INSERT INTO posts (user_id, title, content) VALUES (%s, 'stress', 'stress') RETURNING id",
+                (accounts[0][0],))
+    post_id = cur.fetchone()[0]
+    cur.execute("INSERT INTO comments (post_id, user_id, content) VALUES (%s, %s, 'stress') RETURNING id",
+                (post_id, accounts[0][0]))
+    comment_id = cur.fetchone()[0]
+    conn.commit()
+    cur.close()
+    return accounts, post_id, comment_id
+
+
+def check(conn, post_id, comment_id):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT p.score, COALESCE(SUM(CASE v.vote_type WHEN 'upvote' THEN 1 ELSE -1 END), 0)
+        FROM posts p LEFT JOIN post_votes v ON v.post_id = p.id
+        WHERE p.id = %s GROUP BY p.score
+    """, (post_id,))
+    post_score, post_votes = cur.fetchone()
+    cur.execute("""
+        SELECT c.score, COALESCE(SUM(CASE v.vote_type WHEN 'upvote' THEN 1 ELSE -1 END), 0)
+        FROM comments c LEFT JOIN comment_votes v ON v.comment_id = c.id
+        WHERE c.id = %s GROUP BY c.score
+    """, (comment_id,))
+    comment_score, comment_votes = cur.fetchone()
+    cur.close()
+    conn.rollback()
+    return (post_score, post_votes), (comment_score, comment_votes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--votes", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=32)
+    args = parser.parse_args()
+
+    connections = pool.ThreadedConnectionPool(1, args.threads + 1, **app.db_config)
+    conn = connections.getconn()
+    accounts, post_id, comment_id = setup(conn, args.users)
+
+    statuses = {}
+
+    def cast(_):
+        user_id, token = random.choice(accounts)
+        vote_type = random.choice(["upvote", "downvote"])
+        worker_conn = connections.getconn()
+        try:
+            if random.random() < 0.5:
+                _, status = app.vote_post(worker_conn, user_id, token, post_id, vote_type)
+            else:
+                _, status = app.vote_comment(worker_conn, user_id, token, comment_id, vote_type)
+        finally:
+            connections.putconn(worker_conn)
+        return status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        for status in executor.map(cast, range(args.votes)):
+            statuses[status] = statuses.get(status, 0) + 1
+    elapsed = time.perf_counter() - started
+
+    # In write-behind mode (VOTE_BUFFER=1) apply the outstanding score deltas
+    if app.score_buffer is not None:
+        app.score_buffer.stop()
+
+    (post_score, post_votes), (comment_score, comment_votes) = check(conn, post_id, comment_id)
+    connections.putconn(conn)
+    connections.closeall()
+
+    print(f"{args.votes} votes in {elapsed:.2f}s ({args.votes / elapsed:.0f} votes/s), statuses: {statuses}")
+    print(f"post {post_id}: score={post_score} sum(votes)={post_votes}")
+    print(f"comment {comment_id}: score={comment_score} sum(votes)={comment_votes}")
+
+    if post_score != post_votes or comment_score != comment_votes or set(statuses) != {200}:
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
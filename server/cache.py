@@ -0,0 +1,447 @@
+import asyncio
+import itertools
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+class TTLCache:
+    """Bounded in-process LRU cache whose entries also expire after `ttl` seconds.
+
+    By default `maxsize` is a number of entries. If `weigh` is given, it is
+    called on each value and `maxsize` bounds the sum of those weights
+    instead, e.g. weigh=len to bound a cache of bytes by total size.
+
+    Safe to share between request threads. Keeps hit/miss/eviction counters
+    so the cache can be observed through stats().
+    """
+
+    def __init__(self, maxsize, ttl, weigh=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh or (lambda value: 1)
+        self._data = OrderedDict()
+        self._weight = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at, weight = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self._weight -= weight
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __contains__(self, key):
+        # Whether key holds an unexpired entry, without counting a hit or miss
+        # or refreshing its LRU position
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def set(self, key, value, ttl=None):
+        weight = self.weigh(value)
+        if weight > self.maxsize:
+            # Would evict everything else and still not fit
+            self.delete(key)
+            return
+
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self._weight -= previous[2]
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl), weight)
+            self._weight += weight
+            while self._weight > self.maxsize:
+                _, (_, _, evicted_weight) = self._data.popitem(last=False)
+                self._weight -= evicted_weight
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return False
+            self._weight -= entry[2]
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._weight = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "weight": self._weight,
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class CacheBackendError(Exception):
+    """Raised by cache backends (see cache_backends.py) that could not be
+    reached; the caches below count it as a miss."""
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time: callers arriving while one is
+    in progress wait for it and share its result, or its exception, instead
+    of repeating the work."""
+
+    def __init__(self):
+        self._calls = {}  # key -> _Call in progress
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on one event loop. The call runs as a task
+    of its own, so a caller that goes away (a disconnected client) does not
+    cancel it for the others."""
+
+    def __init__(self):
+        self._calls = {}  # key -> task in progress
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key, fn):
+        task = self._calls.get(key)
+        if task is None:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._forget(key, task))
+            self.calls += 1
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+
+class SharedCounters:
+    """`slots` integer counters kept in a cache backend, so that every process
+    using the backend sees the same values.
+
+    Reads come from a copy in this process. bump() publishes the new value so
+    the copies everywhere follow it, and after a resync (see
+    cache_backends.py) the copies are reloaded from the backend. While the
+    backend cannot be reached, reads return values never returned before, so
+    nothing derived from a counter (an ETag, a cache key) matches a value
+    that may be outdated.
+    """
+
+    def __init__(self, backend, name, slots=1):
+        self.backend = backend
+        self.name = name
+        self.slots = slots
+        self._values = [None] * slots
+        self._epoch = 0  # bumped by every resync
+        self._unknown = itertools.count(-1, -1)
+        self._lock = threading.Lock()
+        backend.subscribe(name, self._on_message)
+
+    def _key(self, slot):
+        return f"{self.name}:{slot}"
+
+    def _store(self, slot, value, epoch=None):
+        # Counters only go up, and messages may overtake a load
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return value
+            current = self._values[slot]
+            if current is None or value > current:
+                self._values[slot] = value
+            return self._values[slot]
+
+    def get(self, slot=0):
+        value = self._values[slot]
+        if value is not None:
+            return value
+        epoch = self._epoch
+        try:
+            return self._store(slot, self.backend.counter(self._key(slot)), epoch)
+        except CacheBackendError:
+            with self._lock:
+                return next(self._unknown)
+
+    def bump(self, slot=0):
+        try:
+            value = self.backend.incr(self._key(slot))
+            self.backend.publish(self.name, f"{slot}:{value}")
+        except CacheBackendError:
+            with self._lock:
+                self._values[slot] = None
+            return
+        self._store(slot, value)
+
+    def _on_message(self, message):
+        if message is None:
+            with self._lock:
+                self._values = [None] * self.slots
+                self._epoch += 1
+            return
+        slot, value = message.split(":")
+        self._store(int(slot), int(value))
+
+
+class VersionCounter(SharedCounters):
+    """A counter bumped by every write that changes some view of the data, so
+    readers can tell cheaply whether that view may have changed."""
+
+    def __init__(self, backend, name):
+        super().__init__(backend, name)
+
+    @property
+    def value(self):
+        return self.get(0)
+
+    def bump(self):
+        super().bump(0)
+
+
+class SharedCache:
+    """Values kept in a cache backend as `name`:key for `ttl` seconds.
+
+    With a shared backend values pass through encode() on the way in and
+    decode() on the way out, with bytes in between; a MemoryBackend stores
+    them as they are. A backend that cannot be reached counts as a miss.
+
+    get_or_compute() keeps a hot key's misses from stampeding the database:
+    in each process one caller computes the value while the others wait for
+    it (SingleFlight), and across processes the first to take a lock in the
+    backend computes it while the rest poll for its result, for up to
+    `lock_timeout` seconds before computing it themselves.
+    """
+
+    def __init__(self, backend, name, ttl, encode=None, decode=None, lock_timeout=5.0, poll_interval=0.01):
+        self.backend = backend
+        self.name = name
+        self.ttl = ttl
+        self.encode = encode
+        self.decode = decode
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.computes = 0
+        self.lock_waits = 0
+        self.errors = 0
+
+    def _key(self, key):
+        return f"{self.name}:{key}"
+
+    def _load(self, full_key):
+        try:
+            value = self.backend.get(full_key)
+        except CacheBackendError:
+            self.errors += 1
+            return None
+        if value is not None and self.backend.shared:
+            value = self.decode(value)
+        return value
+
+    def _store(self, full_key, value, ttl=None):
+        if self.backend.shared:
+            value = self.encode(value)
+        try:
+            self.backend.set(full_key, value, self.ttl if ttl is None else min(ttl, self.ttl))
+        except CacheBackendError:
+            self.errors += 1
+
+    def _lookup(self, full_key, default=None):
+        value = self._load(full_key)
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def get(self, key, default=None):
+        return self._lookup(self._key(key), default)
+
+    def set(self, key, value, ttl=None):
+        # ttl shortens the cache's own for this entry, it never extends it
+        self._store(self._key(key), value, ttl)
+
+    def delete(self, key):
+        try:
+            self.backend.delete(self._key(key))
+        except CacheBackendError:
+            self.errors += 1
+
+    def get_or_compute(self, key, compute):
+        """The value cached for key, or compute()'s result, stored unless it
+        is None."""
+        return self._get_or_compute(self._key(key), compute)
+
+    def _get_or_compute(self, full_key, compute):
+        value = self._lookup(full_key)
+        if value is not None:
+            return value
+        return self.flight.do(full_key, lambda: self._compute(full_key, compute))
+
+    def _compute(self, full_key, compute):
+        lock_key = full_key + ":lock"
+        try:
+            locked = self.backend.add(lock_key, b"1", self.lock_timeout)
+        except CacheBackendError:
+            self.errors += 1
+            locked = None
+
+        if locked is False:
+            # Another process is computing it
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(self.poll_interval)
+                value = self._load(full_key)
+                if value is not None:
+                    self.lock_waits += 1
+                    return value
+                try:
+                    if self.backend.get(lock_key) is None:
+                        break  # it gave up without storing anything
+                except CacheBackendError:
+                    break
+
+        try:
+            self.computes += 1
+            value = compute()
+            if value is not None:
+                self._store(full_key, value)
+            return value
+        finally:
+            if locked:
+                try:
+                    self.backend.delete(lock_key)
+                except CacheBackendError:
+                    self.errors += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            **self.backend.stats(),
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "computes": self.computes,
+            "coalesced": self.flight.shared,
+            "lock_waits": self.lock_waits,
+            "errors": self.errors,
+        }
+
+
+class RenderCache(SharedCache):
+    """SharedCache for rendered responses that can be invalidated while a
+    render is still in progress.
+
+    Entries are stored under their key's current generation, a SharedCounter:
+    invalidate(key) moves the key to a new generation in every process using
+    the backend, and whatever was stored, or is still being rendered, under
+    the old one is never read again. Callers take a ticket with begin(key)
+    before reading from the database and pass it back to set(), or let
+    get_or_compute() do both. Generations are kept in a fixed number of
+    slots shared by hashing, so an unrelated key is now and then invalidated
+    too but the counters stay bounded.
+    """
+
+    def __init__(self, backend, name, ttl, encode=None, decode=None, slots=1024, **kwargs):
+        super().__init__(backend, name, ttl, encode, decode, **kwargs)
+        self.generations = SharedCounters(backend, f"{name}:gen", slots)
+
+    def _slot(self, key):
+        # Unlike hash(), the same in every process
+        return zlib.crc32(str(key).encode()) % self.generations.slots
+
+    def _versioned_key(self, key, ticket):
+        return f"{self.name}:{key}:{ticket}"
+
+    def begin(self, key):
+        return self.generations.get(self._slot(key))
+
+    def version(self, key):
+        """A value that changes whenever key is invalidated (and, now and
+        then, when a key sharing its slot is)."""
+        return self.begin(key)
+
+    def get(self, key, default=None):
+        return self._lookup(self._versioned_key(key, self.begin(key)), default)
+
+    def set(self, key, value, ticket):
+        if self.begin(key) != ticket:
+            return False
+        self._store(self._versioned_key(key, ticket), value)
+        return True
+
+    def get_or_compute(self, key, compute):
+        return self._get_or_compute(self._versioned_key(key, self.begin(key)), compute)
+
+    def invalidate(self, key):
+        slot = self._slot(key)
+        old_key = self._versioned_key(key, self.generations.get(slot))
+        self.generations.bump(slot)
+        try:
+            # Unreachable now; free it rather than wait for the TTL
+            self.backend.delete(old_key)
+        except CacheBackendError:
+            self.errors += 1
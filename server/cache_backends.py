@@ -0,0 +1,223 @@
+"""Where cached values live.
+
+The caches in cache.py keep their entries in a backend: MemoryBackend holds
+them in this process, RedisBackend in a Redis server (or anything speaking
+its protocol) shared by every worker and node. Either way a backend offers
+the same few operations:
+
+    get(key)                  the value, or None
+    set(key, value, ttl)
+    add(key, value, ttl)      set only if absent; True if it was set
+    delete(key)
+    counter(key) / incr(key)  integer counters that never expire
+    publish(channel, message) / subscribe(channel, callback)
+
+Subscribers are called with every message published on their channel, by
+any process, and with None when messages may have been missed (the
+subscription had to reconnect), after which they should reload whatever they
+derived from earlier messages.
+
+Values of a `shared` backend are bytes; MemoryBackend stores Python objects
+as they are.
+"""
+import threading
+import uuid
+
+from cache import CacheBackendError, TTLCache
+
+# redis is optional; it is only needed with CACHE_URL set
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class MemoryBackend:
+    """A backend private to this process: entries in a TTLCache bounded by
+    `maxsize` (see TTLCache for `weigh`), messages delivered in-process."""
+
+    shared = False
+
+    def __init__(self, maxsize, weigh=None):
+        self.cache = TTLCache(maxsize, ttl=0, weigh=weigh)
+        self._counters = {}
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def add(self, key, value, ttl):
+        with self._lock:
+            if key in self.cache:
+                return False
+            self.cache.set(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters[key] = self._counters.get(key, 0) + 1
+            return value
+
+    def publish(self, channel, message):
+        with self._lock:
+            callbacks = list(self._subscribers.get(channel, ()))
+        for callback in callbacks:
+            callback(message)
+
+    def subscribe(self, channel, callback):
+        with self._lock:
+            self._subscribers.setdefault(channel, []).append(callback)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def stats(self):
+        stats = self.cache.stats()
+        return {"backend": "memory", **{key: stats[key] for key in ("size", "weight", "maxsize", "evictions")}}
+
+
+class RedisBackend:
+    """A backend in a Redis server at `url` (redis://host:port/db), with
+    every key prefixed by `prefix` so several deployments can share one.
+
+    Counters are stored without a TTL, so a maxmemory-policy of
+    volatile-lru (or any volatile-* policy) never evicts them; losing one
+    would let an old generation's entries be read again. A server that
+    restarts empty is noticed (see epoch()), but one flushed while servers
+    run is not: restart them afterwards.
+
+    subscribe() must be called before start(), which runs the thread that
+    receives messages.
+    """
+
+    shared = True
+
+    def __init__(self, url, prefix="blueddit:", socket_timeout=1.0, reconnect_delay=1.0):
+        if redis is None:
+            raise RuntimeError("CACHE_URL needs the redis package (pip install redis)")
+        self.url = url
+        self.prefix = prefix
+        self.reconnect_delay = reconnect_delay
+        self.client = redis.Redis.from_url(url, socket_timeout=socket_timeout,
+                                           socket_connect_timeout=socket_timeout)
+        self._subscribers = {}
+        self._stopped = threading.Event()
+        self._thread = None
+        self._epoch = None
+        self.errors = 0
+        self.resyncs = 0
+
+    def _call(self, method, *args, **kwargs):
+        try:
+            return getattr(self.client, method)(*args, **kwargs)
+        except redis.RedisError as e:
+            self.errors += 1
+            raise CacheBackendError(str(e)) from e
+
+    def get(self, key):
+        return self._call("get", self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self._call("set", self.prefix + key, value, px=max(int(ttl * 1000), 1))
+
+    def add(self, key, value, ttl):
+        return bool(self._call("set", self.prefix + key, value, px=max(int(ttl * 1000), 1), nx=True))
+
+    def delete(self, key):
+        self._call("delete", self.prefix + key)
+
+    def counter(self, key):
+        return int(self._call("get", self.prefix + key) or 0)
+
+    def incr(self, key):
+        return self._call("incr", self.prefix + key)
+
+    def publish(self, channel, message):
+        self._call("publish", self.prefix + channel, message)
+
+    def epoch(self):
+        """An id for the server's current contents, the same in every process,
+        that changes when the server comes back empty. Counters start over
+        then, so anything derived from them, like an ETag, should include
+        it."""
+        epoch = self._epoch
+        if epoch is None:
+            key = self.prefix + "epoch"
+            self._call("set", key, uuid.uuid4().hex[:8], nx=True)
+            epoch = self._epoch = self._call("get", key).decode()
+        return epoch
+
+    def subscribe(self, channel, callback):
+        self._subscribers.setdefault(self.prefix + channel, []).append(callback)
+
+    def _deliver(self, channel, message):
+        for callback in self._subscribers.get(channel, ()):
+            try:
+                callback(message)
+            except Exception as e:
+                print(f"Error handling cache message: {e}")
+
+    def _resync(self):
+        self.resyncs += 1
+        self._epoch = None
+        for channel in self._subscribers:
+            self._deliver(channel, None)
+
+    def _listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(*self._subscribers)
+            # Anything read before the subscription took effect may have
+            # missed a message, including on the first connect
+            self._resync()
+            while not self._stopped.is_set():
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None and message["type"] == "message":
+                    self._deliver(message["channel"].decode(), message["data"].decode())
+        finally:
+            pubsub.close()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._listen()
+            except redis.RedisError as e:
+                print(f"Cache subscription lost: {e}")
+                # Until we are back, updates go unseen
+                self._resync()
+                self._stopped.wait(self.reconnect_delay)
+
+    def start(self):
+        if self._thread is None and self._subscribers:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="cache-subscriber", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.client.close()
+
+    def stats(self):
+        stats = {"backend": "redis", "errors": self.errors, "resyncs": self.resyncs}
+        try:
+            stats["size"] = self.client.dbsize()
+        except redis.RedisError:
+            stats["size"] = None
+        return stats
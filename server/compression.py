@@ -0,0 +1,123 @@
+"""Response compression negotiated from Accept-Encoding.
+
+Feed and thread responses are large, repetitive JSON that gzip shrinks
+several-fold. Bodies under a size threshold are sent as they are; below about
+a kilobyte the framing overhead eats most of the saving.
+"""
+import gzip
+import struct
+
+# brotli is optional; when it is installed it is preferred over gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Dynamic content is compressed on every cache miss, so these trade a little
+# ratio for speed; the maximum levels cost several times the CPU
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# In order of preference
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+COMPRESSIBLE_TYPES = ("application/json", "text/plain")
+
+
+def choose_encoding(accept_encoding):
+    """The encoding to use for a request's Accept-Encoding header, or None to
+    send the body as it is. q-values only rule encodings out (q=0); among the
+    acceptable ones our own preference wins."""
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    raise ValueError(f"Unsupported encoding {encoding!r}")
+
+
+def should_compress(status, content_type, content_encoding, size, min_size):
+    return (status == 200 and not content_encoding and size >= min_size
+            and (content_type or "").split(";")[0].strip() in COMPRESSIBLE_TYPES)
+
+
+def encoded_etag(etag, encoding):
+    # Each encoding is a different representation, so it needs its own strong
+    # ETag: "abc" becomes "abc-gzip"
+    if not etag or encoding is None:
+        return etag
+    return etag[:-1] + "-" + encoding + '"'
+
+
+class PrecompressedBody:
+    """A rendered JSON body together with its compressed variants, built once
+    when the body is rendered so that cache hits only pick one.
+
+    len() is the total size of all variants, for use as a cache weight.
+    pack() and unpack() turn it into bytes and back, for shared caches.
+    """
+
+    __slots__ = ("body", "variants")
+
+    def __init__(self, body, min_size):
+        self.body = body
+        self.variants = {}
+        if len(body) >= min_size:
+            self.variants = {encoding: compress(body, encoding) for encoding in ENCODINGS}
+
+    def encoded(self, encoding):
+        # Returns (body, encoding actually used)
+        variant = self.variants.get(encoding)
+        if variant is None:
+            return self.body, None
+        return variant, encoding
+
+    def __len__(self):
+        return len(self.body) + sum(len(variant) for variant in self.variants.values())
+
+    # Each part is a header (encoding name length, data length), the name and
+    # the data; the body comes first, with an empty name
+    _PART_HEADER = struct.Struct("!BI")
+
+    def pack(self):
+        parts = [(b"", self.body)] + [(encoding.encode(), data) for encoding, data in self.variants.items()]
+        return b"".join(self._PART_HEADER.pack(len(name), len(data)) + name + data for name, data in parts)
+
+    @classmethod
+    def unpack(cls, packed):
+        body = cls.__new__(cls)
+        body.body = None
+        body.variants = {}
+        offset = 0
+        while offset < len(packed):
+            name_size, data_size = cls._PART_HEADER.unpack_from(packed, offset)
+            offset += cls._PART_HEADER.size
+            name = packed[offset:offset + name_size].decode()
+            offset += name_size
+            data = packed[offset:offset + data_size]
+            offset += data_size
+            if body.body is None:
+                body.body = data
+            else:
+                body.variants[name] = data
+        return body
@@ -0,0 +1,180 @@
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool.
+
+    getconn() waits up to `timeout` seconds for a connection when all
+    `maxconn` are checked out instead of failing straight away. Connections
+    are checked on the way in and out: broken ones are discarded and
+    replaced, ones left inside a transaction are rolled back, and ones idle
+    for longer than `healthcheck_after` seconds are pinged before reuse.
+
+    stats() reports in-use/idle gauges plus wait and checkout timings.
+    """
+
+    def __init__(self, minconn, maxconn, timeout=10.0, healthcheck_after=30.0, **db_config):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+        self.db_config = db_config
+
+        self._idle = []  # (connection, returned_at), most recently returned last
+        self._checked_out = {}  # id(connection) -> checked out at
+        self._opening = 0
+        self._waiting = 0
+        self._cond = threading.Condition()
+
+        self.waits = 0
+        self.queued = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+        self.checkouts = 0
+        self.checkout_time = 0.0
+        self.max_checkout_time = 0.0
+        self.created = 0
+        self.discarded = 0
+
+        for _ in range(minconn):
+            self._idle.append((psycopg2.connect(**db_config), time.monotonic()))
+            self.created += 1
+
+    def _size(self):
+        return len(self._idle) + len(self._checked_out) + self._opening
+
+    def _healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.healthcheck_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        with self._cond:
+            if not self._idle and self._size() >= self.maxconn:
+                self.queued += 1
+            while not self._idle and self._size() >= self.maxconn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout(f"no connection available within {timeout:.1f}s")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            if self._idle:
+                conn, returned_at = self._idle.pop()
+            else:
+                conn, returned_at = None, None
+            # Reserve the slot while we check or open outside the lock
+            self._opening += 1
+
+        discarded = created = 0
+        try:
+            if conn is not None and not self._healthy(conn, time.monotonic() - returned_at):
+                self._close(conn)
+                conn = None
+                discarded = 1
+            if conn is None:
+                conn = psycopg2.connect(**self.db_config)
+                created = 1
+        except psycopg2.Error:
+            with self._cond:
+                self._opening -= 1
+                self.discarded += discarded
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._opening -= 1
+            self.discarded += discarded
+            self.created += created
+            now = time.monotonic()
+            self._checked_out[id(conn)] = now
+            waited = now - started
+            self.waits += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            return conn
+
+    def putconn(self, conn):
+        status = conn.get_transaction_status() if not conn.closed else None
+        keep = status is not None and status != psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+        if keep and status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # Left inside a (possibly aborted) transaction
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                keep = False
+
+        with self._cond:
+            checked_out_at = self._checked_out.pop(id(conn), None)
+            if checked_out_at is not None:
+                held = time.monotonic() - checked_out_at
+                self.checkouts += 1
+                self.checkout_time += held
+                self.max_checkout_time = max(self.max_checkout_time, held)
+
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                self._close(conn)
+                self.discarded += 1
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                conn.close()
+            self._idle.clear()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "in_use": len(self._checked_out),
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "max": self.maxconn,
+                "waits": self.waits,
+                "queued": self.queued,
+                "wait_time_total": self.wait_time,
+                "wait_time_avg": self.wait_time / self.waits if self.waits else 0.0,
+                "wait_time_max": self.max_wait_time,
+                "timeouts": self.timeouts,
+                "checkouts": self.checkouts,
+                "checkout_time_total": self.checkout_time,
+                "checkout_time_avg": self.checkout_time / self.checkouts if self.checkouts else 0.0,
+                "checkout_time_max": self.max_checkout_time,
+                "created": self.created,
+                "discarded": self.discarded,
+            }
@@ -0,0 +1,290 @@
+"""Real-time thread updates over Postgres LISTEN/NOTIFY.
+
+Write paths publish an event with notify() inside their transaction, so it
+reaches listeners only if, and once, the write commits. Each server process
+holds a single LISTEN connection (PostEvents) and fans every notification
+out to the viewers of that post, which receive ready-to-send Server-Sent
+Events frames. Thousands of viewers of one thread cost one database
+connection per process, and one JSON parse and frame per event.
+
+Event types, each with "post_id", an "event_id" the writer also returns to
+its client so it can ignore the echo of its own write, and the "txid" of the
+writing transaction (added by the NOTIFY statement itself):
+
+    comment_created  {"comment": {...}} shaped like a comment in a thread page
+    score_changed    {"kind": "post" | "comment", "id": ..., "delta": ...}
+    post_created     {"post": {...}} shaped like a post in a feed page
+    resync           events may have been lost (listener reconnect, slow
+                     viewer); refetch the thread
+
+Besides the viewers of one post, watchers see every event as a dict, and a
+{"type": "resync"} after a reconnect; ranked_feed.RankedFeed is kept up to
+date this way.
+"""
+import asyncio
+import json
+import queue
+import select
+import threading
+import uuid
+
+from serialization import dumps
+
+CHANNEL = "post_events"
+# Appends "txid" to the JSON object in the payload
+WITH_TXID = """left({payload}, -1) || ',"txid":' || pg_current_xact_id()::TEXT || '}}'"""
+NOTIFY_QUERY = f"SELECT pg_notify('{CHANNEL}', {WITH_TXID.format(payload='%s')});"
+NOTIFY_MANY_QUERY = (f"SELECT pg_notify('{CHANNEL}', {WITH_TXID.format(payload='payload')}) "
+                     f"FROM unnest(%s::TEXT[]) AS payload;")
+
+# NOTIFY payloads must stay under 8000 bytes, txid included
+MAX_PAYLOAD = 7900
+
+RESYNC_FRAME = b"event: resync\ndata: {}\n\n"
+KEEPALIVE_FRAME = b": keepalive\n\n"
+
+
+def new_event_id():
+    return uuid.uuid4().hex
+
+
+def event_payload(post_id, event_type, event_id, **data):
+    event = {"type": event_type, "post_id": int(post_id), "event_id": event_id, **data}
+    payload = dumps(event)
+    for key in ("comment", "post"):
+        if len(payload) > MAX_PAYLOAD and key in data:
+            # Only long content can overflow; readers fetch it themselves
+            event[key] = {**data[key], "content": None, "truncated": True}
+            payload = dumps(event)
+    return payload.decode()
+
+
+def notify(cursor, post_id, event_type, event_id, **data):
+    """Publish an event on the cursor's connection. Delivered on commit."""
+    cursor.execute(NOTIFY_QUERY, (event_payload(post_id, event_type, event_id, **data),))
+
+
+def notify_many(cursor, payloads):
+    """Publish event_payload() results in one statement, in order."""
+    cursor.execute(NOTIFY_MANY_QUERY, (payloads,))
+
+
+class PostEvents:
+    """Background thread holding this process's LISTEN connection.
+
+    `connect` returns a new (non-pooled) psycopg2 connection. Subscribers are
+    callables taking one SSE frame (bytes); they run on the listener thread
+    and must not block. After the connection drops and comes back, every
+    subscriber gets a resync frame, as notifications sent in between are lost.
+    """
+
+    def __init__(self, connect, reconnect_delay=1.0):
+        self.connect = connect
+        self.reconnect_delay = reconnect_delay
+        self._subscribers = {}  # post_id -> set of callbacks
+        self._watchers = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.notifications = 0
+        self.deliveries = 0
+        self.reconnects = 0
+
+    def subscribe(self, post_id, callback):
+        with self._lock:
+            self._subscribers.setdefault(post_id, set()).add(callback)
+
+    def unsubscribe(self, post_id, callback):
+        with self._lock:
+            callbacks = self._subscribers.get(post_id)
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._subscribers[post_id]
+
+    def watch(self, callback):
+        """Call callback(event) with every event, for all posts."""
+        with self._lock:
+            self._watchers.append(callback)
+
+    def _deliver(self, callbacks, frame):
+        for callback in callbacks:
+            try:
+                callback(frame)
+            except Exception as e:
+                print(f"Error delivering post event: {e}")
+        self.deliveries += len(callbacks)
+
+    def dispatch(self, payload):
+        self.notifications += 1
+        try:
+            event = json.loads(payload)
+            post_id = int(event["post_id"])
+            frame = f"event: {event['type']}\ndata: {payload}\n\n".encode()
+        except (ValueError, KeyError, TypeError):
+            return
+        with self._lock:
+            callbacks = list(self._subscribers.get(post_id, ()))
+            watchers = list(self._watchers)
+        self._watch(watchers, event)
+        self._deliver(callbacks, frame)
+
+    def _watch(self, watchers, event):
+        for watcher in watchers:
+            try:
+                watcher(event)
+            except Exception as e:
+                print(f"Error handling post event: {e}")
+
+    def _resync_all(self):
+        with self._lock:
+            callbacks = [callback for callbacks in self._subscribers.values() for callback in callbacks]
+            watchers = list(self._watchers)
+        self._watch(watchers, {"type": "resync"})
+        self._deliver(callbacks, RESYNC_FRAME)
+
+    def _listen(self, conn):
+        conn.autocommit = True
+        cur = conn.cursor()
+        try:
+            cur.execute(f"LISTEN {CHANNEL};")
+        finally:
+            cur.close()
+        while not self._stopped.is_set():
+            # Wake up now and then to notice stop()
+            if select.select([conn], [], [], 1.0) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                self.dispatch(conn.notifies.pop(0).payload)
+
+    def _run(self):
+        connected_before = False
+        while not self._stopped.is_set():
+            try:
+                conn = self.connect()
+            except Exception as e:
+                print(f"Post events listener could not connect: {e}")
+                self._stopped.wait(self.reconnect_delay)
+                continue
+            try:
+                if connected_before:
+                    self.reconnects += 1
+                    self._resync_all()
+                connected_before = True
+                self._listen(conn)
+            except Exception as e:
+                print(f"Post events listener lost its connection: {e}")
+                self._stopped.wait(self.reconnect_delay)
+            finally:
+                conn.close()
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="post-events", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            subscribers = sum(len(callbacks) for callbacks in self._subscribers.values())
+            posts = len(self._subscribers)
+        return {
+            "posts": posts,
+            "subscribers": subscribers,
+            "notifications": self.notifications,
+            "deliveries": self.deliveries,
+            "reconnects": self.reconnects,
+        }
+
+
+class Subscription:
+    """One viewer's stream of frames for a thread-per-request server.
+
+    Frames wait in a queue of at most `maxsize`; a viewer that falls that far
+    behind has its backlog dropped and gets a resync frame instead, so a slow
+    client never holds up the listener or grows without bound. The viewer is
+    subscribed while frames() is being iterated.
+    """
+
+    def __init__(self, events, post_id, maxsize=64, heartbeat=15.0):
+        self.events = events
+        self.post_id = post_id
+        self.heartbeat = heartbeat
+        self._frames = queue.Queue(maxsize)
+        self._overflowed = threading.Event()
+
+    def put(self, frame):
+        try:
+            self._frames.put_nowait(frame)
+        except queue.Full:
+            self._overflowed.set()
+
+    def frames(self):
+        # Comments (keepalives) every `heartbeat` seconds keep proxies from
+        # timing the stream out and reveal clients that went away
+        self.events.subscribe(self.post_id, self.put)
+        try:
+            while True:
+                if self._overflowed.is_set():
+                    while not self._frames.empty():
+                        self._frames.get_nowait()
+                    self._overflowed.clear()
+                    yield RESYNC_FRAME
+                try:
+                    yield self._frames.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield KEEPALIVE_FRAME
+        finally:
+            self.close()
+
+    def close(self):
+        self.events.unsubscribe(self.post_id, self.put)
+
+
+class AsyncSubscription:
+    """Subscription for an asyncio server: frames are handed from the listener
+    thread to the subscriber's event loop."""
+
+    def __init__(self, events, post_id, maxsize=64, heartbeat=15.0):
+        self.events = events
+        self.post_id = post_id
+        self.heartbeat = heartbeat
+        self._loop = asyncio.get_running_loop()
+        self._frames = asyncio.Queue(maxsize)
+        self._overflowed = False
+
+    def put(self, frame):
+        # Called on the listener thread
+        self._loop.call_soon_threadsafe(self._put, frame)
+
+    def _put(self, frame):
+        try:
+            self._frames.put_nowait(frame)
+        except asyncio.QueueFull:
+            self._overflowed = True
+
+    async def frames(self):
+        self.events.subscribe(self.post_id, self.put)
+        try:
+            while True:
+                if self._overflowed:
+                    while not self._frames.empty():
+                        self._frames.get_nowait()
+                    self._overflowed = False
+                    yield RESYNC_FRAME
+                try:
+                    yield await asyncio.wait_for(self._frames.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield KEEPALIVE_FRAME
+        finally:
+            self.close()
+
+    def close(self):
+        self.events.unsubscribe(self.post_id, self.put)
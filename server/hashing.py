@@ -0,0 +1,118 @@
+import asyncio
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """Runs the password KDF in a pool of worker processes.
+
+    Hashing is deliberately slow; doing it on a request thread blocks that
+    thread, and the GIL-bound parts slow every other one. Here at most
+    `workers` hashes run at once and at most `max_queue` more wait for a
+    worker. Anything beyond that raises HasherBusy straight away, so a login
+    storm gets quick 503s instead of an ever-growing backlog. Callers should
+    not hold a database connection while they wait.
+
+    start() forks the workers; call it before starting any threads. Both
+    blocking (hash/verify) and asyncio (hash_async/verify_async) entry points
+    are provided.
+    """
+
+    def __init__(self, workers=2, max_queue=32, timeout=30.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.hash_time = 0.0
+
+    def _new_executor(self):
+        # fork rather than spawn: spawned workers would re-import the server's
+        # main module, pools and all
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"))
+
+    def start(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = self._new_executor()
+                # Forking happens on first submit
+                self._executor.submit(int).result()
+
+    def stop(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self.rejected += 1
+            raise HasherBusy(f"{self.workers + self.max_queue} password hashes already in progress")
+
+        with self._stats_lock:
+            self.in_flight += 1
+        started = time.perf_counter()
+
+        def done(_):
+            self._slots.release()
+            with self._stats_lock:
+                self.in_flight -= 1
+                self.completed += 1
+                self.hash_time += time.perf_counter() - started
+
+        try:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = self._new_executor()
+                try:
+                    future = self._executor.submit(fn, *args)
+                except BrokenProcessPool:
+                    # A worker died; replace the pool and try once more
+                    self._executor.shutdown(wait=False)
+                    self._executor = self._new_executor()
+                    future = self._executor.submit(fn, *args)
+        except BaseException:
+            done(None)
+            raise
+        future.add_done_callback(done)
+        return future
+
+    def hash(self, password):
+        return self._submit(generate_password_hash, password).result(self.timeout)
+
+    def verify(self, password_hash, password):
+        return self._submit(check_password_hash, password_hash, password).result(self.timeout)
+
+    async def hash_async(self, password):
+        return await asyncio.wait_for(asyncio.wrap_future(self._submit(generate_password_hash, password)),
+                                      self.timeout)
+
+    async def verify_async(self, password_hash, password):
+        return await asyncio.wait_for(
+            asyncio.wrap_future(self._submit(check_password_hash, password_hash, password)), self.timeout)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "hash_time_avg": self.hash_time / self.completed if self.completed else 0.0,
+            }
@@ -0,0 +1,234 @@
+"""Per-request instrumentation.
+
+RequestMetrics.begin() starts collecting for the current request (thread or
+asyncio task) and finish() folds what was collected into Prometheus-style
+counters and histograms. In between, the record_* hooks below are called by
+the code that does the work: TimedCursor for every query, get_db_connection
+for pool waits and serialization.dumps for encoding time. Outside a request
+the hooks do nothing.
+"""
+import contextvars
+import logging
+import random
+import threading
+import time
+
+import psycopg2.extensions
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+slow_request_log = logging.getLogger("blueddit.slow_requests")
+# Errors a route answers with a 500, with their traceback
+error_log = logging.getLogger("blueddit.errors")
+
+_current = contextvars.ContextVar("request_stats", default=None)
+
+
+class RequestStats:
+    __slots__ = ("method", "route", "started", "queries", "pool_wait", "serialization")
+
+    def __init__(self, method, route):
+        self.method = method
+        self.route = route
+        self.started = time.perf_counter()
+        self.queries = []  # (label, seconds)
+        self.pool_wait = 0.0
+        self.serialization = 0.0
+
+
+def record_query(label, seconds):
+    stats = _current.get()
+    if stats is not None:
+        stats.queries.append((label, seconds))
+
+def record_pool_wait(seconds):
+    stats = _current.get()
+    if stats is not None:
+        stats.pool_wait += seconds
+
+def record_serialization(seconds):
+    stats = _current.get()
+    if stats is not None:
+        stats.serialization += seconds
+
+
+def query_label(query):
+    # A low-cardinality name for a query: the statement name for EXECUTE of a
+    # prepared statement, otherwise the leading keyword (select, insert, ...)
+    if isinstance(query, bytes):
+        query = query[:128].decode(errors="replace")
+    words = query.split(None, 2)
+    if not words:
+        return "empty"
+    keyword = words[0].lower()
+    if keyword == "execute" and len(words) > 1:
+        return words[1].split("(")[0]
+    return keyword
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """psycopg2 cursor that reports each execute() to the current request.
+    Pass it as cursor_factory when connecting."""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            if not isinstance(query, (str, bytes)):
+                query = query.as_string(self)
+            record_query(query_label(query), time.perf_counter() - started)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+               for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labelvalues, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(dict(zip(self.labelnames, labelvalues)))} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}  # labelvalues -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labelvalues, series in sorted(self._series.items()):
+                labels = dict(zip(self.labelnames, labelvalues))
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_format_labels(dict(labels, le=bound))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(dict(labels, le='+Inf'))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {series[-1]}")
+        return lines
+
+
+class RequestMetrics:
+    """Request, query, pool-wait and serialization metrics for one process.
+
+    Requests slower than slow_threshold seconds are logged with their query
+    breakdown to the "blueddit.slow_requests" logger, a sample_rate fraction
+    of them; slow_threshold=None turns the log off. Gauges that are read on
+    demand (pool and cache sizes) are added with add_gauge().
+    """
+
+    def __init__(self, slow_threshold=None, sample_rate=1.0):
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.requests = Counter("blueddit_http_requests_total", "HTTP requests handled.",
+                                ("method", "route", "status"))
+        self.latency = Histogram("blueddit_http_request_duration_seconds", "Time to handle a request.",
+                                 ("method", "route"))
+        self.db_time = Histogram("blueddit_request_db_seconds", "Time spent in queries per request.",
+                                 ("method", "route"))
+        self.query_count = Histogram("blueddit_request_queries", "Queries executed per request.",
+                                     ("method", "route"), buckets=QUERY_COUNT_BUCKETS)
+        self.query_time = Histogram("blueddit_db_query_duration_seconds", "Time per query.", ("query",))
+        self.pool_wait = Histogram("blueddit_db_pool_wait_seconds", "Time waiting for a pooled connection.",
+                                   ("route",))
+        self.serialization = Histogram("blueddit_serialization_seconds", "Time encoding responses per request.",
+                                       ("route",))
+        self.slow_requests = Counter("blueddit_slow_requests_total", "Requests over the slow threshold.",
+                                     ("route",))
+        self._metrics = [self.requests, self.latency, self.db_time, self.query_count, self.query_time,
+                         self.pool_wait, self.serialization, self.slow_requests]
+        self._gauges = []
+
+    def begin(self, method, route):
+        _current.set(RequestStats(method, route))
+
+    def finish(self, status, route=None):
+        # route overrides the one given to begin(), for servers that only know
+        # the matched route once the request has been handled
+        stats = _current.get()
+        if stats is None:
+            return
+        _current.set(None)
+        if route is not None:
+            stats.route = route
+        elapsed = time.perf_counter() - stats.started
+
+        db_time = sum(seconds for _, seconds in stats.queries)
+        self.requests.inc(stats.method, stats.route, str(status))
+        self.latency.observe(elapsed, stats.method, stats.route)
+        self.db_time.observe(db_time, stats.method, stats.route)
+        self.query_count.observe(len(stats.queries), stats.method, stats.route)
+        for label, seconds in stats.queries:
+            self.query_time.observe(seconds, label)
+        self.pool_wait.observe(stats.pool_wait, stats.route)
+        self.serialization.observe(stats.serialization, stats.route)
+
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self.slow_requests.inc(stats.route)
+            if random.random() < self.sample_rate:
+                self._log_slow(stats, status, elapsed, db_time)
+
+    def _log_slow(self, stats, status, elapsed, db_time):
+        by_query = {}
+        for label, seconds in stats.queries:
+            count, total = by_query.get(label, (0, 0.0))
+            by_query[label] = (count + 1, total + seconds)
+        breakdown = ", ".join(f"{label} {count}x {total * 1000:.1f}ms" for label, (count, total)
+                              in sorted(by_query.items(), key=lambda item: -item[1][1]))
+        slow_request_log.warning(
+            "slow request %s %s %s %.1fms: %d queries %.1fms (%s), pool wait %.1fms, serialization %.1fms",
+            stats.method, stats.route, status, elapsed * 1000, len(stats.queries), db_time * 1000,
+            breakdown or "none", stats.pool_wait * 1000, stats.serialization * 1000)
+
+    def add_gauge(self, name, help, read, labelname=None):
+        # read() returns a number, or a {label value: number} dict with labelname
+        self._gauges.append((name, help, read, labelname))
+
+    def render(self):
+        """The Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, help, read, labelname in self._gauges:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+            value = read()
+            if labelname is None:
+                lines.append(f"{name} {value}")
+            else:
+                for label, item in sorted(value.items()):
+                    lines.append(f"{name}{_format_labels({labelname: label})} {item}")
+        return "\n".join(lines) + "\n"
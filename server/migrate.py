@@ -0,0 +1,199 @@
+"""Versioned schema migrations.
+
+Migrations are the numbered SQL files in migrations/ (NNNN_description.sql),
+applied in order, each in its own transaction, and recorded in the
+schema_migrations table so every file runs exactly once per database.
+
+    python migrate.py            # apply pending migrations
+    python migrate.py status     # list applied and pending migrations
+    python migrate.py check      # EXPLAIN the hot queries, fail on seq scans
+
+A new database is set up with plain `python migrate.py`.
+"""
+import argparse
+import os
+import re
+import sys
+from datetime import datetime
+
+import psycopg2
+
+from queries import (
+    db_config,
+    statements,
+    SESSION_TTL,
+    validate_token_params,
+    FEED_SORTS,
+    DEFAULT_FEED_LIMIT,
+    DEFAULT_THREAD_LIMIT,
+    thread_first_level_params,
+    thread_replies_params,
+    SEARCH_TYPES,
+    DEFAULT_SEARCH_LIMIT,
+)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_FILE = re.compile(r"^(\d+)_(\w+)\.sql$")
+
+# Arbitrary key for pg_advisory_xact_lock, so two deploys running migrations
+# at once apply each file once instead of racing
+MIGRATION_LOCK_ID = 7203114
+
+def available_migrations():
+    # Returns [(version, name, path)] sorted by version
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_FILE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    migrations.sort()
+
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError("Duplicate migration version in " + MIGRATIONS_DIR)
+    return migrations
+
+def ensure_migrations_table(conn):
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+        conn.commit()
+    finally:
+        cur.close()
+
+def applied_migrations(conn):
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT version, applied_at FROM schema_migrations")
+        return dict(cur.fetchall())
+    finally:
+        cur.close()
+
+def migrate(conn):
+    ensure_migrations_table(conn)
+    applied = []
+    for version, name, path in available_migrations():
+        with open(path) as f:
+            body = f.read()
+
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+            cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+            if cur.fetchone() is not None:
+                conn.rollback()
+                continue
+
+            cur.execute(body)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            conn.commit()
+            applied.append((version, name))
+        except psycopg2.Error:
+            conn.rollback()
+            print(f"Migration {version:04d}_{name} failed, nothing from it was applied")
+            raise
+        finally:
+            cur.close()
+    return applied
+
+def status(conn):
+    ensure_migrations_table(conn)
+    applied = applied_migrations(conn)
+    for version, name, _ in available_migrations():
+        applied_at = applied.get(version)
+        state = f"applied {applied_at:%Y-%m-%d %H:%M:%S}" if applied_at else "pending"
+        print(f"{version:04d}_{name:<40} {state}")
+
+# The statements app.py runs per request (see queries.py), with
+# representative parameters.
+# Statements that only call a function (cast_*_vote) are covered by the
+# queries the functions run internally, listed explicitly.
+def hot_queries():
+    limit = DEFAULT_FEED_LIMIT + 1
+    feed_after = {'top': (0, 1, limit), 'new': (datetime.now(), 1, limit), 'hot': (0.0, 1, limit)}
+    queries = [("validate_token", statements.query("validate_token"), validate_token_params(1, "token"))]
+    for sort in FEED_SORTS:
+        queries.append((f"feed_{sort}", statements.query(f"feed_{sort}"), (limit,)))
+        queries.append((f"feed_{sort}_after", statements.query(f"feed_{sort}_after"), feed_after[sort]))
+    queries += [
+        ("thread_post", statements.query("thread_post"), (1,)),
+        ("thread_top_level", statements.query("thread_top_level"),
+         thread_first_level_params(1, None, 0, DEFAULT_THREAD_LIMIT)),
+        ("thread_replies_to", statements.query("thread_replies_to"),
+         thread_first_level_params(1, 1, 0, DEFAULT_THREAD_LIMIT)),
+        ("thread_replies", statements.query("thread_replies"),
+         thread_replies_params(1, [1, 2, 3], DEFAULT_THREAD_LIMIT)),
+        ("logout", "DELETE FROM sessions WHERE token = %s", ("token",)),
+        ("purge_sessions", "DELETE FROM sessions WHERE created_at < NOW() - make_interval(secs => %s)",
+         (SESSION_TTL,)),
+        ("post_vote_lookup", "SELECT vote_type FROM post_votes WHERE user_id = %s AND post_id = %s", (1, 1)),
+        ("comment_vote_lookup", "SELECT vote_type FROM comment_votes WHERE user_id = %s AND comment_id = %s", (1, 1)),
+        ("comment_post_lookup", "SELECT post_id FROM comments WHERE id = %s", (1,)),
+        ("usernames", statements.query("usernames"), ([1, 2, 3],)),
+    ]
+    search_limit = DEFAULT_SEARCH_LIMIT + 1
+    for search_type in SEARCH_TYPES:
+        queries.append((f"search_{search_type}", statements.query(f"search_{search_type}"),
+                        ("search words", search_limit)))
+        queries.append((f"search_{search_type}_after", statements.query(f"search_{search_type}_after"),
+                        ("search words", 0.1, 1, search_limit)))
+    return queries
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+def check(conn):
+    # With enable_seqscan off the planner still falls back to a sequential
+    # scan when no index fits, so any Seq Scan left in the plan is a missing
+    # index rather than a small-table shortcut
+    failures = 0
+    cur = conn.cursor()
+    try:
+        cur.execute("SET enable_seqscan = off")
+        for name, query, params in hot_queries():
+            cur.execute("EXPLAIN (FORMAT JSON) " + query.strip().rstrip(';'), params)
+            plan = cur.fetchone()[0][0]["Plan"]
+            seq_scans = sorted({node["Relation Name"] for node in plan_nodes(plan)
+                                if node["Node Type"] == "Seq Scan"})
+            if seq_scans:
+                failures += 1
+                print(f"FAIL {name:<22} sequential scan on {', '.join(seq_scans)}")
+            else:
+                indexes = sorted({node["Index Name"] for node in plan_nodes(plan) if "Index Name" in node})
+                print(f"ok   {name:<22} {', '.join(indexes)}")
+    finally:
+        cur.close()
+        conn.rollback()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("command", nargs="?", default="migrate", choices=["migrate", "status", "check"])
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**db_config)
+    try:
+        if args.command == "status":
+            status(conn)
+        elif args.command == "check":
+            if check(conn):
+                sys.exit(1)
+        else:
+            applied = migrate(conn)
+            for version, name in applied:
+                print(f"Applied {version:04d}_{name}")
+            if not applied:
+                print("Database is up to date")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+-- Objects app.py has relied on since before migrations were tracked. Written
+-- to be safe on databases where some of them were created by hand.
+
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS score INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE comments ADD COLUMN IF NOT EXISTS score INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE comments ADD COLUMN IF NOT EXISTS parent_comment_id INTEGER REFERENCES comments(id) ON DELETE CASCADE;
+
+CREATE TABLE IF NOT EXISTS sessions (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    token VARCHAR(64) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- The primary keys double as the unique (user_id, item_id) indexes the
+-- cast_*_vote functions rely on for ON CONFLICT and the row lookup
+CREATE TABLE IF NOT EXISTS post_votes (
+    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+    post_id INTEGER REFERENCES posts(id) ON DELETE CASCADE,
+    vote_type VARCHAR(10) NOT NULL CHECK (vote_type IN ('upvote', 'downvote')),
+    PRIMARY KEY (user_id, post_id)
+);
+
+CREATE TABLE IF NOT EXISTS comment_votes (
+    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+    comment_id INTEGER REFERENCES comments(id) ON DELETE CASCADE,
+    vote_type VARCHAR(10) NOT NULL CHECK (vote_type IN ('upvote', 'downvote')),
+    PRIMARY KEY (user_id, comment_id)
+);
+
+-- Time-decayed ranking for the "hot" feed. Newer posts get a fixed bonus per
+-- 12.5 hours of age instead of older posts being divided down, so the value
+-- never changes for a post unless its score does and can be indexed.
+CREATE OR REPLACE FUNCTION hot_rank(score INTEGER, created_at TIMESTAMP)
+RETURNS DOUBLE PRECISION AS $$
+    SELECT SIGN(score) * LOG(GREATEST(ABS(score), 1))
+         + EXTRACT(EPOCH FROM created_at)::DOUBLE PRECISION / 45000
+$$ LANGUAGE SQL IMMUTABLE;
+
+-- Apply a vote and return the resulting score change. Voting the same way
+-- twice withdraws the vote, voting the other way flips it. The vote row is
+-- written (or locked) before the score row, so concurrent voters always take
+-- locks in the same order and the score always equals the sum of the votes.
+-- With p_apply_score = FALSE only the vote row is written and the caller is
+-- responsible for applying the returned delta (see score_buffer.py).
+CREATE OR REPLACE FUNCTION cast_post_vote(p_user_id INTEGER, p_post_id INTEGER, p_vote_type VARCHAR,
+                               p_apply_score BOOLEAN DEFAULT TRUE)
+RETURNS INTEGER AS $$
+DECLARE
+    new_value INTEGER := CASE p_vote_type WHEN 'upvote' THEN 1 ELSE -1 END;
+    old_type VARCHAR;
+    delta INTEGER;
+BEGIN
+    LOOP
+        INSERT INTO post_votes (user_id, post_id, vote_type)
+        VALUES (p_user_id, p_post_id, p_vote_type)
+        ON CONFLICT (user_id, post_id) DO NOTHING;
+        IF FOUND THEN
+            delta := new_value;
+            EXIT;
+        END IF;
+
+        SELECT vote_type INTO old_type FROM post_votes
+        WHERE user_id = p_user_id AND post_id = p_post_id
+        FOR UPDATE;
+        -- The conflicting row was withdrawn concurrently, try inserting again
+        CONTINUE WHEN NOT FOUND;
+
+        IF old_type = p_vote_type THEN
+            DELETE FROM post_votes WHERE user_id = p_user_id AND post_id = p_post_id;
+            delta := -new_value;
+        ELSE
+            UPDATE post_votes SET vote_type = p_vote_type
+            WHERE user_id = p_user_id AND post_id = p_post_id;
+            delta := 2 * new_value;
+        END IF;
+        EXIT;
+    END LOOP;
+
+    IF p_apply_score THEN
+        UPDATE posts SET score = score + delta WHERE id = p_post_id;
+    END IF;
+    RETURN delta;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION cast_comment_vote(p_user_id INTEGER, p_comment_id INTEGER, p_vote_type VARCHAR,
+                               p_apply_score BOOLEAN DEFAULT TRUE)
+RETURNS INTEGER AS $$
+DECLARE
+    new_value INTEGER := CASE p_vote_type WHEN 'upvote' THEN 1 ELSE -1 END;
+    old_type VARCHAR;
+    delta INTEGER;
+BEGIN
+    LOOP
+        INSERT INTO comment_votes (user_id, comment_id, vote_type)
+        VALUES (p_user_id, p_comment_id, p_vote_type)
+        ON CONFLICT (user_id, comment_id) DO NOTHING;
+        IF FOUND THEN
+            delta := new_value;
+            EXIT;
+        END IF;
+
+        SELECT vote_type INTO old_type FROM comment_votes
+        WHERE user_id = p_user_id AND comment_id = p_comment_id
+        FOR UPDATE;
+        CONTINUE WHEN NOT FOUND;
+
+        IF old_type = p_vote_type THEN
+            DELETE FROM comment_votes WHERE user_id = p_user_id AND comment_id = p_comment_id;
+            delta := -new_value;
+        ELSE
+            UPDATE comment_votes SET vote_type = p_vote_type
+            WHERE user_id = p_user_id AND comment_id = p_comment_id;
+            delta := 2 * new_value;
+        END IF;
+        EXIT;
+    END LOOP;
+
+    IF p_apply_score THEN
+        UPDATE comments SET score = score + delta WHERE id = p_comment_id;
+    END IF;
+    RETURN delta;
+END;
+$$ LANGUAGE plpgsql;
+
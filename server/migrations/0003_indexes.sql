@@ -0,0 +1,17 @@
+-- Indexes for the queries app.py runs on every request. `python migrate.py
+-- check` EXPLAINs those queries and fails if any of them needs a sequential scan.
+
+-- One index per /api/posts ordering, matching ORDER BY <key> DESC, id DESC.
+-- posts_top_idx and posts_new_idx are the score and created_at indexes.
+CREATE INDEX IF NOT EXISTS posts_top_idx ON posts (score, id);
+CREATE INDEX IF NOT EXISTS posts_new_idx ON posts (created_at, id);
+CREATE INDEX IF NOT EXISTS posts_hot_idx ON posts (hot_rank(score, created_at), id);
+
+-- Thread loading: each level of /api/post/<id> reads one parent's replies in
+-- id order (top-level comments have a NULL parent), and reply_count probes
+-- the same range
+CREATE INDEX IF NOT EXISTS comments_thread_idx ON comments (post_id, parent_comment_id, id);
+
+-- Session tokens are random and only ever compared for equality, which is
+-- what a hash index is for; it is also smaller than a btree on 32-char keys
+CREATE INDEX IF NOT EXISTS sessions_token_idx ON sessions USING HASH (token);
@@ -0,0 +1,13 @@
+-- Sessions now expire SESSION_TTL seconds after they are created; the
+-- janitor in sessions.py deletes old rows by created_at.
+CREATE INDEX IF NOT EXISTS sessions_created_at_idx ON sessions (created_at);
+
+-- Signed tokens (SESSION_TOKENS=signed) that were logged out before they
+-- expired. `expires` is the token's own expiry in unix seconds, after which
+-- the row is no longer needed.
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    token_id VARCHAR(32) PRIMARY KEY,
+    expires BIGINT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS revoked_tokens_expires_idx ON revoked_tokens (expires);
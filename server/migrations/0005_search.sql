@@ -0,0 +1,40 @@
+-- Full-text search for /api/search. Posts and comments carry a tsvector of
+-- their text, kept current by triggers, with a GIN index each. Titles weigh
+-- more than post bodies (A over B) when results are ranked. The text search
+-- configuration must match SEARCH_CONFIG in app.py.
+
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+ALTER TABLE comments ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+
+CREATE OR REPLACE FUNCTION posts_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := setweight(to_tsvector('english', COALESCE(NEW.title, '')), 'A')
+                      || setweight(to_tsvector('english', COALESCE(NEW.content, '')), 'B');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION comments_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := to_tsvector('english', COALESCE(NEW.content, ''));
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Only text changes recompute the vector; score updates from votes skip it
+DROP TRIGGER IF EXISTS posts_search_vector_trigger ON posts;
+CREATE TRIGGER posts_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF title, content ON posts
+    FOR EACH ROW EXECUTE FUNCTION posts_search_vector();
+
+DROP TRIGGER IF EXISTS comments_search_vector_trigger ON comments;
+CREATE TRIGGER comments_search_vector_trigger
+    BEFORE INSERT OR UPDATE OF content ON comments
+    FOR EACH ROW EXECUTE FUNCTION comments_search_vector();
+
+-- Existing rows; firing the triggers keeps the expressions in one place
+UPDATE posts SET title = title WHERE search_vector IS NULL;
+UPDATE comments SET content = content WHERE search_vector IS NULL;
+
+CREATE INDEX IF NOT EXISTS posts_search_idx ON posts USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS comments_search_idx ON comments USING GIN (search_vector);
@@ -0,0 +1,53 @@
+import threading
+import weakref
+
+
+class PreparedStatements:
+    """Named statements that are PREPAREd on each connection the first time
+    they are used there and EXECUTEd from then on, so Postgres parses and
+    plans them once per connection instead of once per request.
+
+    Queries are registered with psycopg2-style %s placeholders. Prepared
+    statements survive rollbacks, so a connection only ever prepares a given
+    statement once; a replacement connection from the pool starts over.
+    With enabled=False execute() sends the plain query text instead, which
+    is what you want behind a transaction-pooling proxy such as PgBouncer.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._queries = {}
+        self._prepared = weakref.WeakKeyDictionary()  # connection -> set of names
+        self._lock = threading.Lock()
+
+    def register(self, name, query):
+        # Postgres wants $1, $2, ... in PREPARE; none of our queries contain a
+        # literal %, so every %s is a parameter
+        parts = query.strip().rstrip(';').split('%s')
+        positional = parts[0] + ''.join(f"${i}{part}" for i, part in enumerate(parts[1:], start=1))
+        self._queries[name] = (query, positional, len(parts) - 1)
+
+    def query(self, name):
+        """The registered query text, with %s placeholders."""
+        return self._queries[name][0]
+
+    def execute(self, cursor, name, params=()):
+        query, positional, param_count = self._queries[name]
+        if not self.enabled:
+            cursor.execute(query, params)
+            return
+
+        conn = cursor.connection
+        with self._lock:
+            prepared = self._prepared.setdefault(conn, set())
+            needs_prepare = name not in prepared
+
+        if needs_prepare:
+            cursor.execute(f"PREPARE {name} AS {positional}")
+            with self._lock:
+                prepared.add(name)
+
+        if param_count:
+            cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * param_count)})", params)
+        else:
+            cursor.execute(f"EXECUTE {name}")
@@ -0,0 +1,217 @@
+"""Database settings and the statements the request handlers run.
+
+Kept apart from app.py, which opens pools and starts threads and worker
+processes when imported, so that migrate.py and the benchmarks can plan and
+run the same statements without any of that.
+"""
+import os
+
+from prepared import PreparedStatements
+
+# Database connection parameters
+db_config = {
+    'dbname': 'postgres',
+    'user': 'postgres',
+    'password': os.environ.get("DB_PASSWORD"),
+    'host': 'localhost'
+}
+
+# Hot queries are registered below and run as per-connection prepared
+# statements; PREPARED_STATEMENTS=0 sends them as plain text instead
+statements = PreparedStatements(enabled=os.environ.get("PREPARED_STATEMENTS", "1") == "1")
+
+# Sessions expire SESSION_TTL seconds after login
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 30 * 24 * 3600))
+
+# The session's user_id and the seconds it has left, so that a cached
+# validation never outlives the session
+statements.register("validate_token", """
+    SELECT user_id, EXTRACT(EPOCH FROM created_at + make_interval(secs => %s) - NOW())::FLOAT8
+    FROM sessions
+    WHERE user_id = %s AND token = %s AND created_at > NOW() - make_interval(secs => %s)
+""")
+
+def validate_token_params(user_id, token):
+    return (SESSION_TTL, user_id, token, SESSION_TTL)
+
+# Feed orderings accepted by /api/posts. Each one maps to the sort key selected
+# alongside the post row; every key is paired with p.id as a tie-breaker so the
+# keyset comparison is total, and each (key, id) pair has a matching index in
+# migrations/0003_indexes.sql.
+FEED_SORTS = {
+    'top': "p.score",
+    'new': "p.created_at",
+    'hot': "hot_rank(p.score, p.created_at)",
+}
+DEFAULT_FEED_SORT = 'hot'
+DEFAULT_FEED_LIMIT = 25
+MAX_FEED_LIMIT = 100
+
+def feed_query(sort, with_cursor):
+    # Keyset pagination: continue strictly after the last (key, id) pair of the
+    # previous page instead of using OFFSET, so each page is an index range scan
+    # of `limit` rows no matter how deep the reader is or how big the table gets.
+    # Parameters are the cursor's (key, id) if with_cursor, then the row limit.
+    sort_key = FEED_SORTS[sort]
+    where = f"WHERE ({sort_key}, p.id) < (%s, %s)" if with_cursor else ""
+    return f"""
+SELECT p.id, p.user_id, u.username, p.title, p.content, p.created_at, p.updated_at, p.score, {sort_key}
+FROM posts p
+JOIN users u ON p.user_id = u.id
+{where}
+ORDER BY {sort_key} DESC, p.id DESC
+LIMIT %s;
+"""
+
+for feed_sort in FEED_SORTS:
+    statements.register(f"feed_{feed_sort}", feed_query(feed_sort, False))
+    statements.register(f"feed_{feed_sort}_after", feed_query(feed_sort, True))
+
+# Rows for ranked_feed of posts that may have risen into it
+FEED_POSTS_QUERY = """
+SELECT p.id, p.user_id, u.username, p.title, p.content, p.created_at, p.updated_at, p.score
+FROM posts p
+JOIN users u ON p.user_id = u.id
+WHERE p.id = ANY(%s);
+"""
+statements.register("feed_posts", FEED_POSTS_QUERY)
+
+# ranked_feed's reads run in one REPEATABLE READ transaction, started by
+# these, so that all of their rows were read under the snapshot returned
+FEED_SNAPSHOT_QUERIES = ("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ;",
+                         "SELECT pg_current_snapshot()::TEXT;")
+
+DEFAULT_THREAD_LIMIT = 200
+MAX_THREAD_LIMIT = 1000
+DEFAULT_THREAD_DEPTH = 10
+MAX_THREAD_DEPTH = 50
+
+THREAD_POST_QUERY = """
+    SELECT p.id, p.user_id, p.title, p.content, p.created_at, p.updated_at, p.score, u.username
+    FROM posts p INNER JOIN users u ON p.user_id = u.id WHERE p.id = %s
+"""
+
+# reply_count is capped: it only needs to tell whether a comment has more
+# replies than the response is about to show.
+THREAD_COMMENT_COLUMNS = """
+    c.id, c.parent_comment_id, c.content, c.created_at, c.score, u.username,
+    (SELECT COUNT(*) FROM (
+        SELECT 1 FROM comments r
+        WHERE r.post_id = c.post_id AND r.parent_comment_id = c.id
+        LIMIT %s
+    ) capped) AS reply_count
+"""
+
+def thread_first_level_query(parent_id):
+    # Parameters: reply_count cap, post_id, parent_id (unless None), after_id, limit
+    parent_filter = "c.parent_comment_id IS NULL" if parent_id is None else "c.parent_comment_id = %s"
+    return f"""
+        SELECT {THREAD_COMMENT_COLUMNS}
+        FROM comments c
+        JOIN users u ON c.user_id = u.id
+        WHERE c.post_id = %s AND {parent_filter} AND c.id > %s
+        ORDER BY c.id
+        LIMIT %s
+    """
+
+statements.register("thread_post", THREAD_POST_QUERY)
+statements.register("thread_top_level", thread_first_level_query(None))
+statements.register("thread_replies_to", thread_first_level_query(0))
+
+def thread_first_level_params(post_id, parent_id, after_id, limit):
+    # One extra row tells whether there is a next page
+    parent = (parent_id,) if parent_id is not None else ()
+    return (limit + 1, post_id) + parent + (after_id, limit + 1)
+
+# Up to `per_parent` replies for each parent, oldest first, in the order the
+# parents were given, stopping after `total` rows. Each lateral probe is an
+# index range scan, so the work is bounded by the page size rather than by how
+# many replies a parent has.
+# Parameters: reply_count cap, parent ids, post_id, per_parent, total
+THREAD_REPLIES_QUERY = f"""
+    SELECT {THREAD_COMMENT_COLUMNS}
+    FROM unnest(%s::INTEGER[]) WITH ORDINALITY AS f(parent_id, ord)
+    CROSS JOIN LATERAL (
+        SELECT * FROM comments c
+        WHERE c.post_id = %s AND c.parent_comment_id = f.parent_id
+        ORDER BY c.id
+        LIMIT %s
+    ) c
+    JOIN users u ON c.user_id = u.id
+    ORDER BY f.ord, c.id
+    LIMIT %s
+"""
+
+statements.register("thread_replies", THREAD_REPLIES_QUERY)
+
+def thread_replies_params(post_id, parent_ids, budget):
+    return (budget + 1, parent_ids, post_id, budget, budget)
+
+statements.register("cast_comment_vote", """
+    SELECT cast_comment_vote(%s, %s, %s, %s), (SELECT post_id FROM comments WHERE id = %s);
+""")
+
+statements.register("cast_post_vote", "SELECT cast_post_vote(%s, %s, %s, %s);")
+
+statements.register("usernames", "SELECT id, username FROM users WHERE id = ANY(%s);")
+
+# Search over the search_vector columns kept by migrations/0005_search.sql
+SEARCH_CONFIG = "english"
+SEARCH_TYPES = ("posts", "comments")
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+MAX_SEARCH_QUERY = 200
+
+# Sets statement_timeout for the rest of the transaction
+SEARCH_TIMEOUT_QUERY = "SELECT set_config('statement_timeout', %s, true);"
+
+# ts_headline marks matches with these control characters; search_snippet()
+# escapes the rest as HTML and turns them into <mark> tags, so whatever users
+# wrote comes out as text
+SNIPPET_START, SNIPPET_STOP = "\x02", "\x03"
+SNIPPET_OPTIONS = (f"StartSel={SNIPPET_START}, StopSel={SNIPPET_STOP}, "
+                   'MaxWords=35, MinWords=15, MaxFragments=2, FragmentDelimiter=" … "')
+TITLE_OPTIONS = f"StartSel={SNIPPET_START}, StopSel={SNIPPET_STOP}, HighlightAll=true"
+
+# Titles are scored above bodies by their weights; normalization 1 divides by
+# the log of the length so long texts do not win by repetition alone
+SEARCH_RANK = "ts_rank_cd({alias}.search_vector, query, 1)"
+
+SEARCH_COLUMNS = {
+    'posts': """p.id, p.user_id, u.username, p.title, p.created_at, p.score,
+       ts_headline('{config}', p.title, hits.query, '{title_options}'),
+       ts_headline('{config}', p.content, hits.query, '{snippet_options}')""",
+    'comments': """p.id, p.post_id, post.title, p.user_id, u.username, p.created_at, p.score,
+       ts_headline('{config}', p.content, hits.query, '{snippet_options}')""",
+}
+
+def search_query(search_type, with_cursor):
+    # Every match is ranked, but ts_headline, the expensive part, only runs on
+    # the page. Keyset pagination over (rank, id) as in feed_query; ranks are
+    # REALs that survive the round trip through the cursor exactly.
+    # Parameters are the query text, the cursor's (rank, id) if with_cursor,
+    # then the row limit. Rows end with the rank.
+    rank = SEARCH_RANK.format(alias="m")
+    where = f"AND ({rank}, m.id) < (%s::REAL, %s)" if with_cursor else ""
+    join_post = "JOIN posts post ON post.id = p.post_id" if search_type == "comments" else ""
+    columns = SEARCH_COLUMNS[search_type].format(config=SEARCH_CONFIG, title_options=TITLE_OPTIONS,
+                                                 snippet_options=SNIPPET_OPTIONS)
+    return f"""
+WITH hits AS (
+    SELECT m.id, {rank} AS rank, query
+    FROM {search_type} m, websearch_to_tsquery('{SEARCH_CONFIG}', %s) AS query
+    WHERE m.search_vector @@ query {where}
+    ORDER BY rank DESC, m.id DESC
+    LIMIT %s
+)
+SELECT {columns}, hits.rank
+FROM hits
+JOIN {search_type} p ON p.id = hits.id
+JOIN users u ON u.id = p.user_id
+{join_post}
+ORDER BY hits.rank DESC, hits.id DESC;
+"""
+
+for search_type in SEARCH_TYPES:
+    statements.register(f"search_{search_type}", search_query(search_type, False))
+    statements.register(f"search_{search_type}_after", search_query(search_type, True))
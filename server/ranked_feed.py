@@ -0,0 +1,232 @@
+import bisect
+import threading
+import time
+from datetime import datetime
+
+
+class RankedFeed:
+    """The first `size` posts of every feed ordering, kept in memory so a feed
+    page is a bisect and a slice instead of a query.
+
+    Rows are the ones feed_query returns minus the trailing sort key:
+    (id, user_id, username, title, content, created_at, updated_at, score).
+    `sort_keys` maps each sort to a function computing its key from such a
+    row; keys must order the same way the SQL does.
+
+    The structure does no I/O. Callers load it with begin_reload() /
+    finish_reload(), feed it writes with add_post() and apply_vote(), and
+    fetch the rows of posts returned by take_pending() (see below) before
+    calling page().
+
+    Rows read from the database come with the Snapshot they were read under.
+    Votes arrive as events some time after they commit, so one that committed
+    before a row was read may be delivered after it; apply_vote() is given
+    the voting transaction's id and skips votes the row's snapshot already
+    saw, which would otherwise be counted twice.
+
+    Per sort, every post not held ranks below `floor` (the last entry dropped
+    to stay within `size`, or None while every post is held). Keeping that
+    true is what makes a page served from here identical to the query's:
+
+    - a held post whose key falls below the floor is dropped, since posts
+      we don't hold may now rank above it;
+    - a post we don't hold that gets an upvote may rise past the floor, so
+      its id is queued in pending and its row fetched before the next page.
+
+    Everything is reloaded every `refresh_interval` seconds, to bound the
+    drift from events that were lost, and after reload() is called.
+    """
+
+    def __init__(self, sort_keys, size=1000, refresh_interval=300.0):
+        self.sort_keys = sort_keys
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self._rows = {}  # post_id -> row
+        self._snapshots = {}  # post_id -> Snapshot, for rows read from the database
+        self._entries = {sort: [] for sort in sort_keys}  # ascending (key, post_id)
+        self._keys = {sort: {} for sort in sort_keys}  # post_id -> key
+        self._floor = {sort: None for sort in sort_keys}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._reloading = False
+        self._journal = None  # writes seen while a reload runs, replayed after
+        self._reload_due = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def _place(self, sort, post_id, row):
+        key = self.sort_keys[sort](row)
+        entries = self._entries[sort]
+        keys = self._keys[sort]
+        old_key = keys.get(post_id)
+        if old_key is not None:
+            del entries[bisect.bisect_left(entries, (old_key, post_id))]
+            del keys[post_id]
+
+        floor = self._floor[sort]
+        if floor is not None and (key, post_id) < floor:
+            return
+        bisect.insort(entries, (key, post_id))
+        keys[post_id] = key
+
+        while len(entries) > self.size:
+            dropped_key, dropped_id = entries.pop(0)
+            del keys[dropped_id]
+            self._floor[sort] = (dropped_key, dropped_id)
+            self._forget(dropped_id)
+
+    def _forget(self, post_id):
+        # Drop the row once no sort holds the post any more
+        if all(post_id not in keys for keys in self._keys.values()):
+            self._rows.pop(post_id, None)
+            self._snapshots.pop(post_id, None)
+
+    def _add(self, row, snapshot=None):
+        post_id = row[0]
+        self._rows[post_id] = row
+        if snapshot is not None:
+            self._snapshots[post_id] = snapshot
+        else:
+            self._snapshots.pop(post_id, None)
+        self._pending.discard(post_id)
+        for sort in self._entries:
+            self._place(sort, post_id, row)
+        self._forget(post_id)
+
+    def _vote(self, post_id, delta, txid):
+        row = self._rows.get(post_id)
+        if row is None:
+            if delta > 0 and any(floor is not None for floor in self._floor.values()):
+                self._pending.add(post_id)
+            return
+        snapshot = self._snapshots.get(post_id)
+        if txid is not None and snapshot is not None and snapshot.sees(txid):
+            return
+        self._add(row[:7] + (row[7] + delta,), snapshot)
+
+    def add_post(self, row, snapshot=None):
+        # snapshot: what the row was read under, None for a row built from a
+        # post_created event (every vote on it comes later)
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((self._add, row, snapshot))
+            if self._loaded:
+                self._add(row, snapshot)
+
+    def apply_vote(self, post_id, delta, txid=None):
+        # txid: the voting transaction's, as in the score_changed event
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((self._vote, post_id, delta, txid))
+            if self._loaded:
+                self._vote(post_id, delta, txid)
+
+    def refetch(self, post_id):
+        # For writes that arrive without the whole row
+        with self._lock:
+            if self._loaded:
+                self._pending.add(post_id)
+
+    def reload(self):
+        with self._lock:
+            self._reload_due = 0.0
+
+    def begin_reload(self):
+        """True if the caller should load fresh rows now and pass them to
+        finish_reload() (or abort_reload()); only one caller at a time is
+        asked to."""
+        with self._lock:
+            if self._reloading or time.monotonic() < self._reload_due:
+                return False
+            self._reloading = True
+            self._journal = []
+            return True
+
+    def finish_reload(self, rows_by_sort, snapshot=None):
+        # rows_by_sort: sort -> up to `size` feed_query rows, best first, all
+        # read under `snapshot`
+        with self._lock:
+            self._rows = {}
+            self._snapshots = {}
+            self._pending = set()
+            for sort, rows in rows_by_sort.items():
+                self._entries[sort] = sorted((row[8], row[0]) for row in rows)
+                self._keys[sort] = {row[0]: row[8] for row in rows}
+                self._floor[sort] = self._entries[sort][0] if len(rows) >= self.size else None
+                for row in rows:
+                    self._rows[row[0]] = tuple(row[:8])
+                    if snapshot is not None:
+                        self._snapshots[row[0]] = snapshot
+            # Writes delivered while the rows were being read; votes the
+            # snapshot saw are skipped
+            for apply, *args in self._journal:
+                apply(*args)
+            self._journal = None
+            self._loaded = True
+            self._reloading = False
+            self._reload_due = time.monotonic() + self.refresh_interval
+            self.reloads += 1
+
+    def abort_reload(self):
+        with self._lock:
+            self._journal = None
+            self._reloading = False
+
+    def take_pending(self):
+        """Ids of posts whose rows should be fetched and passed to add_post()
+        before the next page()."""
+        with self._lock:
+            pending, self._pending = self._pending, set()
+            return pending
+
+    def page(self, sort, limit, cursor):
+        """Up to limit + 1 feed_query rows after `cursor`, or None when the
+        page reaches past what is held and must come from the database."""
+        with self._lock:
+            entries = self._entries[sort]
+            end = len(entries) if cursor is None else bisect.bisect_left(entries, tuple(cursor))
+            start = end - (limit + 1)
+            if not self._loaded or self._pending or (start < 0 and self._floor[sort] is not None):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return [self._rows[post_id] + (key,) for key, post_id in reversed(entries[max(start, 0):end])]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": self.size,
+                "posts": len(self._rows),
+                "pending": len(self._pending),
+                "reloads": self.reloads,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class Snapshot:
+    """A Postgres snapshot as pg_current_snapshot() prints it
+    ("xmin:xmax:xip,..."): which transactions' writes a read saw."""
+
+    def __init__(self, text):
+        xmin, xmax, xip = text.split(":")
+        self.xmin = int(xmin)
+        self.xmax = int(xmax)
+        self.xip = frozenset(int(txid) for txid in xip.split(",") if txid)
+
+    def sees(self, txid):
+        # For transactions known to have committed, like any that notified
+        return txid < self.xmin or (txid < self.xmax and txid not in self.xip)
+
+
+def post_row(post):
+    """A RankedFeed row from a post as it appears in a feed page or a
+    post_created event, where timestamps may be ISO strings."""
+    created_at, updated_at = (datetime.fromisoformat(value) if isinstance(value, str) else value
+                              for value in (post["created_at"], post["updated_at"]))
+    return (post["id"], post["user_id"], post["author"], post["title"], post["content"],
+            created_at, updated_at, post["score"])
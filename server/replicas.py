@@ -0,0 +1,213 @@
+"""Routing reads to streaming read replicas.
+
+With DB_REPLICAS set (see app.py), GET endpoints that only read take a
+connection from a replica pool chosen by ReplicaRouter; writes, token checks
+and cache fills stay on the primary. Responses to writes carry the primary's
+WAL position so the writer's next reads wait for a replica that has it.
+
+A replica to try this with locally, next to a primary on port 5432 that has
+wal_level=replica (the default):
+
+    pg_basebackup -h localhost -p 5432 -U postgres -D /tmp/replica -R
+    pg_ctl -D /tmp/replica -o "-p 5433" start
+    DB_REPLICAS=localhost:5433 python app.py
+
+`SELECT pg_wal_replay_pause()` on the replica makes it fall behind, and reads
+go back to the primary once it is REPLICA_MAX_LAG seconds late;
+`SELECT pg_wal_replay_resume()` lets it catch up.
+"""
+import collections
+import itertools
+import threading
+import time
+
+import psycopg2
+
+WRITE_POSITION_QUERY = "SELECT pg_current_wal_lsn()::TEXT"
+
+
+def parse_lsn(text):
+    """A WAL position such as "16/B374D848" as an integer, or None."""
+    try:
+        high, low = text.split("/")
+        return (int(high, 16) << 32) + int(low, 16)
+    except (AttributeError, ValueError):
+        return None
+
+
+def format_lsn(lsn):
+    return f"{lsn >> 32:X}/{lsn & 0xFFFFFFFF:X}"
+
+
+class ReplicaRouter:
+    """Decides which streaming replica, if any, may serve a read.
+
+    A background thread samples the primary's WAL position and each
+    replica's replay position every `check_interval` seconds, over its own
+    connections. A replica's lag is how long ago the primary first had WAL
+    the replica has not replayed yet, so an idle primary means no lag, and a
+    replica that stopped receiving WAL falls behind even though it has
+    nothing left to replay. Replicas more than `max_lag` seconds behind, or
+    that could not be checked, get no reads.
+
+    choose(read_after) also skips replicas that have not replayed
+    `read_after` yet: writers are handed the primary's WAL position after
+    their write commits (see write_position()), so reads they send with it
+    see their own write. Positions are only as fresh as the last check, so
+    such reads usually go to the primary for up to one interval.
+
+    Connection pools are kept by the caller; choose() returns an index into
+    the `replicas` list given here (each a dict of psycopg2.connect
+    arguments), or None for the primary.
+    """
+
+    def __init__(self, primary, replicas, max_lag=1.0, check_interval=0.5):
+        self.primary = primary
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._history = collections.deque()  # (monotonic time, primary LSN), oldest first
+        self._replayed = [None] * len(replicas)  # replay LSN, None if unknown
+        self._lag = [None] * len(replicas)  # seconds, None if unknown
+        self._reads = [0] * len(replicas)
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.primary_reads = 0
+
+    def choose(self, read_after=None):
+        with self._lock:
+            eligible = [index for index, lag in enumerate(self._lag)
+                        if lag is not None and lag <= self.max_lag
+                        and (read_after is None or self._replayed[index] >= read_after)]
+            if not eligible:
+                self.primary_reads += 1
+                return None
+            index = eligible[next(self._next) % len(eligible)]
+            self._reads[index] += 1
+            return index
+
+    def mark_failed(self, index):
+        # The caller could not get a connection; no reads until the next check
+        with self._lock:
+            self._lag[index] = None
+
+    def _lag_since(self, replayed, now):
+        # Seconds since the primary was first seen past `replayed`. Behind
+        # even the oldest sample, that is only a lower bound, and no bound at
+        # all until the samples go back max_lag seconds.
+        oldest = self._history[0][0]
+        for sampled_at, lsn in self._history:
+            if lsn > replayed:
+                if sampled_at == oldest and now - oldest <= self.max_lag:
+                    return None
+                return now - sampled_at
+        return 0.0
+
+    def _query(self, conn, query):
+        cur = conn.cursor()
+        try:
+            cur.execute(query)
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+
+    def check_once(self, connections):
+        # connections: [primary] + one per replica, opened by _run()
+        now = time.monotonic()
+        primary_lsn = parse_lsn(self._query(connections[0], WRITE_POSITION_QUERY))
+
+        replayed = []
+        for conn in connections[1:]:
+            try:
+                # NULL when the server is not a replica at all (a primary
+                # listed for testing); treat it as fully caught up
+                lsn = parse_lsn(self._query(conn, "SELECT pg_last_wal_replay_lsn()::TEXT"))
+                replayed.append(primary_lsn if lsn is None else lsn)
+            except psycopg2.Error:
+                replayed.append(None)
+
+        with self._lock:
+            self._history.append((now, primary_lsn))
+            # Only samples within max_lag of now can tell an acceptable lag
+            # from an unacceptable one
+            while len(self._history) > 1 and self._history[1][0] < now - self.max_lag - self.check_interval:
+                self._history.popleft()
+            for index, lsn in enumerate(replayed):
+                self._replayed[index] = lsn
+                self._lag[index] = None if lsn is None else self._lag_since(lsn, now)
+
+    def _connect(self, config):
+        conn = psycopg2.connect(**config)
+        conn.autocommit = True
+        return conn
+
+    def _run(self):
+        connections = [None] * (len(self.replicas) + 1)
+        configs = [self.primary] + self.replicas
+        while not self._stopped.is_set():
+            try:
+                for index, config in enumerate(configs):
+                    if connections[index] is None or connections[index].closed:
+                        try:
+                            connections[index] = self._connect(config)
+                        except psycopg2.Error:
+                            connections[index] = None
+                if connections[0] is None:
+                    raise psycopg2.OperationalError("cannot reach the primary")
+                self.check_once([conn if conn is not None else _Unreachable() for conn in connections])
+            except psycopg2.Error as e:
+                # Without the primary's position no replica can be trusted
+                print(f"Replica check failed: {e}")
+                with self._lock:
+                    self._lag = [None] * len(self.replicas)
+            self._stopped.wait(self.check_interval)
+        for conn in connections:
+            if conn is not None:
+                conn.close()
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="replica-router", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_lag": self.max_lag,
+                "primary_reads": self.primary_reads,
+                "replicas": [
+                    {
+                        "host": f"{config.get('host')}:{config.get('port', 5432)}",
+                        "lag": lag,
+                        "replayed": format_lsn(replayed) if replayed is not None else None,
+                        "reads": reads,
+                    }
+                    for config, lag, replayed, reads in zip(self.replicas, self._lag, self._replayed, self._reads)
+                ],
+            }
+
+
+class _Unreachable:
+    # Stands in for a replica connection that could not be opened
+    def cursor(self):
+        raise psycopg2.OperationalError("replica unreachable")
+
+
+def write_position(conn):
+    """The primary's WAL position right after a commit on conn, as text for
+    the client to send back with its next reads."""
+    cur = conn.cursor()
+    try:
+        cur.execute(WRITE_POSITION_QUERY)
+        return cur.fetchone()[0]
+    finally:
+        cur.close()
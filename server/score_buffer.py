@@ -0,0 +1,120 @@
+import threading
+
+from psycopg2.extras import execute_values
+
+
+class ScoreBuffer:
+    """Collects per-post and per-comment score deltas in memory and writes them
+    out in one batched UPDATE per table.
+
+    Used when votes are recorded with the score update deferred: instead of
+    every vote on a hot post taking that post's row lock, the lock is taken
+    once per flush. A background thread flushes every `interval` seconds and
+    stop() flushes whatever is left.
+
+    Flushes run one at a time, so once flush() returns every delta added
+    before it was called has been written (unless it failed).
+    """
+
+    TABLES = ("posts", "comments")
+
+    def __init__(self, get_connection, release_connection, interval=1.0):
+        self.get_connection = get_connection
+        self.release_connection = release_connection
+        self.interval = interval
+        self._pending = {table: {} for table in self.TABLES}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def add(self, table, item_id, delta):
+        if delta == 0:
+            return
+        with self._lock:
+            pending = self._pending[table]
+            pending[item_id] = pending.get(item_id, 0) + delta
+
+    def _take(self):
+        with self._lock:
+            taken = self._pending
+            self._pending = {table: {} for table in self.TABLES}
+        return taken
+
+    def _restore(self, taken):
+        with self._lock:
+            for table, deltas in taken.items():
+                pending = self._pending[table]
+                for item_id, delta in deltas.items():
+                    pending[item_id] = pending.get(item_id, 0) + delta
+
+    def flush(self):
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        taken = self._take()
+        if not any(taken.values()):
+            return 0
+
+        conn = self.get_connection()
+        if conn is None:
+            self._restore(taken)
+            return 0
+
+        cur = conn.cursor()
+        try:
+            rows = 0
+            for table, deltas in taken.items():
+                if not deltas:
+                    continue
+                # Sorted so concurrent flushers lock rows in the same order
+                values = sorted((int(item_id), delta) for item_id, delta in deltas.items() if delta)
+                execute_values(
+                    cur,
+                    f"UPDATE {table} SET score = {table}.score + v.delta "
+                    f"FROM (VALUES %s) AS v(id, delta) WHERE {table}.id = v.id",
+                    values,
+                    page_size=len(values) or 1,
+                )
+                rows += len(values)
+            conn.commit()
+            self.flushes += 1
+            self.flushed_rows += rows
+            return rows
+        except Exception as e:
+            conn.rollback()
+            self._restore(taken)
+            print(f"Error flushing score buffer: {e}")
+            return 0
+        finally:
+            cur.close()
+            self.release_connection(conn)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="score-buffer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = {table: len(deltas) for table, deltas in self._pending.items()}
+        return {
+            "interval": self.interval,
+            "pending": pending,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+        }
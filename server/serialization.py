@@ -0,0 +1,38 @@
+import json
+import time
+from datetime import date, datetime
+
+from flask import Response
+
+from metrics import record_serialization
+
+# orjson is optional; it is several times faster than the stdlib encoder and
+# serializes datetimes itself
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def dumps(payload):
+    """Serialize `payload` to compact JSON bytes."""
+    started = time.perf_counter()
+    if orjson is not None:
+        body = orjson.dumps(payload, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    else:
+        body = json.dumps(payload, separators=(',', ':'), default=_default).encode()
+    record_serialization(time.perf_counter() - started)
+    return body
+
+
+def json_response(payload, status=200):
+    """Build a JSON response, serializing `payload` exactly once. Bytes are
+    assumed to be JSON already and are sent as they are."""
+    body = payload if isinstance(payload, bytes) else dumps(payload)
+    return Response(body, status=status, mimetype='application/json')
@@ -0,0 +1,156 @@
+import base64
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+
+
+class SignedTokens:
+    """Stateless session tokens: "<user_id>.<expires>.<token_id>.<signature>",
+    signed with HMAC-SHA256 so they can be checked without a database lookup.
+
+    Tokens can't be recalled once issued, so logout records the token_id in a
+    revocation list until the token would have expired anyway. The list here
+    is the in-process copy; SessionJanitor keeps it in sync with the
+    revoked_tokens table, so a token revoked by another process is honoured
+    for at most one janitor interval.
+    """
+
+    def __init__(self, secret, ttl):
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.ttl = ttl
+        self._revoked = {}  # token_id -> expires (unix time)
+        self._lock = threading.Lock()
+
+    def _sign(self, payload):
+        digest = hmac.new(self.secret, payload.encode(), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+    def issue(self, user_id):
+        expires = int(time.time() + self.ttl)
+        payload = f"{int(user_id)}.{expires}.{secrets.token_hex(8)}"
+        return f"{payload}.{self._sign(payload)}"
+
+    def parse(self, token):
+        # Returns (user_id, expires, token_id) for a well-signed token, else None.
+        # Expiry and revocation are not checked here, see verify().
+        try:
+            payload, signature = token.rsplit('.', 1)
+            user_id, expires, token_id = payload.split('.')
+            claims = (int(user_id), int(expires), token_id)
+        except (AttributeError, ValueError):
+            return None
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            return None
+        return claims
+
+    def verify(self, token):
+        """The token's user_id, or None if it is forged, expired or revoked."""
+        claims = self.parse(token)
+        if claims is None:
+            return None
+        user_id, expires, token_id = claims
+        if expires <= time.time():
+            return None
+        with self._lock:
+            if token_id in self._revoked:
+                return None
+        return user_id
+
+    def revoke(self, token_id, expires):
+        with self._lock:
+            self._revoked[token_id] = expires
+
+    def replace_revoked(self, revoked):
+        # revoked: iterable of (token_id, expires) read back from the database
+        now = time.time()
+        with self._lock:
+            local = {token_id: expires for token_id, expires in self._revoked.items() if expires > now}
+            local.update(revoked)
+            self._revoked = local
+
+    def stats(self):
+        with self._lock:
+            return {"ttl": self.ttl, "revoked": len(self._revoked)}
+
+
+# Signed tokens: the revocation entry lives as long as the token would have
+REVOKE_TOKEN_QUERY = """
+    INSERT INTO revoked_tokens (token_id, expires) VALUES (%s, %s)
+    ON CONFLICT (token_id) DO NOTHING;
+"""
+
+
+class SessionJanitor:
+    """Background thread that deletes `sessions` rows older than session_ttl
+    seconds and expired revoked_tokens rows every `interval` seconds, and
+    refreshes the in-process revocation list of `signed_tokens` if given.
+    """
+
+    def __init__(self, get_connection, release_connection, interval=60.0, session_ttl=30 * 24 * 3600,
+                 signed_tokens=None):
+        self.get_connection = get_connection
+        self.release_connection = release_connection
+        self.interval = interval
+        self.session_ttl = session_ttl
+        self.signed_tokens = signed_tokens
+        self._stopped = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.purged_sessions = 0
+        self.purged_revocations = 0
+
+    def run_once(self):
+        conn = self.get_connection()
+        if conn is None:
+            return
+        cur = conn.cursor()
+        try:
+            cur.execute("DELETE FROM sessions WHERE created_at < NOW() - make_interval(secs => %s)",
+                        (self.session_ttl,))
+            purged_sessions = cur.rowcount
+            cur.execute("DELETE FROM revoked_tokens WHERE expires < EXTRACT(EPOCH FROM NOW())")
+            purged_revocations = cur.rowcount
+            revoked = None
+            if self.signed_tokens is not None:
+                cur.execute("SELECT token_id, expires FROM revoked_tokens")
+                revoked = cur.fetchall()
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error purging sessions: {e}")
+            return
+        finally:
+            cur.close()
+            self.release_connection(conn)
+
+        if revoked is not None:
+            self.signed_tokens.replace_revoked(revoked)
+        self.runs += 1
+        self.purged_sessions += purged_sessions
+        self.purged_revocations += purged_revocations
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.run_once()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="session-janitor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        return {
+            "interval": self.interval,
+            "session_ttl": self.session_ttl,
+            "runs": self.runs,
+            "purged_sessions": self.purged_sessions,
+            "purged_revocations": self.purged_revocations,
+        }